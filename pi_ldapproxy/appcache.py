@@ -1,9 +1,10 @@
 import functools
 
 from twisted.internet import reactor
-from twisted.logger import Logger
 
-log = Logger()
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
 
 def case_insensitive_dn(wrapped_function):
     """
@@ -37,8 +38,11 @@ class AppCache(object):
         #: Map of dn to tuples (app marker, insertion timestamp)
         self._entries = {}
 
+    def __len__(self):
+        return len(self._entries)
+
     @case_insensitive_dn
-    def add_to_cache(self, dn, marker):
+    def add_to_cache(self, dn, marker, age=0):
         """
         Add the entry to the app cache. It will be automatically removed after ``timeout`` seconds.
         If an entry for ``dn`` (with any marker) already exists, it will be overwritten.
@@ -49,15 +53,29 @@ class AppCache(object):
         This function respects the ``case_insensitive`` option.
         :param dn: DN
         :param marker: App marker (a string)
+        :param age: number of seconds since the entry has been added to another app cache (see ``entries``).
+        This is subtracted from the timeout.
         """
+        if age >= self.timeout:
+            log.info('Not adding expired entry to app cache: dn={dn!r}, marker={marker!r}', dn=dn, marker=marker)
+            return
         if dn in self._entries:
             log.info('Entry {dn!r} already cached {marker!r}, overwriting ...',
                      dn=dn, marker=self._entries[dn])
-        current_time = reactor.seconds()
-        log.info('Adding to app cache: dn={dn!r}, marker={marker!r}, time={time!r}',
-                 dn=dn, time=current_time, marker=marker)
+        current_time = reactor.seconds() - age
+        log.sampled_info('Adding to app cache: dn={dn!r}, marker={marker!r}, time={time!r}',
+                         dn=dn, time=current_time, marker=marker)
         self._entries[dn] = (marker, current_time)
-        self.callLater(self.timeout, self.remove_from_cache, dn, marker)
+        self.callLater(self.timeout - age, self.remove_from_cache, dn, marker)
+
+    def entries(self):
+        """
+        Return all entries of the app cache, e.g. to hand them over to another process.
+        :return: a list of tuples ``(dn, marker, age)``, where *age* is the number of seconds since the
+        entry has been added
+        """
+        current_time = reactor.seconds()
+        return [(dn, marker, current_time - timestamp) for dn, (marker, timestamp) in self._entries.items()]
 
     @case_insensitive_dn
     def remove_from_cache(self, dn, marker):
@@ -73,7 +91,7 @@ class AppCache(object):
             stored_marker, stored_timestamp = self._entries[dn]
             if stored_marker == marker:
                 del self._entries[dn]
-                log.info('Removed {dn!r}/{marker!r} from app cache', dn=dn, marker=marker)
+                log.sampled_info('Removed {dn!r}/{marker!r} from app cache', dn=dn, marker=marker)
             else:
                 log.warn('Removal from app cache failed: {dn!r} mapped to {stored!r}, not {marker!r}',
                          dn=dn, stored=stored_marker, marker=marker)
@@ -99,5 +117,5 @@ class AppCache(object):
                     dn=dn, inserted=timestamp, current=current_time
                 )
         else:
-            log.info('No entry in app cache for dn={dn!r}', dn=dn)
+            log.sampled_info('No entry in app cache for dn={dn!r}', dn=dn)
         return None
@@ -0,0 +1,251 @@
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+
+class BackendConnectionPool(object):
+    """
+    A pool of idle connections to the LDAP backend. Instead of closing the connection to the LDAP backend
+    once a client session has ended, the session releases it to the pool. The connection is then reset
+    using an anonymous bind and handed out to the next client session, which saves the TCP and TLS
+    handshakes with the LDAP backend.
+
+    Connections are only kept if they are still connected, have no outstanding operations, have not
+    exceeded their maximum lifetime and have been reset successfully. Idle connections are closed
+    after ``idle_timeout`` seconds.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = reactor.seconds
+
+    def __init__(self, connector, size, max_lifetime, idle_timeout):
+        """
+        :param connector: A callable which returns a Deferred firing a new ``LDAPClient`` instance
+        :param size: Maximum number of idle connections kept in the pool
+        :param max_lifetime: Number of seconds after which a connection is not reused anymore
+        :param idle_timeout: Number of seconds after which an idle connection is closed
+        """
+        self.connector = connector
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        #: List of tuples (client, release timestamp), the most recently released connection comes last
+        self._idle = []
+        #: DelayedCall which evicts idle connections, or None
+        self._eviction_call = None
+
+    @property
+    def idle_count(self):
+        """ Number of idle connections in the pool """
+        return len(self._idle)
+
+    def acquire(self):
+        """
+        Hand out an idle connection to the LDAP backend. If there is no usable idle connection,
+        establish a new one.
+        :return: A Deferred that fires a ``LDAPClient`` instance
+        """
+        now = self.seconds()
+        while self._idle:
+            client, released = self._idle.pop()
+            if self._is_alive(client, now):
+                return defer.succeed(client)
+            self._discard(client)
+        d = self.connector()
+        d.addCallback(self._register)
+        return d
+
+    def fill(self):
+        """
+        Establish new connections until the pool holds ``size`` idle connections, e.g. on startup.
+        :return: A Deferred that fires once all connection attempts have completed
+        """
+        deferreds = []
+        for _ in range(self.size - len(self._idle)):
+            d = self.connector()
+            d.addCallback(self._register)
+            d.addCallback(lambda client: self._reset_succeeded(None, client))
+            deferreds.append(d)
+        return defer.gatherResults(deferreds, consumeErrors=True)
+
+    def _register(self, client):
+        # We store the creation timestamp on the client itself. This way, the pool does not keep
+        # references to connections that are closed without being released to the pool.
+        client.pool_created = self.seconds()
+        return client
+
+    def _is_alive(self, client, now):
+        """
+        Check whether *client* may still be used. Connections which have not been created
+        by the pool are never reused.
+        """
+        created = getattr(client, 'pool_created', None)
+        return (created is not None
+                and client.connected
+                and not client.onwire
+                and now - created < self.max_lifetime)
+
+    def release(self, client):
+        """
+        Return a connection to the pool. The connection is reset using an anonymous bind first. If the reset
+        fails, or if the connection cannot be reused for some other reason, the connection is closed.
+        :param client: ``LDAPClient`` instance which was previously handed out by ``acquire``
+        :return: A Deferred that fires True if the connection has been added to the pool
+        """
+        if not self._is_alive(client, self.seconds()):
+            log.info('Not returning connection to LDAP backend to the pool')
+            self._discard(client)
+            return defer.succeed(False)
+        if len(self._idle) >= self.size:
+            log.info('Connection pool is full, closing connection to LDAP backend')
+            self._discard(client)
+            return defer.succeed(False)
+        d = defer.maybeDeferred(client.bind, '', '')
+        d.addCallbacks(self._reset_succeeded, self._reset_failed, (client,), None, (client,))
+        return d
+
+    def _reset_succeeded(self, result, client):
+        # The pool might have filled up in the meantime
+        if len(self._idle) >= self.size or not self._is_alive(client, self.seconds()):
+            self._discard(client)
+            return False
+        self._idle.append((client, self.seconds()))
+        self._schedule_eviction()
+        return True
+
+    def _reset_failed(self, failure, client):
+        log.warn('Could not reset connection to LDAP backend: {failure!r}', failure=failure.value)
+        self._discard(client)
+        return False
+
+    def _discard(self, client):
+        """
+        Close the connection *client*.
+        """
+        if client.connected:
+            client.unbind()
+
+    def _schedule_eviction(self):
+        """
+        Make sure that ``evict_idle`` is called once the oldest idle connection has exceeded ``idle_timeout``.
+        """
+        if self._eviction_call is None and self._idle:
+            oldest_release = min(released for client, released in self._idle)
+            delay = max(0, oldest_release + self.idle_timeout - self.seconds())
+            self._eviction_call = self.callLater(delay, self.evict_idle)
+
+    def evict_idle(self):
+        """
+        Close all idle connections that have been idle for ``idle_timeout`` seconds,
+        that have exceeded their lifetime or that have been closed by the LDAP backend.
+        """
+        self._eviction_call = None
+        now = self.seconds()
+        remaining = []
+        for client, released in self._idle:
+            if now - released < self.idle_timeout and self._is_alive(client, now):
+                remaining.append((client, released))
+            else:
+                self._discard(client)
+        if len(remaining) != len(self._idle):
+            log.info('Evicted {count!r} idle connections to LDAP backend ({remaining!r} remaining)',
+                     count=len(self._idle) - len(remaining), remaining=len(remaining))
+        self._idle = remaining
+        self._schedule_eviction()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        if self._eviction_call is not None and self._eviction_call.active():
+            self._eviction_call.cancel()
+        self._eviction_call = None
+        idle, self._idle = self._idle, []
+        for client, released in idle:
+            self._discard(client)
+
+
+class SharedServiceAccountConnections(object):
+    """
+    A fixed number of persistent connections to the LDAP backend, bound as the service account.
+    Once a client session has been authenticated and ``bind-service-account`` is set, the session
+    does not need a connection of its own: All such sessions are equivalent from the backend's
+    point of view, so their requests can be multiplexed over a few shared connections.
+
+    ``LDAPClient`` assigns a fresh message ID to every request sent over a shared connection and
+    dispatches the responses to the handler registered for that message ID. The handler in turn
+    replies to the client using the client's original message ID, so message IDs are effectively
+    rewritten in both directions.
+    """
+    def __init__(self, connector, count):
+        """
+        :param connector: A callable which returns a Deferred firing a ``LDAPClient`` instance
+            that is bound as the service account
+        :param count: Number of shared connections
+        """
+        self.connector = connector
+        self.count = count
+        #: For each slot, the connected ``LDAPClient`` or None
+        self._clients = [None] * count
+        #: For each slot, None or a list of Deferreds waiting for the connection to be established
+        self._waiters = [None] * count
+        #: Index of the slot which is used next
+        self._next = 0
+
+    @property
+    def connected_count(self):
+        """ Number of established shared connections """
+        return sum(1 for client in self._clients if client is not None and client.connected)
+
+    def get_connection(self):
+        """
+        Return one of the shared connections in a round-robin fashion. If the connection has not been
+        established yet or has been lost, (re-)connect first.
+        :return: A Deferred that fires a ``LDAPClient`` instance
+        """
+        index = self._next
+        self._next = (self._next + 1) % self.count
+        client = self._clients[index]
+        if client is not None and client.connected:
+            return defer.succeed(client)
+        self._clients[index] = None
+        d = defer.Deferred()
+        if self._waiters[index] is None:
+            log.info('Establishing shared connection #{index!r} to the LDAP backend', index=index)
+            self._waiters[index] = [d]
+            connect_d = self.connector()
+            connect_d.addBoth(self._connected, index)
+        else:
+            self._waiters[index].append(d)
+        return d
+
+    def connect_all(self):
+        """
+        Establish all shared connections, e.g. on startup.
+        :return: A Deferred that fires once all connections have been established
+        """
+        return defer.gatherResults([self.get_connection() for _ in range(self.count)], consumeErrors=True)
+
+    def _connected(self, result, index):
+        waiters, self._waiters[index] = self._waiters[index], None
+        if isinstance(result, failure.Failure):
+            log.warn('Could not establish shared connection #{index!r} to the LDAP backend: {failure!r}',
+                     index=index, failure=result.value)
+            for waiter in waiters:
+                waiter.errback(result)
+        else:
+            self._clients[index] = result
+            for waiter in waiters:
+                waiter.callback(result)
+
+    def close(self):
+        """
+        Unbind and close all shared connections.
+        """
+        for index, client in enumerate(self._clients):
+            if client is not None and client.connected:
+                client.unbind()
+            self._clients[index] = None
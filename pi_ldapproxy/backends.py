@@ -0,0 +1,214 @@
+from ldaptor.protocols.ldap.ldapconnector import connectToLDAPEndpoint
+from twisted.internet import defer, reactor
+
+from pi_ldapproxy.logs import GatedLogger
+from pi_ldapproxy.rawforward import RawForwardingLDAPClient
+
+log = GatedLogger()
+
+
+class BackendLDAPClient(RawForwardingLDAPClient):
+    """
+    ``LDAPClient`` which keeps track of the number of active connections to its LDAP backend.
+    """
+    def __init__(self, backend):
+        RawForwardingLDAPClient.__init__(self)
+        self.backend = backend
+
+    def connectionMade(self):
+        RawForwardingLDAPClient.connectionMade(self)
+        self.backend.active_connections += 1
+
+    def connectionLost(self, reason=None):
+        RawForwardingLDAPClient.connectionLost(self, reason)
+        self.backend.active_connections -= 1
+
+
+class Backend(object):
+    """
+    A single LDAP backend server, along with some statistics.
+    """
+    def __init__(self, endpoint):
+        """
+        :param endpoint: Twisted client endpoint string
+        """
+        self.endpoint = endpoint
+        #: Number of currently open connections
+        self.active_connections = 0
+        #: Total number of connection attempts
+        self.connection_attempts = 0
+        #: Total number of failed connection attempts
+        self.connection_failures = 0
+        #: Number of times the backend has been ejected
+        self.ejections = 0
+        #: Timestamp until which the backend is ejected, i.e. not used for new connections
+        self.ejected_until = 0
+        #: Result of the last health check (True or False), or None if there was none
+        self.healthy = None
+
+    def statistics(self):
+        """
+        :return: a dictionary of statistics
+        """
+        return {
+            'endpoint': self.endpoint,
+            'active-connections': self.active_connections,
+            'connection-attempts': self.connection_attempts,
+            'connection-failures': self.connection_failures,
+            'ejections': self.ejections,
+            'healthy': self.healthy,
+        }
+
+
+class BackendSet(object):
+    """
+    A set of equivalent LDAP backend servers. New connections are distributed among the backends
+    according to a balancing strategy:
+
+     * ``round-robin``: Use the backends in turn
+     * ``least-connections``: Use the backend with the smallest number of open connections
+
+    If a connection attempt fails (e.g. because it is refused or times out), the backend is ejected
+    for ``ejection_time`` seconds and the next backend is tried. Optionally, all backends are
+    checked periodically using a health check, which ejects unhealthy backends and reinstates
+    healthy ones. If all backends are ejected, all of them are tried anyway.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = reactor.seconds
+
+    def __init__(self, endpoints, balancing='round-robin', ejection_time=30):
+        """
+        :param endpoints: list of Twisted client endpoint strings
+        :param balancing: ``round-robin`` or ``least-connections``
+        :param ejection_time: Number of seconds for which a failing backend is not used
+        """
+        if not endpoints:
+            raise ValueError('At least one LDAP backend is required')
+        self.backends = [Backend(endpoint) for endpoint in endpoints]
+        self.balancing = balancing
+        self.ejection_time = ejection_time
+        #: Index of the backend which is tried first by the next connection (for ``round-robin``)
+        self._next = 0
+        #: DelayedCall of the next health check, or None
+        self._health_check_call = None
+
+    def _candidates(self):
+        """
+        :return: a list of backends in the order in which they should be tried
+        """
+        now = self.seconds()
+        available = [backend for backend in self.backends if backend.ejected_until <= now]
+        if not available:
+            log.warn('All LDAP backends are ejected, trying all of them')
+            available = list(self.backends)
+        # Rotate the list, which also breaks ties for ``least-connections``
+        start = self._next % len(available)
+        self._next += 1
+        available = available[start:] + available[:start]
+        if self.balancing == 'least-connections':
+            available.sort(key=lambda backend: backend.active_connections)
+        return available
+
+    @defer.inlineCallbacks
+    def connect(self):
+        """
+        Connect to one of the backends. If connecting fails, eject the backend and try the next one.
+        :return: A Deferred that fires a ``BackendLDAPClient`` instance or fails with the last error
+        """
+        candidates = self._candidates()
+        for index, backend in enumerate(candidates):
+            try:
+                client = yield self.connect_to(backend)
+            except defer.CancelledError:
+                # The connection attempt has been abandoned, which says nothing about the backend
+                raise
+            except Exception as e:
+                self.eject(backend, e)
+                if index == len(candidates) - 1:
+                    raise
+            else:
+                defer.returnValue(client)
+
+    def connect_to(self, backend):
+        """
+        Connect to a specific backend.
+        :param backend: ``Backend`` instance
+        :return: A Deferred that fires a ``BackendLDAPClient`` instance
+        """
+        backend.connection_attempts += 1
+        d = self._dial(backend)
+        d.addErrback(self._count_failure, backend)
+        return d
+
+    def _dial(self, backend):
+        return connectToLDAPEndpoint(reactor, backend.endpoint, lambda: BackendLDAPClient(backend))
+
+    def _count_failure(self, failure, backend):
+        if not failure.check(defer.CancelledError):
+            backend.connection_failures += 1
+        return failure
+
+    def eject(self, backend, reason):
+        """
+        Do not use *backend* for new connections for ``ejection_time`` seconds.
+        """
+        log.warn('Ejecting LDAP backend {endpoint!r} for {time!r} seconds: {reason!r}',
+                 endpoint=backend.endpoint, time=self.ejection_time, reason=reason)
+        backend.ejected_until = self.seconds() + self.ejection_time
+        backend.ejections += 1
+
+    def reinstate(self, backend):
+        """
+        Use *backend* for new connections again.
+        """
+        if backend.ejected_until > self.seconds():
+            log.info('Reinstating LDAP backend {endpoint!r}', endpoint=backend.endpoint)
+        backend.ejected_until = 0
+
+    def start_health_checks(self, check, interval):
+        """
+        Periodically check the health of all backends.
+        :param check: A callable which accepts a ``Backend`` and returns a Deferred firing True or False
+        :param interval: Number of seconds between two health checks
+        """
+        self._health_check_call = self.callLater(interval, self.check_health, check, interval)
+
+    def stop_health_checks(self):
+        if self._health_check_call is not None and self._health_check_call.active():
+            self._health_check_call.cancel()
+        self._health_check_call = None
+
+    def check_health(self, check, interval=None):
+        """
+        Check the health of all backends, eject unhealthy and reinstate healthy backends.
+        If *interval* is given, schedule the next health check afterwards.
+        :return: A Deferred that fires once all backends have been checked
+        """
+        deferreds = []
+        for backend in self.backends:
+            d = check(backend)
+            d.addCallback(self._checked, backend)
+            deferreds.append(d)
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(self._log_statistics)
+        if interval is not None:
+            d.addBoth(lambda result: self.start_health_checks(check, interval))
+        return d
+
+    def _checked(self, healthy, backend):
+        backend.healthy = healthy
+        if healthy:
+            self.reinstate(backend)
+        elif backend.ejected_until <= self.seconds():
+            self.eject(backend, 'health check failed')
+
+    def _log_statistics(self, result):
+        for backend in self.backends:
+            log.info('LDAP backend statistics: {statistics!r}', statistics=backend.statistics())
+
+    def statistics(self):
+        """
+        :return: a list of dictionaries containing statistics, one for each backend
+        """
+        return [backend.statistics() for backend in self.backends]
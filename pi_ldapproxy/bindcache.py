@@ -1,7 +1,8 @@
 from twisted.internet import reactor
-from twisted.logger import Logger
 
-log = Logger()
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
 
 class BindCache(object):
     """
@@ -26,7 +27,10 @@ class BindCache(object):
         #: Map of tuples (dn, app_marker, password) to insertion timestamps (determined using ``reactor.seconds``)
         self._cache = {}
 
-    def add_to_cache(self, dn, app_marker, password):
+    def __len__(self):
+        return len(self._cache)
+
+    def add_to_cache(self, dn, app_marker, password, age=0):
         """
         Add the credentials to the bind cache. They are automatically removed from the cache after ``self.timeout``
         seconds using the ``reactor.callLater`` mechanism.
@@ -34,17 +38,22 @@ class BindCache(object):
         :param dn: user distinguished name
         :param app_marker: app marker
         :param password: user password
+        :param age: number of seconds since the credentials have been added to another bind cache
+        (see ``entries``). This is subtracted from the timeout.
         """
         item = (dn, app_marker, password)
-        if item not in self._cache:
-            current_time = reactor.seconds()
-            log.info('Adding to bind cache: dn={dn!r}, marker={marker!r}, time={time!r}',
-                     dn=dn, marker=app_marker, time=current_time)
+        if age >= self.timeout:
+            log.info('Not adding expired entry to bind cache: dn={dn!r}, marker={marker!r}',
+                     dn=dn, marker=app_marker)
+        elif item not in self._cache:
+            current_time = reactor.seconds() - age
+            log.sampled_info('Adding to bind cache: dn={dn!r}, marker={marker!r}, time={time!r}',
+                             dn=dn, marker=app_marker, time=current_time)
             self._cache[item] = current_time
-            self.callLater(self.timeout, self.remove_from_cache, dn, app_marker, password)
+            self.callLater(self.timeout - age, self.remove_from_cache, dn, app_marker, password)
         else:
-            log.info('Already in the bind cache: dn={dn!r}, marker={marker!r}',
-                     dn=dn, marker=app_marker)
+            log.sampled_info('Already in the bind cache: dn={dn!r}, marker={marker!r}',
+                             dn=dn, marker=app_marker)
 
     def remove_from_cache(self, dn, app_marker, password):
         """
@@ -57,11 +66,20 @@ class BindCache(object):
         item = (dn, app_marker, password)
         if item in self._cache:
             del self._cache[item]
-            log.info('Removed from bind cache: dn={dn!r}/marker={marker!r} ({remaining!r} remaining)',
-                     dn=dn, marker=app_marker, remaining=len(self._cache))
+            log.sampled_info('Removed from bind cache: dn={dn!r}/marker={marker!r} ({remaining!r} remaining)',
+                             dn=dn, marker=app_marker, remaining=len(self._cache))
         else:
             log.info("Removal from bind cache failed as dn={dn!r} is not cached", dn=dn)
 
+    def entries(self):
+        """
+        Return all cached credentials, e.g. to hand them over to another process.
+        :return: a list of tuples ``(dn, app_marker, password, age)``, where *age* is the number of seconds
+        since the credentials have been added
+        """
+        current_time = reactor.seconds()
+        return [item + (current_time - inserted_time,) for item, inserted_time in self._cache.items()]
+
     def is_cached(self, dn, app_marker, password):
         """
         Determines whether the given credentials are found in the bind cache.
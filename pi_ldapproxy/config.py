@@ -9,25 +9,119 @@ CONFIG_SPEC = """
 instance = string
 certificate = string(default='')
 verify = boolean(default=True)
+keep-alive-connections = integer(min=0, default=0)
+keep-alive-timeout = integer(min=1, default=4)
 
 [ldap-backend]
-endpoint = string
+endpoint = force_list
+balancing = option('round-robin', 'least-connections', default='round-robin')
+ejection-time = integer(min=1, default=30)
+health-check-interval = integer(min=0, default=0)
 use-tls = boolean(default=False)
 test-connection = boolean(default=True)
+lazy-connect = boolean(default=False)
+max-pending-requests = integer(min=1, default=32)
+pool-size = integer(min=0, default=0)
+pool-max-lifetime = integer(min=1, default=300)
+pool-idle-timeout = integer(min=1, default=60)
+flow-control = boolean(default=True)
+paged-search-size = integer(min=0, default=0)
 
 [ldap-proxy]
 endpoint = string
 passthrough-binds = force_list
 bind-service-account = boolean(default=False)
+multiplex-service-account = boolean(default=False)
+multiplex-connections = integer(min=1, default=4)
 allow-search = boolean(default=False)
 allow-connection-reuse = boolean(default=False)
 ignore-search-result-references = boolean(default=False)
 forward-anonymous-binds = boolean(default=False)
+raw-forwarding = boolean(default=False)
+
+[limits]
+max-connections = integer(min=0, default=0)
+max-connections-per-ip = integer(min=0, default=0)
+idle-timeout = integer(min=0, default=0)
+bind-timeout = integer(min=0, default=0)
+max-session-lifetime = integer(min=0, default=0)
+
+[workers]
+count = integer(min=0, default=0)
+restart-delay = integer(min=0, default=1)
+heartbeat-interval = integer(min=1, default=5)
+heartbeat-timeout = integer(min=1, default=30)
+share-caches = boolean(default=True)
+
+[metrics]
+endpoint = string(default='')
+
+[health]
+endpoint = string(default='')
+max-privacyidea-failures = integer(min=0, default=0)
+
+[tracing]
+enabled = boolean(default=False)
+sample-rate = float(min=0, max=1, default=0.01)
+exporter = option('collector', 'file', default='collector')
+collector = string(default='http://127.0.0.1:4318/v1/traces')
+file = string(default='')
+export-interval = integer(min=1, default=5)
+max-queue-size = integer(min=1, default=2048)
+service-name = string(default='privacyidea-ldap-proxy')
+
+[slow-log]
+threshold = integer(min=0, default=0)
+file = string(default='')
+
+[logging]
+level = option('debug', 'info', 'warn', 'error', 'critical', default='info')
+info-sample-rate = float(min=0, max=1, default=1)
+file = string(default='')
+buffer-size = integer(min=2, default=10000)
+flush-interval = integer(min=1, default=1)
+[[levels]]
+__many__ = option('debug', 'info', 'warn', 'error', 'critical')
+
+[load-shedding]
+check-interval = integer(min=10, default=100)
+reject-connections = integer(min=0, default=0)
+reject-binds = integer(min=0, default=0)
+
+[scheduling]
+max-concurrent = integer(min=0, default=0)
+max-queued = integer(min=0, default=1000)
+
+[profiling]
+mode = option('sampling', 'cprofile', default='sampling')
+duration = integer(min=1, default=30)
+directory = string(default='')
+sample-interval = integer(min=1, default=5)
+
+[startup]
+timeout = integer(min=0, default=10)
+fill-pool = boolean(default=True)
+
+[timeouts]
+backend-connect = integer(min=0, default=10)
+user-lookup = integer(min=0, default=10)
+privacyidea = integer(min=0, default=30)
+service-account-bind = integer(min=0, default=10)
+unbind = integer(min=0, default=5)
+drain = integer(min=0, default=10)
 
 [service-account]
 dn = string
 password = string
 
+[routes]
+[[__many__]]
+suffix = string
+endpoint = force_list
+balancing = option('round-robin', 'least-connections', default='round-robin')
+service-account-dn = string(default='')
+service-account-password = string(default='')
+
 [bind-cache]
 enabled = boolean
 timeout = integer(default=3)
@@ -38,6 +132,12 @@ timeout = integer(default=3)
 attribute = string(default='objectclass')
 value-prefix = string(default='App-')
 case-insensitive = boolean(default=False)
+strip-marker = boolean(default=False)
+
+[search-cache]
+enabled = boolean(default=False)
+timeout = integer(min=1, default=30)
+max-size = integer(min=1, default=10485760)
 
 [user-mapping]
 strategy = string
@@ -46,12 +146,22 @@ strategy = string
 strategy = string
 """
 
-def report_config_errors(config, result):
+class ConfigError(Exception):
     """
-    Interpret configobj results and report configuration errors to the user.
+    Raised if a configuration file cannot be read or is invalid. ``errors`` is a list of error messages.
+    """
+    def __init__(self, errors):
+        Exception.__init__(self, '; '.join(errors))
+        self.errors = errors
+
+
+def format_config_errors(config, result):
+    """
+    Interpret configobj results.
+    :return: a list of error messages
     """
+    errors = []
     # from http://www.voidspace.org.uk/python/configobj.html#example-usage
-    print('Invalid config file:')
     for entry in configobj.flatten_errors(config, result):
         # each entry is a tuple
         section_list, key, error = entry
@@ -62,23 +172,51 @@ def report_config_errors(config, result):
         section_string = ', '.join(section_list)
         if error == False:
             error = 'Invalid value (or section).'
-        print('{}: {}'.format(section_string, error))
+        errors.append('{}: {}'.format(section_string, error))
+    return errors
 
 
-def load_config(filename):
+def report_config_errors(config, result):
+    """
+    Interpret configobj results and report configuration errors to the user.
+    """
+    print('Invalid config file:')
+    for error in format_config_errors(config, result):
+        print(error)
+
+
+def read_config(filename):
     """
     Load, validate and return the configuration file stored at *filename*.
-    In case the configuration is invalid, report the error to the user
-    and exit with return code 1.
     :param filename: config filename as a string
     :return: a dictionary
+    :raises ConfigError: if the file cannot be read or the configuration is invalid
     """
-    with open(filename, 'r') as f:
-        config = configobj.ConfigObj(f, configspec=CONFIG_SPEC.splitlines())
+    try:
+        with open(filename, 'r') as f:
+            config = configobj.ConfigObj(f, configspec=CONFIG_SPEC.splitlines())
+    except (IOError, configobj.ConfigObjError) as e:
+        raise ConfigError([str(e)])
 
     validator = validate.Validator()
     result = config.validate(validator, preserve_errors=True)
     if result != True:
-        report_config_errors(config, result)
+        raise ConfigError(format_config_errors(config, result))
+    return config
+
+
+def load_config(filename):
+    """
+    Load, validate and return the configuration file stored at *filename*.
+    In case the configuration is invalid, report the error to the user
+    and exit with return code 1.
+    :param filename: config filename as a string
+    :return: a dictionary
+    """
+    try:
+        return read_config(filename)
+    except ConfigError as e:
+        print('Invalid config file:')
+        for error in e.errors:
+            print(error)
         sys.exit(1)
-    return config
\ No newline at end of file
@@ -0,0 +1,67 @@
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised if a phase of processing a request has not completed within its deadline.
+    """
+    pass
+
+
+def with_deadline(d, timeout, phase, callLater):
+    """
+    Cancel the Deferred *d* if it has not fired after *timeout* seconds. In that case, *d* fails
+    with ``DeadlineExceeded`` instead of ``CancelledError``.
+    :param d: a Deferred which supports cancellation
+    :param timeout: number of seconds, or 0 to disable the deadline
+    :param phase: name of the phase, which is used in the error message
+    :param callLater: ``reactor.callLater`` or a replacement (e.g. in tests)
+    :return: *d*
+    """
+    if not timeout or d.called:
+        return d
+    expired = []
+
+    def expire():
+        log.warn('{phase} did not complete within {timeout!r} seconds, cancelling ...',
+                 phase=phase, timeout=timeout)
+        expired.append(True)
+        d.cancel()
+
+    delayed_call = callLater(timeout, expire)
+
+    def finish(result):
+        if delayed_call.active():
+            delayed_call.cancel()
+        elif expired and isinstance(result, Failure) and result.check(defer.CancelledError):
+            raise DeadlineExceeded('{} did not complete within {} seconds'.format(phase, timeout))
+        return result
+    d.addBoth(finish)
+    return d
+
+
+def unbind_with_deadline(client, timeout, callLater):
+    """
+    Send an Unbind Request to the LDAP backend and close the connection *client*. If the connection
+    has not been closed after *timeout* seconds (e.g. because the LDAP backend does not read from it),
+    abort it. Connections which have been lost already are ignored.
+    :param client: ``LDAPClient`` instance
+    :param timeout: number of seconds, or 0 to wait for the connection to be closed indefinitely
+    :param callLater: ``reactor.callLater`` or a replacement (e.g. in tests)
+    """
+    if not client.connected:
+        return
+    client.unbind()
+    if timeout and client.connected:
+        callLater(timeout, _abort_connection, client)
+
+
+def _abort_connection(client):
+    if client.connected:
+        log.warn('Connection to LDAP backend has not been closed after unbind, aborting ...')
+        client.transport.abortConnection()
@@ -0,0 +1,78 @@
+from ldaptor.protocols import pureber
+from six import ensure_str
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+#: OID of the Simple Paged Results Control (RFC 2696)
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+
+@implementer(IPushProducer)
+class BackendReadThrottle(object):
+    """
+    Push producer which is registered with the transport of the client connection. Once the write buffer
+    of the client connection is full, Twisted pauses the producer, which in turn stops reading from the
+    connection to the LDAP backend. Thus, responses of the LDAP backend are not buffered in memory if the
+    client cannot keep up with them.
+    As opposed to registering the transport of the LDAP backend connection directly, stopping the producer
+    (which happens once the client has disconnected) does not close the connection to the LDAP backend,
+    which might be returned to the connection pool.
+    """
+    def __init__(self, transport):
+        """
+        :param transport: Transport of the connection to the LDAP backend
+        """
+        self.transport = transport
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        if self.paused:
+            self.resumeProducing()
+
+
+def can_throttle(transport):
+    """
+    :return: whether reading from *transport* can be paused
+    """
+    return IPushProducer.providedBy(transport)
+
+
+def paged_results_control(size, cookie=b''):
+    """
+    Build a Simple Paged Results Control.
+    :param size: page size
+    :param cookie: cookie as returned by the server, or the empty string for the first page
+    :return: a tuple ``(controlType, criticality, controlValue)``
+    """
+    value = pureber.BERSequence([pureber.BERInteger(size), pureber.BEROctetString(cookie)]).toWire()
+    return (PAGED_RESULTS_OID, False, value)
+
+
+def has_paged_results_control(controls):
+    """
+    :param controls: list of tuples ``(controlType, criticality, controlValue)`` or None
+    :return: whether *controls* contains a Simple Paged Results Control
+    """
+    return any(ensure_str(control[0]) == PAGED_RESULTS_OID for control in controls or ())
+
+
+def paged_results_cookie(controls):
+    """
+    Extract the cookie of the Simple Paged Results Control in *controls*.
+    :param controls: list of tuples ``(controlType, criticality, controlValue)`` or None
+    :return: the cookie as bytes, or the empty string if there is no control or no cookie,
+    i.e. if there are no more pages
+    """
+    for control_type, criticality, value in controls or ():
+        if ensure_str(control_type) == PAGED_RESULTS_OID and value:
+            sequence, length = pureber.berDecodeObject(pureber.BERDecoderContext(), value)
+            return sequence.data[1].value
+    return b''
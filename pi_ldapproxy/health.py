@@ -0,0 +1,150 @@
+"""
+Health and readiness checks for load balancers.
+
+Health checks which open LDAP connections to the proxy cause connections to the LDAP backend (or, with
+``lazy-connect``, at least client sessions) for every probe. If ``[health] endpoint`` is set, the proxy serves
+its health via HTTP instead, and answers probes from the state it keeps anyway, i.e. without any requests
+to the LDAP backends or privacyIDEA:
+
+ * ``/live`` answers ``200`` as long as the reactor is able to serve requests.
+ * ``/ready`` (and every other path) answers ``200`` if the proxy is ready to process requests, and
+   ``503`` otherwise. The proxy is not ready while it warms up its connections on startup (see ``startup``),
+   while it is draining its sessions on shutdown, while every LDAP backend of a route is ejected or has
+   failed its last health check (see ``backends.BackendSet``), while the last ``max-privacyidea-failures``
+   requests to privacyIDEA have failed, and while the proxy sheds load because the reactor lags behind
+   (see ``loadshedding``).
+
+The body is a JSON object with the results of the individual checks.
+"""
+import json
+
+from twisted.application import internet
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import serverFromString
+from twisted.python.failure import Failure
+from twisted.web import resource, server
+
+from pi_ldapproxy.loadshedding import LEVEL_NORMAL
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+CONTENT_TYPE = b'application/json'
+
+
+class PrivacyIDEAState(object):
+    """
+    Keeps track of the outcomes of the recent requests to privacyIDEA.
+    """
+    def __init__(self):
+        #: Number of requests which have failed since the last successful request
+        self.consecutive_failures = 0
+
+    def observe(self, result):
+        """
+        Record the outcome of a privacyIDEA request. This is added as a callback and errback to the request.
+        :param result: a tuple ``(response, body)`` or a ``Failure``, which is passed on
+        """
+        if isinstance(result, Failure):
+            # If the client has disconnected, the request has been cancelled, which says nothing about privacyIDEA
+            failed = not result.check(defer.CancelledError)
+        else:
+            failed = result[0].code != 200
+        if failed:
+            if not self.consecutive_failures:
+                log.warn('Request to privacyIDEA has failed')
+            self.consecutive_failures += 1
+        else:
+            if self.consecutive_failures:
+                log.info('privacyIDEA has recovered after {count!r} failed requests', count=self.consecutive_failures)
+            self.consecutive_failures = 0
+        return result
+
+
+class HealthCheck(object):
+    """
+    Determines the liveness and readiness of the proxy from the state of a ``ProxyServerFactory``.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        #: Outcomes of the requests to privacyIDEA
+        self.privacyidea = PrivacyIDEAState()
+        self.configure()
+
+    def configure(self, max_privacyidea_failures=0):
+        """
+        Change the settings, e.g. after the configuration has been reloaded.
+        :param max_privacyidea_failures: number of consecutive failed privacyIDEA requests after which
+        the proxy is not ready anymore, or 0 to ignore privacyIDEA
+        """
+        self.max_privacyidea_failures = max_privacyidea_failures
+
+    def readiness(self):
+        """
+        :return: a tuple ``(ready, checks)``, whereas *checks* is a dictionary of the results of the
+        individual checks
+        """
+        factory = self.factory
+        routes = {}
+        for route in factory.routes:
+            now = route.backends.seconds()
+            available = [backend for backend in route.backends.backends
+                         if backend.ejected_until <= now and backend.healthy is not False]
+            routes[route.name] = {'available': len(available), 'total': len(route.backends.backends)}
+        failures = self.privacyidea.consecutive_failures
+        lag_monitor = factory.lag_monitor
+        checks = {
+            'draining': {'ok': factory.session_limits.drain_deadline is None},
+            'startup': {'ok': not factory.warmup.running},
+            'ldap-backends': {'ok': all(route['available'] for route in routes.values()), 'routes': routes},
+            'privacyidea': {'ok': not self.max_privacyidea_failures or failures < self.max_privacyidea_failures,
+                            'consecutive-failures': failures},
+            'reactor-lag': {'ok': lag_monitor.level == LEVEL_NORMAL, 'lag': lag_monitor.smoothed_lag},
+        }
+        return all(check['ok'] for check in checks.values()), checks
+
+
+class HealthResource(resource.Resource):
+    """
+    Serves ``/live`` and ``/ready`` (on every other path) of a ``HealthCheck``.
+    """
+    isLeaf = True
+
+    def __init__(self, health):
+        resource.Resource.__init__(self)
+        self.health = health
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', CONTENT_TYPE)
+        request.setHeader(b'Cache-Control', b'no-store')
+        if request.postpath == [b'live']:
+            body = {'status': 'ok'}
+        else:
+            ready, checks = self.health.readiness()
+            if not ready:
+                request.setResponseCode(503)
+            body = {'status': 'ready' if ready else 'not ready', 'checks': checks}
+        return json.dumps(body, sort_keys=True).encode('utf-8')
+
+
+class HealthSite(server.Site):
+    """
+    Site of the health listener. Probes are not written to the log.
+    """
+    noisy = False
+
+    def log(self, request):
+        pass
+
+
+def health_service(health, endpoint_string, worker=None):
+    """
+    Build a service which serves *health* via HTTP. In worker mode, every worker serves its own health,
+    so the placeholder ``{worker}`` in the endpoint is replaced by the worker number (e.g. ``tcp:808{worker}``).
+    :param health: ``HealthCheck`` instance
+    :param endpoint_string: ``[health] endpoint``
+    :param worker: worker number, or None
+    :return: a ``StreamServerEndpointService``
+    """
+    endpoint = serverFromString(reactor, endpoint_string.replace('{worker}', str(worker or 0)))
+    return internet.StreamServerEndpointService(endpoint, HealthSite(HealthResource(health)))
@@ -0,0 +1,108 @@
+"""
+Load shedding based on the lag of the reactor.
+
+If the CPU is saturated, the reactor falls behind: Timers fire late and incoming data is processed late, so
+clients time out and retry, which increases the load even further. ``LagMonitor`` measures how late a periodic
+timer fires (the "lag" of the reactor) and sheds load progressively once the smoothed lag crosses the configured
+thresholds:
+
+ 1. At ``reject_connections``, new client connections are refused (see ``ProxyServerFactory.buildProtocol``).
+ 2. At ``reject_binds``, bind requests which would be validated by privacyIDEA are additionally answered
+    with ``busy``. Passthrough binds, searches of authenticated sessions and the service account are not
+    affected, so that sessions which are already established continue to work.
+
+Load is shed as long as the smoothed lag is above the threshold.
+"""
+from twisted.internet import reactor
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+#: Load shedding levels
+LEVEL_NORMAL = 0
+LEVEL_REJECT_CONNECTIONS = 1
+LEVEL_REJECT_BINDS = 2
+
+#: Weight of a new measurement in the smoothed lag
+SMOOTHING = 0.25
+
+
+class LagMonitor(object):
+    """
+    Measures the lag of the reactor by the drift of a timer which is scheduled every ``interval`` seconds,
+    and determines the load shedding level. Load shedding is disabled as long as the thresholds are 0.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = reactor.seconds
+
+    def __init__(self):
+        #: Most recently measured lag in seconds
+        self.lag = 0.0
+        #: Exponentially smoothed lag in seconds
+        self.smoothed_lag = 0.0
+        #: Current load shedding level (one of the ``LEVEL_*`` constants)
+        self.level = LEVEL_NORMAL
+        #: Number of client connections which have been refused because of the lag
+        self.rejected_connections = 0
+        self._call = None
+        self._expected = None
+        self.configure()
+
+    def configure(self, interval=0.1, reject_connections=0, reject_binds=0):
+        """
+        Change the settings, e.g. after the configuration has been reloaded.
+        :param interval: number of seconds between two measurements
+        :param reject_connections: lag in seconds from which new connections are refused, or 0
+        :param reject_binds: lag in seconds from which binds are rejected, or 0
+        """
+        self.interval = interval
+        self.thresholds = ((LEVEL_REJECT_BINDS, reject_binds), (LEVEL_REJECT_CONNECTIONS, reject_connections))
+        self._update_level()
+
+    def start(self):
+        if self._call is None:
+            self._schedule()
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self.lag = self.smoothed_lag = 0.0
+        self._update_level()
+
+    def _schedule(self):
+        self._expected = self.seconds() + self.interval
+        self._call = self.callLater(self.interval, self._measure)
+
+    def _measure(self):
+        self.lag = max(0.0, self.seconds() - self._expected)
+        self.smoothed_lag += SMOOTHING * (self.lag - self.smoothed_lag)
+        self._update_level()
+        self._schedule()
+
+    def _update_level(self):
+        level = LEVEL_NORMAL
+        for candidate, threshold in self.thresholds:
+            if threshold and self.smoothed_lag >= threshold:
+                level = candidate
+                break
+        if level != self.level:
+            if level > self.level:
+                log.warn('Reactor lag is {lag:.3f}s, shedding load (level {shed_level!r})',
+                         lag=self.smoothed_lag, shed_level=level)
+            else:
+                log.warn('Reactor lag is {lag:.3f}s, reducing load shedding (level {shed_level!r})',
+                         lag=self.smoothed_lag, shed_level=level)
+            self.level = level
+
+    @property
+    def reject_connections(self):
+        """ Whether new client connections are refused """
+        return self.level >= LEVEL_REJECT_CONNECTIONS
+
+    @property
+    def reject_binds(self):
+        """ Whether binds which would be validated by privacyIDEA are rejected """
+        return self.level >= LEVEL_REJECT_BINDS
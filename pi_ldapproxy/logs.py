@@ -0,0 +1,247 @@
+"""
+Low-overhead logging for the hot path.
+
+Every bind causes several log events (the bind request, the realm and user resolution, the bind cache and the
+response). Building a Twisted log event and passing it to the observers, which format it, takes a noticeable
+share of CPU time at thousands of binds per second. Therefore, the modules of the proxy log via a
+``GatedLogger``, which checks the minimum level configured for its namespace before an event is built
+(see ``configure``), e.g. to log the bind cache only at ``warn`` level. Informational events which occur for every
+operation are logged via ``GatedLogger.sampled_info``, so that only a fraction of them is emitted.
+
+Optionally, events are written as JSON lines by a ``JSONLogWriter``: It collects events in a bounded ring buffer
+and writes them to a file in batches, in a thread, so that the reactor never waits for the disk. If the buffer
+is full (e.g. because the disk is slow), the oldest events are dropped.
+"""
+import time
+from collections import deque
+
+from twisted.application import service
+from twisted.internet import defer, reactor, threads
+from twisted.logger import ILogObserver, LogLevel, LogLevelFilterPredicate, Logger, eventAsJSON, globalLogPublisher
+from zope.interface import implementer
+
+
+class LogSettings(object):
+    """
+    Log levels and sampling of ``GatedLogger`` instances. There is one instance per process, ``settings``.
+    """
+    def __init__(self):
+        self._levels = LogLevelFilterPredicate()
+        #: Map of namespaces to their minimum level, filled on demand
+        self._thresholds = {}
+        #: Fraction of the events logged via ``GatedLogger.sampled_info`` which are emitted
+        self.info_sample_rate = 1
+
+    def configure(self, level=LogLevel.info, levels=None, info_sample_rate=1):
+        """
+        Change the settings, e.g. after the configuration has been reloaded.
+        :param level: default minimum level as ``LogLevel`` constant
+        :param levels: dictionary mapping namespaces (e.g. ``pi_ldapproxy.bindcache``) to their minimum levels,
+        which also apply to the namespaces below them, or None
+        :param info_sample_rate: fraction of the events logged via ``GatedLogger.sampled_info`` which are emitted
+        """
+        self._levels = LogLevelFilterPredicate(level)
+        for namespace, namespace_level in (levels or {}).items():
+            self._levels.setLogLevelForNamespace(namespace, namespace_level)
+        self._thresholds = {}
+        self.info_sample_rate = info_sample_rate
+
+    def threshold(self, namespace):
+        """
+        :return: the minimum level of events in *namespace*, as ``LogLevel`` constant
+        """
+        try:
+            return self._thresholds[namespace]
+        except KeyError:
+            threshold = self._thresholds[namespace] = self._levels.logLevelForNamespace(namespace)
+            return threshold
+
+
+#: The log settings of this process
+settings = LogSettings()
+
+
+def configure(config):
+    """
+    Apply the ``[logging]`` section *config* to ``settings``.
+    """
+    levels = dict((namespace, LogLevel.levelWithName(level)) for namespace, level in config['levels'].items())
+    settings.configure(LogLevel.levelWithName(config['level']), levels, config['info-sample-rate'])
+
+
+class GatedLogger(Logger):
+    """
+    ``Logger`` which drops events below the minimum level of its namespace (see ``LogSettings``)
+    before they are built.
+    """
+    #: Accumulated sampling rate of ``sampled_info``, an event is emitted whenever this reaches 1
+    _sample_credit = 0.0
+
+    def enabled(self, level):
+        """
+        :return: whether events of *level* are emitted, e.g. to skip computing expensive log fields
+        """
+        return level >= settings.threshold(self.namespace)
+
+    def emit(self, level, format=None, **kwargs):
+        if level >= settings.threshold(self.namespace):
+            Logger.emit(self, level, format, **kwargs)
+
+    def sampled_info(self, format=None, **kwargs):
+        """
+        Log an informational event which occurs for (almost) every operation, e.g. for every bind. Only
+        a fraction of these events (``LogSettings.info_sample_rate``) is emitted. Sampling is deterministic,
+        i.e. with a rate of 0.1, every tenth event is emitted.
+        """
+        if LogLevel.info < settings.threshold(self.namespace):
+            return
+        rate = settings.info_sample_rate
+        if rate < 1:
+            self._sample_credit += rate
+            if self._sample_credit < 1:
+                return
+            self._sample_credit -= 1
+        Logger.emit(self, LogLevel.info, format, **kwargs)
+
+
+@implementer(ILogObserver)
+class JSONLogWriter(service.Service):
+    """
+    Log observer which writes events as JSON lines to a file (see ``twisted.logger.eventAsJSON``). Events are
+    collected in a ring buffer of at most *buffer_size* events, and written every *flush_interval* seconds
+    (or earlier, once the buffer is half full). Files are written in a thread, and at most one batch is written
+    at a time. While it is running, the service observes the global log publisher.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = time.time
+
+    def __init__(self, filename, buffer_size=10000, flush_interval=1, publisher=globalLogPublisher):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.publisher = publisher
+        self._buffer = deque()
+        #: Number of events which have been dropped because the buffer was full
+        self.dropped = 0
+        #: Number of dropped events which have not been reported in the file yet
+        self._unreported_drops = 0
+        #: Deferred of the write in progress, or None
+        self._writing = None
+        #: DelayedCall of the next flush, or None
+        self._flush_call = None
+
+    def __call__(self, event):
+        if len(self._buffer) >= self.buffer_size:
+            self._buffer.popleft()
+            self.dropped += 1
+            self._unreported_drops += 1
+        self._buffer.append(event)
+        if len(self._buffer) == self.buffer_size // 2:
+            # Flush a half-full buffer right away
+            if self._flush_call is not None:
+                self._flush_call.cancel()
+                self._flush_call = None
+            self._schedule_flush(0)
+        else:
+            self._schedule_flush(self.flush_interval)
+
+    def _schedule_flush(self, delay):
+        if self._flush_call is None:
+            self._flush_call = self.callLater(delay, self.flush)
+
+    def encode_batch(self, events):
+        """
+        :return: the events as JSON lines (as bytes)
+        """
+        lines = [eventAsJSON(event) for event in events]
+        if self._unreported_drops:
+            lines.append(eventAsJSON({
+                'log_namespace': __name__,
+                'log_level': LogLevel.warn,
+                'log_format': 'Dropped {count!r} log events, as the log buffer was full',
+                'log_time': self.seconds(),
+                'count': self._unreported_drops,
+            }))
+            self._unreported_drops = 0
+        return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+    def _write(self, data):
+        with open(self.filename, 'ab') as f:
+            f.write(data)
+
+    def flush(self):
+        """
+        Write the buffered events, unless a write is already in progress.
+        :return: a Deferred which fires once the events have been written
+        """
+        self._flush_call = None
+        if self._writing is not None or not self._buffer:
+            return defer.succeed(None)
+        events = list(self._buffer)
+        self._buffer.clear()
+        self._writing = d = threads.deferToThread(self._write, self.encode_batch(events))
+        # The failure cannot be logged, as the event would end up in the buffer again
+        d.addErrback(lambda failure: None)
+        d.addBoth(self._write_done)
+        return d
+
+    def _write_done(self, _):
+        self._writing = None
+        if self._buffer:
+            self._schedule_flush(0 if len(self._buffer) >= self.buffer_size // 2 else self.flush_interval)
+
+    def startService(self):
+        service.Service.startService(self)
+        self.publisher.addObserver(self)
+
+    def stopService(self):
+        """
+        Stop observing and write all buffered events.
+        """
+        service.Service.stopService(self)
+        self.publisher.removeObserver(self)
+        return self._drain()
+
+    def _drain(self):
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        if self._writing is not None:
+            return self._writing.addCallback(lambda _: self._drain())
+        if not self._buffer:
+            return defer.succeed(None)
+        return self.flush().addCallback(lambda _: self._drain())
+
+
+class LoggedService(service.MultiService):
+    """
+    Runs *main_service* while *writer* (a ``JSONLogWriter``) writes the log. The writer is started first and
+    stopped only after *main_service* has stopped, so that it sees all events, e.g. of draining sessions.
+    """
+    def __init__(self, main_service, writer):
+        service.MultiService.__init__(self)
+        self.writer = writer
+        self.main_service = main_service
+        writer.setServiceParent(self)
+        main_service.setServiceParent(self)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        d = defer.maybeDeferred(self.main_service.stopService)
+        d.addBoth(lambda result: self.writer.stopService().addCallback(lambda _: result))
+        return d
+
+
+def json_log_service(config, worker=None):
+    """
+    Build the service which writes the JSON log configured in the ``[logging]`` section *config*. In worker mode,
+    every process writes its own file, so the placeholder ``{worker}`` in the filename is replaced by the worker
+    number (or ``supervisor``).
+    :param worker: worker number, ``'supervisor'``, or None
+    :return: a ``JSONLogWriter``, or None if no file is configured
+    """
+    if not config['file']:
+        return None
+    return JSONLogWriter(config['file'].replace('{worker}', str(worker or 0)), config['buffer-size'],
+                         config['flush-interval'])
@@ -0,0 +1,194 @@
+"""
+Metrics in the Prometheus text exposition format.
+
+The metrics are recorded on every bind, so recording is kept cheap: Histograms preallocate their buckets and
+counters are plain integers in preallocated dictionaries, so an observation only increments existing values.
+Gauges (e.g. the number of client connections or the size of the caches) are not recorded at all, but are
+evaluated by callbacks whenever the metrics are scraped.
+
+If ``[metrics] endpoint`` is set, the metrics are served via HTTP (see ``MetricsResource``).
+"""
+import time
+from bisect import bisect_left
+
+from twisted.application import internet
+from twisted.internet import reactor
+from twisted.internet.endpoints import serverFromString
+from twisted.web import resource, server
+
+#: Upper bounds of the buckets of latency histograms in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: Phases of ``TwoFactorAuthenticationProxy.authenticate_bind_request`` whose duration is measured
+BIND_PHASES = ('realm-resolution', 'user-resolution', 'bind-cache', 'privacyidea', 'service-account-bind')
+
+#: Outcomes of bind requests which are handled by the proxy (i.e. which are not passed through):
+#:  * ``success``: privacyIDEA (or the bind cache) has accepted the credentials
+#:  * ``invalid-credentials``: the user or realm could not be resolved or privacyIDEA has rejected the credentials
+#:  * ``rejected``: the bind has been rejected without contacting privacyIDEA (e.g. anonymous binds)
+#:  * ``error``: the authentication has failed because of an error (e.g. privacyIDEA is unreachable)
+#:  * ``cancelled``: the client has disconnected before the authentication has completed
+BIND_OUTCOMES = ('success', 'invalid-credentials', 'rejected', 'busy', 'error', 'cancelled')
+
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('\n', r'\n')
+                                                                   .replace('"', r'\"'))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets. ``counts[i]`` is the number of observations which are at most
+    ``buckets[i]`` (but greater than ``buckets[i - 1]``), the last element counts the remaining observations.
+    """
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: sorted tuple of upper bounds
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name, labels=()):
+        """
+        :return: a list of lines in the text exposition format
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', _format_value(bound)),)),
+                                                 cumulative))
+        lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), self.sum))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+        return lines
+
+
+class Metrics(object):
+    """
+    The metrics of one ``ProxyServerFactory``. The bind metrics are recorded by the proxy, all other metrics
+    are added using ``add_metric``.
+    """
+    # Durations are measured using a monotonic clock, which can be replaced in tests
+    seconds = time.monotonic
+
+    def __init__(self):
+        #: Map of phases (see ``BIND_PHASES``) to histograms of their duration
+        self.bind_phases = dict((phase, Histogram()) for phase in BIND_PHASES)
+        #: Map of outcomes (see ``BIND_OUTCOMES``) to the number of bind requests
+        self.bind_outcomes = dict((outcome, 0) for outcome in BIND_OUTCOMES)
+        #: Number of bind cache lookups, by result
+        self.bind_cache_lookups = {'hit': 0, 'miss': 0}
+        #: List of tuples ``(name, type, help, callback)`` of metrics which are evaluated on each scrape
+        self._callbacks = []
+
+    def lap(self, phase, started):
+        """
+        Record that the bind phase *phase* has ended now.
+        :param phase: one of ``BIND_PHASES``
+        :param started: timestamp (see ``seconds``) at which the phase has started
+        :return: the current timestamp, i.e. the start of the next phase
+        """
+        now = self.seconds()
+        self.bind_phases[phase].observe(now - started)
+        return now
+
+    def add_metric(self, name, kind, help, callback):
+        """
+        Add a metric whose value is determined by invoking *callback* whenever the metrics are rendered.
+        :param name: metric name
+        :param kind: ``gauge`` or ``counter``
+        :param help: description of the metric
+        :param callback: a callable which returns either a number or a list of tuples ``(labels, value)``,
+        where *labels* is a tuple of pairs ``(label name, label value)``
+        """
+        self._callbacks.append((name, kind, help, callback))
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format (as a string)
+        """
+        lines = ['# HELP ldapproxy_bind_phase_duration_seconds Duration of the phases of bind requests',
+                 '# TYPE ldapproxy_bind_phase_duration_seconds histogram']
+        for phase in BIND_PHASES:
+            lines.extend(self.bind_phases[phase].samples('ldapproxy_bind_phase_duration_seconds',
+                                                         (('phase', phase),)))
+        lines.extend(['# HELP ldapproxy_bind_requests_total Bind requests handled by the proxy, by outcome',
+                      '# TYPE ldapproxy_bind_requests_total counter'])
+        for outcome in BIND_OUTCOMES:
+            lines.append('ldapproxy_bind_requests_total{} {}'.format(_format_labels((('outcome', outcome),)),
+                                                                     self.bind_outcomes[outcome]))
+        lines.extend(['# HELP ldapproxy_bind_cache_lookups_total Bind cache lookups, by result',
+                      '# TYPE ldapproxy_bind_cache_lookups_total counter'])
+        for result in ('hit', 'miss'):
+            lines.append('ldapproxy_bind_cache_lookups_total{} {}'.format(_format_labels((('result', result),)),
+                                                                          self.bind_cache_lookups[result]))
+        for name, kind, help, callback in self._callbacks:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            value = callback()
+            if isinstance(value, list):
+                for labels, sample in value:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(sample)))
+            else:
+                lines.append('{} {}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the metrics of a ``Metrics`` instance on every path.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', CONTENT_TYPE)
+        return self.metrics.render().encode('utf-8')
+
+
+class MetricsSite(server.Site):
+    """
+    Site of the metrics listener. Scrapes are not written to the log.
+    """
+    noisy = False
+
+    def log(self, request):
+        pass
+
+
+def metrics_service(metrics, endpoint_string, worker=None):
+    """
+    Build a service which serves *metrics* via HTTP. In worker mode, every worker serves its own metrics,
+    so the placeholder ``{worker}`` in the endpoint is replaced by the worker number (e.g. ``tcp:910{worker}``).
+    :param metrics: ``Metrics`` instance
+    :param endpoint_string: ``[metrics] endpoint``
+    :param worker: worker number, or None
+    :return: a ``StreamServerEndpointService``
+    """
+    endpoint = serverFromString(reactor, endpoint_string.replace('{worker}', str(worker or 0)))
+    return internet.StreamServerEndpointService(endpoint, MetricsSite(MetricsResource(metrics)))
@@ -0,0 +1,106 @@
+from collections import deque
+
+from ldaptor.protocols import pureldap
+
+from pi_ldapproxy.tracing import NOOP_SPAN
+
+
+class MessageReply(object):
+    """
+    Wraps the ``reply`` callable passed by ``BaseLDAPServer``. Additionally, it stores the message ID
+    of the request (which is needed to send raw PDUs to the client, see ``rawforward``) and invokes
+    ``on_complete`` once the final response to the request has been sent. At that point, the span
+    of the request (see ``tracing``) is ended as well.
+    """
+    __slots__ = ('reply', 'message_id', 'on_complete', 'span')
+
+    def __init__(self, reply, message_id):
+        self.reply = reply
+        self.message_id = message_id
+        #: Callable which is invoked once the final response has been sent, or None
+        self.on_complete = None
+        #: Root span of the trace of the request, or ``NOOP_SPAN``
+        self.span = NOOP_SPAN
+
+    def __call__(self, response):
+        result = self.reply(response)
+        if response is not None and not isinstance(response, (pureldap.LDAPSearchResultEntry,
+                                                              pureldap.LDAPSearchResultReference)):
+            if self.span:
+                span, self.span = self.span, NOOP_SPAN
+                span.set_attribute('ldap.result_code', getattr(response, 'resultCode', 0))
+                span.end()
+            if self.on_complete is not None:
+                on_complete, self.on_complete = self.on_complete, None
+                on_complete()
+        return result
+
+
+class OperationSequencer(object):
+    """
+    Decides when the operations which a client has sent on one connection are started. In general,
+    operations are processed concurrently. However, LDAP requires some ordering guarantees around binds:
+
+     * A bind is only started once all previously started operations have completed (RFC 4511, 4.2.1).
+     * While a bind is in progress, subsequent operations are held back until the bind has completed,
+       so that they are processed in the context of the new authentication state.
+
+    Once an operation has been held back, all subsequent operations are held back as well, so operations
+    are always started in the order in which they have been received.
+    """
+    __slots__ = ('outstanding', 'bind_in_progress', 'held')
+
+    def __init__(self):
+        #: Number of operations which have been started, but not completed
+        self.outstanding = 0
+        #: Specifies whether a bind has been started, but not completed
+        self.bind_in_progress = False
+        #: Queue of tuples ``(is_bind, start)`` of operations which have been held back, or None.
+        #: As most connections never pipeline, the queue is only allocated once it is needed.
+        self.held = None
+
+    def submit(self, is_bind, start):
+        """
+        Start an operation as soon as the ordering rules allow it.
+        :param is_bind: whether the operation is a bind
+        :param start: A callable which starts the operation. It is passed a callable which
+        must be invoked once the operation has completed.
+        """
+        if self.held or not self._may_start(is_bind):
+            if self.held is None:
+                self.held = deque()
+            self.held.append((is_bind, start))
+        else:
+            self._start(is_bind, start)
+
+    def _may_start(self, is_bind):
+        if self.bind_in_progress:
+            return False
+        return not (is_bind and self.outstanding)
+
+    def _start(self, is_bind, start):
+        self.outstanding += 1
+        if is_bind:
+            self.bind_in_progress = True
+        completed = []
+
+        def done():
+            # Make sure an operation is only completed once
+            if not completed:
+                completed.append(True)
+                self._completed(is_bind)
+        start(done)
+
+    def _completed(self, is_bind):
+        self.outstanding -= 1
+        if is_bind:
+            self.bind_in_progress = False
+        while self.held and self._may_start(self.held[0][0]):
+            is_bind, start = self.held.popleft()
+            self._start(is_bind, start)
+
+    def clear(self):
+        """
+        Drop all operations which have been held back.
+        """
+        self.held = None
@@ -0,0 +1,237 @@
+"""
+On-demand profiling of the reactor thread.
+
+A profiling session is started by sending ``profile_signal`` (``SIGTTIN``) to the proxy process (see
+``services.ProxyService``). In worker mode, the supervisor forwards the signal to all workers. The session
+ends after ``[profiling] duration`` seconds, and then writes its results to ``[profiling] directory``:
+
+ * ``<prefix>.collapsed``: the sampled stacks of the reactor thread in the "collapsed" format, one stack per
+   line, which can be turned into a flame graph (e.g. using ``flamegraph.pl`` or speedscope)
+ * ``<prefix>.txt``: the functions which occur most often in the samples (or, with cProfile, the functions
+   with the highest cumulative time)
+ * ``<prefix>.pstats``: the statistics of cProfile, which can be analyzed using the ``pstats`` module
+   (only in ``cprofile`` mode)
+
+In ``sampling`` mode, a background thread records the stack of the reactor thread every ``sample-interval``
+milliseconds, which slows down the proxy only slightly. In ``cprofile`` mode, the reactor thread is additionally
+profiled deterministically using cProfile, which yields exact call counts, but slows down the proxy noticeably.
+"""
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+
+from twisted.internet import defer, reactor, threads
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+#: Profiling modes
+MODES = ('sampling', 'cprofile')
+
+#: Number of functions listed in the text report
+REPORT_SIZE = 50
+
+
+def _frame_label(code):
+    return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class StackSampler(object):
+    """
+    Periodically records the stack of a thread from a background thread.
+    """
+    def __init__(self, thread_id, interval):
+        """
+        :param thread_id: identifier of the sampled thread (see ``threading.get_ident``)
+        :param interval: number of seconds between two samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        #: Map of stacks (tuples of frame labels, outermost frame first) to the number of samples
+        self.counts = collections.Counter()
+        #: Map of code objects to their labels
+        self._labels = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ldapproxy-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.sample(frame)
+
+    def sample(self, frame):
+        """
+        Record the stack which ends in *frame*.
+        """
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = _frame_label(code)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        self.counts[tuple(stack)] += 1
+
+    def collapsed(self):
+        """
+        :return: the samples in the collapsed stack format, e.g. ``main (a.py:1);run (b.py:10) 42``
+        """
+        return ''.join('{} {}\n'.format(';'.join(stack), count) for stack, count in sorted(self.counts.items()))
+
+    def report(self):
+        """
+        :return: a text report of the functions which occur most often in the samples, by inclusive
+        samples ("total") and by samples in which they were running ("self")
+        """
+        total = sum(self.counts.values())
+        inclusive = collections.Counter()
+        exclusive = collections.Counter()
+        for stack, count in self.counts.items():
+            for label in set(stack):
+                inclusive[label] += count
+            exclusive[stack[-1]] += count
+        lines = ['{} samples, one every {:g} ms'.format(total, self.interval * 1000)]
+        for title, counter in (('Total', inclusive), ('Self', exclusive)):
+            lines.append('')
+            lines.append('{:>8} {:>7}  function'.format(title, '%'))
+            for label, count in counter.most_common(REPORT_SIZE):
+                lines.append('{:>8} {:>6.1f}%  {}'.format(count, 100.0 * count / total, label))
+        return '\n'.join(lines) + '\n'
+
+
+class ProfilingSession(object):
+    """
+    Profiles the reactor thread until ``stop`` is called. Must be started and stopped in the reactor thread.
+    """
+    def __init__(self, mode, sample_interval):
+        self.mode = mode
+        self.sampler = StackSampler(threading.get_ident(), sample_interval)
+        self.profile = cProfile.Profile() if mode == 'cprofile' else None
+
+    def start(self):
+        self.sampler.start()
+        if self.profile is not None:
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+        self.sampler.stop()
+
+    def write(self, prefix):
+        """
+        Write the results to files whose names start with *prefix*. This may be called in a thread.
+        :return: list of filenames
+        """
+        filenames = [prefix + '.collapsed', prefix + '.txt']
+        if self.profile is not None:
+            self.profile.dump_stats(prefix + '.pstats')
+            filenames.append(prefix + '.pstats')
+            report = io.StringIO()
+            pstats.Stats(self.profile, stream=report).sort_stats('cumulative').print_stats(REPORT_SIZE)
+            report = report.getvalue()
+        else:
+            report = self.sampler.report()
+        for filename, contents in zip(filenames, (self.sampler.collapsed(), report)):
+            with open(filename, 'w') as f:
+                f.write(contents)
+        return filenames
+
+
+class Profiler(object):
+    """
+    Runs time-boxed profiling sessions on demand. At most one session runs at a time.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    time = time.time
+
+    def __init__(self):
+        #: The running ``ProfilingSession``, or None
+        self.session = None
+        self._stop_call = None
+        self.configure()
+
+    def configure(self, mode='sampling', duration=30, directory=None, sample_interval=0.005):
+        """
+        Change the settings of future sessions, e.g. after the configuration has been reloaded.
+        :param mode: one of ``MODES``
+        :param duration: number of seconds after which a session ends
+        :param directory: directory to which the results are written, or None for the temporary directory
+        :param sample_interval: number of seconds between two samples of the stack
+        """
+        self.mode = mode
+        self.duration = duration
+        self.directory = directory or tempfile.gettempdir()
+        self.sample_interval = sample_interval
+
+    def start(self):
+        """
+        Start a profiling session, unless one is running already. It is stopped after ``duration`` seconds.
+        :return: the ``ProfilingSession``, or None
+        """
+        if self.session is not None:
+            log.warn('Not starting a profiling session, as one is running already')
+            return None
+        log.warn('Profiling the reactor thread for {duration!r} seconds ({mode}) ...',
+                 duration=self.duration, mode=self.mode)
+        session = ProfilingSession(self.mode, self.sample_interval)
+        try:
+            session.start()
+        except Exception as e:
+            # e.g. because another profiler is active
+            log.failure('Could not start profiling', exception=e)
+            session.stop()
+            return None
+        self.session = session
+        self._stop_call = self.callLater(self.duration, self.stop)
+        return self.session
+
+    def stop(self):
+        """
+        Stop the running profiling session (if any) and write its results.
+        :return: a Deferred which fires with the list of written files
+        """
+        if self._stop_call is not None:
+            if self._stop_call.active():
+                self._stop_call.cancel()
+            self._stop_call = None
+        session, self.session = self.session, None
+        if session is None:
+            return defer.succeed([])
+        session.stop()
+        prefix = os.path.join(self.directory, 'ldapproxy-profile-{}-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.time())), os.getpid()))
+        d = threads.deferToThread(session.write, prefix)
+        d.addCallbacks(self._written, self._write_failed)
+        return d
+
+    def _written(self, filenames):
+        log.warn('Wrote profiling results: {filenames}', filenames=', '.join(filenames))
+        return filenames
+
+    def _write_failed(self, failure):
+        log.failure('Could not write profiling results', failure)
+        return []
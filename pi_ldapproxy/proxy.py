@@ -4,30 +4,47 @@ import json
 import sys
 import re
 import urllib
-from io import BytesIO
 from functools import partial
+from io import BytesIO
 
 from ldaptor.protocols import pureldap
-from ldaptor.protocols.ldap import ldaperrors
-from ldaptor.protocols.ldap.ldapclient import LDAPClient
-from ldaptor.protocols.ldap.ldapconnector import connectToLDAPEndpoint
+from ldaptor.protocols.ldap import ldaperrors, ldapserver
 from ldaptor.protocols.ldap.proxybase import ProxyBase
 from six import ensure_str
 from twisted.internet import defer, protocol, reactor
-from twisted.logger import Logger
 from twisted.internet.ssl import Certificate
 from twisted.python.filepath import FilePath
-from twisted.web.client import Agent, FileBodyProducer, readBody, BrowserLikePolicyForHTTPS
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody, BrowserLikePolicyForHTTPS
 from twisted.web.http_headers import Headers
 
+from pi_ldapproxy.backends import BackendSet
+from pi_ldapproxy.backendpool import BackendConnectionPool, SharedServiceAccountConnections
 from pi_ldapproxy.bindcache import BindCache
 from pi_ldapproxy.config import load_config
+from pi_ldapproxy.deadlines import unbind_with_deadline, with_deadline
+from pi_ldapproxy.flowcontrol import BackendReadThrottle, can_throttle, has_paged_results_control, \
+    paged_results_control, paged_results_cookie
+from pi_ldapproxy.health import HealthCheck
+from pi_ldapproxy.loadshedding import LagMonitor
+from pi_ldapproxy.logs import GatedLogger, configure as configure_logging
+from pi_ldapproxy.metrics import Metrics
+from pi_ldapproxy.profiling import Profiler
 from pi_ldapproxy.appcache import AppCache
-from pi_ldapproxy.realmmapping import detect_login_preamble, REALM_MAPPING_STRATEGIES, RealmMappingError
+from pi_ldapproxy.pipelining import MessageReply, OperationSequencer
+from pi_ldapproxy.rawforward import RawForwardingLDAPClient, peek_object_name, rewrite_message_id
+from pi_ldapproxy.routing import Route, RoutingTable
+from pi_ldapproxy.scheduling import PRIORITY_CLASSES, PRIORITY_PASSTHROUGH, PRIORITY_SERVICE_ACCOUNT, PRIORITY_USER, \
+    PriorityScheduler
+from pi_ldapproxy.searchcache import SearchCache, search_cache_key
+from pi_ldapproxy.sessionlimits import SessionLimits, peer_host
+from pi_ldapproxy.slowlog import SlowOperationLog
+from pi_ldapproxy.startup import Warmup, timings as startup_timings
+from pi_ldapproxy.tracing import NOOP_SPAN, SPAN_KIND_CLIENT, Tracer, build_exporter
+from pi_ldapproxy.realmmapping import detect_login_preamble, find_app_marker, strip_app_marker, REALM_MAPPING_STRATEGIES, RealmMappingError
 from pi_ldapproxy.usermapping import USER_MAPPING_STRATEGIES, UserMappingError
 from pi_ldapproxy.util import DisabledVerificationPolicyForHTTPS
 
-log = Logger()
+log = GatedLogger()
 
 class ProxyError(Exception):
     pass
@@ -35,27 +52,615 @@ class ProxyError(Exception):
 DN_BLACKLIST = list(map(re.compile, ['^dn=uid=']))
 VALIDATE_URL_TEMPLATE = '{}validate/check'
 
+
+def error_response(request, result_code, message):
+    """
+    Build a response to *request* with the given result code.
+    :param request: the LDAP request, which must expect an answer
+    :param result_code: LDAP result code as integer
+    :param message: error message as string
+    :return: a ``LDAPResult`` (or subclass) instance
+    """
+    if isinstance(request, pureldap.LDAPBindRequest):
+        response_class = pureldap.LDAPBindResponse
+    elif isinstance(request, pureldap.LDAPSearchRequest):
+        response_class = pureldap.LDAPSearchResultDone
+    else:
+        response_class = pureldap.LDAPResult
+    return response_class(result_code, errorMessage=message)
+
+
 class TwoFactorAuthenticationProxy(ProxyBase):
+    # Some applications keep large numbers of idle connections open, so the per-connection state is kept
+    # compact: Attributes are stored in slots, and containers which are only needed by some connections
+    # are allocated on demand (they are None until then). Attributes which are not listed here
+    # (e.g. ``clientConnector`` overrides in tests) are stored in the instance dictionary, as usual.
+    __slots__ = (
+        # set by ``BaseLDAPServer``, ``ProxyBase`` and Twisted
+        'buffer', 'connected', 'queuedRequests', 'startTLS_initiated', 'client', 'unbound',
+        'factory', 'transport',
+        # see below and ``reset_state``
+        'connecting_backend', 'backend_waiters', 'shared_backend', 'route', 'dispatched_message_id',
+        'backend_throttle', 'sequencer', 'backend_dial', 'inflight', 'connected_at', 'last_activity',
+        'authenticated', 'search_cache_collectors', 'stripped_app_markers', 'received_bind_request',
+        'forwarded_passthrough_bind', 'backend_identity', 'last_search_response_dn',
+        'search_response_entries', 'open_spans',
+    )
+
     def __init__(self):
         ProxyBase.__init__(self)
+        # These are class attributes of the base classes, which are shadowed by the slots
+        self.client = None
+        self.unbound = False
+        self.factory = None
+        self.transport = None
+        #: Specifies whether we are currently connecting to the LDAP backend
+        self.connecting_backend = False
+        #: List of Deferreds which wait for the connection to the LDAP backend, or None
+        self.backend_waiters = None
+        #: Specifies whether ``self.client`` is a connection shared with other sessions
+        #: (see ``SharedServiceAccountConnections``)
+        self.shared_backend = False
+        #: The ``Route`` whose LDAP backends the session connects to, or None for the default route
+        self.route = None
+        #: Message ID of the incoming request which is currently being dispatched
+        self.dispatched_message_id = None
+        #: ``BackendReadThrottle`` registered with our transport, or None
+        self.backend_throttle = None
+        #: Decides when incoming operations are started
+        self.sequencer = OperationSequencer()
+        #: Deferred of the pending connection attempt to the LDAP backend, or None
+        self.backend_dial = None
+        #: Set of Deferreds of in-flight work (e.g. authentications) which is cancelled once the
+        #: client has disconnected, or None
+        self.inflight = None
+        #: Timestamps of the connection and of the last incoming request (see ``SessionLimits``)
+        self.connected_at = self.last_activity = 0
+        #: Specifies whether a bind has succeeded at some point
+        self.authenticated = False
+        #: Map of ``id(request)`` to lists ``[key, responses, size]`` for search requests whose responses
+        #: are collected for the search cache, or None
+        self.search_cache_collectors = None
+        #: Map of ``id(request)`` to app markers which have been stripped from the filters of forwarded
+        #: search requests (see ``strip_app_marker``), or None
+        self.stripped_app_markers = None
+        #: Set of root spans (see ``tracing``) of traced operations which have not completed yet, or None
+        self.open_spans = None
         # Set the state initially
         self.reset_state()
 
+    def connectionMade(self):
+        """
+        Called by Twisted once the client has connected. Unless the ``lazy-connect`` config option
+        is set, we immediately start connecting to the LDAP backend. Otherwise, the connection
+        is only established once a request actually needs to be forwarded.
+        """
+        ldapserver.BaseLDAPServer.connectionMade(self)
+        limits = self.factory.session_limits
+        self.connected_at = self.last_activity = limits.seconds()
+        limits.register(self, peer_host(self.transport))
+        if not self.factory.lazy_connect:
+            self._dial_backend()
+
+    def handle(self, msg):
+        """
+        Called for each incoming LDAP message. Remember its message ID while it is dispatched.
+        """
+        self.last_activity = self.factory.session_limits.seconds()
+        self.dispatched_message_id = msg.id
+        try:
+            ProxyBase.handle(self, msg)
+        finally:
+            self.dispatched_message_id = None
+
+    def connectionLost(self, reason):
+        """
+        Called by Twisted once the client has disconnected. If the connection pool is enabled,
+        the connection to the LDAP backend is released to the pool if the client has sent an
+        Unbind Request or if the connection has not been used for a passthrough bind.
+        """
+        self.factory.session_limits.unregister(self)
+        self._release_backend_throttle()
+        self.sequencer.clear()
+        self.factory.scheduler.forget(self)
+        for span in self.open_spans or ():
+            span.end('Client has disconnected')
+        self.open_spans = None
+        if self.shared_backend:
+            # The shared connection must stay open for the other sessions
+            self.client = None
+            self.shared_backend = False
+        pool = self.factory.backend_pool
+        if pool is not None and self.client is not None:
+            if self.unbound or not self.forwarded_passthrough_bind:
+                pool.release(self.client)
+                self.client = None
+        ProxyBase.connectionLost(self, reason)
+        self._cancel_inflight()
+
+    def is_idle(self):
+        """
+        :return: whether there are no operations in progress (see ``SessionLimits``)
+        """
+        return not self.sequencer.outstanding and not self.sequencer.held
+
+    def close_session(self, abort=False):
+        """
+        Disconnect the client, e.g. because the session has timed out (see ``SessionLimits``).
+        :param abort: if True, pending data is discarded instead of waiting for the client to read it
+        """
+        if abort:
+            self.transport.abortConnection()
+        else:
+            self.transport.loseConnection()
+
+    def _cancel_inflight(self):
+        """
+        Cancel all work which is still in progress on behalf of the client, i.e. pending authentications
+        (including their privacyIDEA requests and user lookups) and the connection attempt to the LDAP backend.
+        """
+        if self.backend_dial is not None:
+            log.info('Client has disconnected, cancelling connection attempt to LDAP backend ...')
+            self.backend_dial.cancel()
+        for d in list(self.inflight or ()):
+            d.cancel()
+
+    def _track(self, d):
+        """
+        Remember the in-flight Deferred *d* until it has fired, so that it can be cancelled once the client
+        has disconnected (see ``_cancel_inflight``).
+        :return: *d*
+        """
+        if self.inflight is None:
+            self.inflight = set()
+        self.inflight.add(d)
+
+        def _done(result):
+            self.inflight.discard(d)
+            return result
+        d.addBoth(_done)
+        return d
+
+    def clientConnector(self):
+        """
+        Connect to the LDAP backend of the default route, using the connection pool if it is enabled.
+        This is a method (instead of an attribute set by the factory) in order to save memory per connection.
+        :return: A Deferred that fires a `LDAPClient` instance
+        """
+        return self.factory.connect_session_backend()
+
+    def _dial_backend(self):
+        """
+        Start connecting to the LDAP backend using ``clientConnector``, unless we are already connected
+        or connecting.
+        """
+        if self.client is None and not self.connecting_backend:
+            self.connecting_backend = True
+            route = self.route
+            if route is None:
+                d = self.clientConnector()
+            else:
+                d = route.backends.connect()
+            self.backend_dial = self.factory.with_deadline(d, 'backend-connect')
+            d.addBoth(self._dialFinished)
+            d.addCallback(self._connectedToRoute, route)
+            d.addErrback(self._failedToConnectToProxiedServer)
+
+    def _dialFinished(self, result):
+        self.backend_dial = None
+        return result
+
+    def _connectedToRoute(self, proto, route):
+        """
+        Called once the connection to a backend of *route* has been established. If the session has
+        been routed elsewhere in the meantime, discard the connection and connect again.
+        """
+        if route is not self.route:
+            self.connecting_backend = False
+            self._discard_backend_connection(proto)
+            if self.connected and (self.queuedRequests or self.backend_waiters):
+                self._dial_backend()
+        else:
+            self._connectedToProxiedServer(proto)
+
+    def select_route(self, route):
+        """
+        Route the session to the LDAP backends of *route*. If the session is currently connected to
+        another route, the existing connection is discarded, and a new connection will be established
+        once a request needs to be forwarded.
+        :param route: a ``Route`` instance, or None for the default route
+        """
+        if route is self.route:
+            return
+        log.sampled_info('Routing session to {route!r}', route=route)
+        self.route = route
+        self._release_backend_throttle()
+        if self.client is not None:
+            if self.shared_backend:
+                self.shared_backend = False
+            else:
+                self._discard_backend_connection(self.client)
+            self.client = None
+
+    def connect_backend(self):
+        """
+        Return the connection to the LDAP backend, connecting to it first if necessary.
+        :return: A Deferred that fires a `LDAPClient` instance
+        """
+        if self.client is not None:
+            return defer.succeed(self.client)
+        d = defer.Deferred()
+        if self.backend_waiters is None:
+            self.backend_waiters = []
+        self.backend_waiters.append(d)
+        self._dial_backend()
+        return d
+
     def _connectedToProxiedServer(self, proto):
         """
         Workaround for ldaptor bug #105. In case the application has disconnected before
         the connection to the LDAP backend has been established, we want to close the
         connection to the LDAP backend. This works around the problem that health checks
-        may result in leftover sockets.
+        may result in leftover sockets. Load balancers should rather probe the health endpoint
+        (see ``health``), which does not involve the LDAP backend at all.
         """
+        # NOTE: As opposed to ``ProxyBase``, this does not handle ``use_tls``, which is never set here
+        # (the ``use-tls`` config option is ignored). STARTTLS to the LDAP backend is unsupported.
+        self.connecting_backend = False
         if not self.connected:
             log.info('Client has disconnected already, closing connection to LDAP backend ...')
+            self._discard_backend_connection(proto)
+            self.queuedRequests = []
+            self._fail_backend_waiters(ProxyError('Client has disconnected'))
+        elif self.client is not None:
+            # In the meantime, the session has switched to a shared connection
+            self._discard_backend_connection(proto)
+        else:
+            self._set_backend_client(proto)
+
+    def _set_backend_client(self, proto):
+        """
+        Use *proto* as the connection to the LDAP backend, notify everyone waiting for the connection
+        and forward all queued requests.
+        """
+        self.client = proto
+        if self.factory.flow_control and not self.shared_backend:
+            self._throttle_backend(proto)
+        waiters, self.backend_waiters = self.backend_waiters or (), None
+        for waiter in waiters:
+            waiter.callback(proto)
+        self._processBacklog()
+
+    def _throttle_backend(self, proto):
+        """
+        Pause reading from the connection *proto* to the LDAP backend whenever the write buffer of the client
+        connection is full (see ``BackendReadThrottle``).
+        """
+        self._release_backend_throttle()
+        if self.transport is not None and can_throttle(getattr(proto, 'transport', None)):
+            self.backend_throttle = BackendReadThrottle(proto.transport)
+            self.transport.registerProducer(self.backend_throttle, True)
+
+    def _release_backend_throttle(self):
+        """
+        Unregister the ``BackendReadThrottle``, if any, and make sure that the connection to the LDAP backend
+        is read from again.
+        """
+        if self.backend_throttle is not None:
+            throttle, self.backend_throttle = self.backend_throttle, None
+            self.transport.unregisterProducer()
+            throttle.stopProducing()
+
+    def _discard_backend_connection(self, proto):
+        """
+        Get rid of a connection to the LDAP backend which is not needed anymore. If the connection pool
+        is enabled, it is released to the pool. Otherwise, it is closed.
+        """
+        if self.factory.backend_pool is not None:
+            self.factory.backend_pool.release(proto)
+        else:
             proto.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def use_shared_connection(self):
+        """
+        Switch this session over to one of the shared connections of the service account.
+        The session's own connection to the LDAP backend, if any, is discarded.
+        :return: A Deferred that fires once the switch is complete
+        """
+        client = yield self.factory.shared_connections.get_connection()
+        own_client = None if self.shared_backend else self.client
+        # Reading from the shared connection must never be paused because of this session
+        self._release_backend_throttle()
+        self.shared_backend = True
+        self.connecting_backend = False
+        self.client = None
+        self._set_backend_client(client)
+        if own_client is not None:
+            self._discard_backend_connection(own_client)
+
+    def _failedToConnectToProxiedServer(self, err):
+        """
+        Called if the connection to the LDAP backend could not be established, or if the connection
+        attempt has been cancelled because the client has disconnected.
+        """
+        self.connecting_backend = False
+        self._fail_backend_waiters(err)
+        if err.check(defer.CancelledError) and not self.connected:
             self.queuedRequests = []
         else:
-            ProxyBase._connectedToProxiedServer(self, proto)
+            ProxyBase._failedToConnectToProxiedServer(self, err)
+
+    def _fail_backend_waiters(self, reason):
+        waiters, self.backend_waiters = self.backend_waiters or (), None
+        for waiter in waiters:
+            waiter.errback(reason)
+
+    def _processBacklog(self):
+        """
+        Forward all requests which have been queued while connecting to the LDAP backend.
+        As opposed to ``ProxyBase``, these requests have already passed ``handleBeforeForwardRequest``.
+        """
+        while self.queuedRequests:
+            request, controls, reply = self.queuedRequests.pop(0)
+            self._sendToProxiedServer(request, controls, reply)
+
+    def _forwardRequestToProxiedServer(self, request, controls, reply):
+        """
+        Called by `ProxyBase` for each incoming request. The request is started once the ordering rules
+        around binds allow it (see ``OperationSequencer``). Otherwise, pipelined requests are processed
+        concurrently.
+        """
+        reply = MessageReply(reply, self.dispatched_message_id)
+        is_bind = isinstance(request, pureldap.LDAPBindRequest)
+        self.sequencer.submit(is_bind, partial(self._scheduleOperation, request, controls, reply))
+
+    def _scheduleOperation(self, request, controls, reply, done):
+        """
+        Start an operation which the ordering rules allow to start, once the scheduler has a slot for it
+        (see ``scheduling``). Requests without a response are started right away.
+        """
+        scheduler = self.factory.scheduler
+        if not scheduler.enabled or not request.needs_answer:
+            self._startOperation(request, controls, reply, done)
+        else:
+            scheduler.submit(self, self.priority_class(request), peer_host(self.transport),
+                             partial(self._startScheduledOperation, request, controls, reply, done),
+                             partial(self._rejectOperation, request, reply, done))
+
+    def _startScheduledOperation(self, request, controls, reply, done, release):
+        def completed():
+            release()
+            done()
+        self._startOperation(request, controls, reply, completed)
+
+    def _rejectOperation(self, request, reply, done):
+        """
+        Answer a request with ``busy`` because the scheduler queue is full.
+        """
+        if isinstance(request, pureldap.LDAPBindRequest):
+            self.factory.metrics.bind_outcomes['busy'] += 1
+        reply(error_response(request, ldaperrors.LDAPBusy.resultCode, 'Too many operations are queued.'))
+        done()
+
+    def priority_class(self, request):
+        """
+        Determine the priority class of an incoming request (see ``scheduling``).
+        :return: one of the ``scheduling.PRIORITY_*`` constants
+        """
+        if isinstance(request, pureldap.LDAPBindRequest):
+            if ensure_str(request.dn) in self.factory.passthrough_binds:
+                return PRIORITY_PASSTHROUGH
+            return PRIORITY_USER
+        elif self.forwarded_passthrough_bind:
+            return PRIORITY_PASSTHROUGH
+        elif self.authenticated:
+            return PRIORITY_SERVICE_ACCOUNT
+        return PRIORITY_USER
+
+    def _startOperation(self, request, controls, reply, done):
+        """
+        Start processing an incoming request. As opposed to ``ProxyBase``, we pass the request
+        to ``handleBeforeForwardRequest`` right away, i.e. even if the connection to the LDAP backend
+        has not been established yet. Requests that actually need to be forwarded are queued until
+        the connection is ready.
+        :param done: A callable which is invoked once the request has been completed
+        """
+        if request.needs_answer:
+            reply.on_complete = done
+            span = reply.span = self.factory.tracer.start_trace(request.__class__.__name__)
+            if span:
+                span.set_attribute('ldap.message_id', reply.message_id)
+                span.set_attribute('net.peer.ip', peer_host(self.transport))
+                # The span is ended once the final response has been sent, or once the client has disconnected
+                if self.open_spans is None:
+                    self.open_spans = set()
+                self.open_spans.add(span)
+                reply.on_complete = partial(self._traced_operation_completed, span, done)
+            if self.factory.slow_log.threshold and isinstance(request, pureldap.LDAPSearchRequest):
+                reply.on_complete = partial(self._search_completed, request, self.factory.metrics.seconds(),
+                                            reply.on_complete)
+        else:
+            done()
+        d = defer.maybeDeferred(self.handleBeforeForwardRequest, request, controls, reply)
+        d.addCallback(self._forwardHandledRequest, reply)
+        d.addErrback(self._failedToForwardRequest, request, reply)
+
+    def _traced_operation_completed(self, span, done):
+        if self.open_spans is not None:
+            self.open_spans.discard(span)
+        done()
+
+    def _search_completed(self, request, started, done):
+        """
+        Called once the final response to the search request *request* has been sent if the slow-operation
+        log is enabled. Record the search if it has been slow.
+        """
+        done()
+        finished = self.factory.metrics.seconds()
+        if finished - started >= self.factory.slow_log.threshold:
+            self.factory.slow_log.log_search(self, request, started, finished)
+
+    def _failedToForwardRequest(self, failure, request, reply):
+        """
+        Called if an incoming request could not be processed or forwarded, e.g. because the connection
+        to the LDAP backend has been lost. Log the failure and, if the client expects an answer,
+        send an error response so that the client does not wait forever.
+        """
+        log.failure('Could not forward request', failure)
+        if request.needs_answer and self.connected:
+            reply.span.set_error(failure.getErrorMessage())
+            reply(error_response(request, ldaperrors.LDAPOther.resultCode, 'LDAP Proxy failed.'))
+
+    def _forwardHandledRequest(self, result, reply):
+        """
+        Forward a request that has passed ``handleBeforeForwardRequest`` to the LDAP backend.
+        If we are not connected to the LDAP backend yet, queue the request and connect.
+        :param result: None or a tuple ``(request, controls)``
+        :param reply: A function that expects a ``LDAPResult`` object
+        """
+        if result is None:
+            return
+        request, controls = result
+        if self.shared_backend and self.client is not None and not self.client.connected:
+            # The shared connection has been lost, so switch to another one. In the meantime,
+            # requests are queued.
+            log.info('Shared connection to LDAP backend has been lost, switching ...')
+            self.client = None
+            self.connecting_backend = True
+            self.queuedRequests.append((request, controls, reply))
+            self.use_shared_connection().addErrback(self._failedToConnectToProxiedServer)
+        elif self.client is not None:
+            self._sendToProxiedServer(request, controls, reply)
+        elif isinstance(request, pureldap.LDAPUnbindRequest) and not self.connecting_backend:
+            # There is no connection to the LDAP backend we would need to unbind
+            return
+        elif self.factory.lazy_connect and len(self.queuedRequests) >= self.factory.max_pending_requests:
+            log.warn('Too many requests pending for the connection to the LDAP backend, '
+                     'rejecting {class_!r}', class_=request.__class__.__name__)
+            if request.needs_answer:
+                reply(error_response(request, ldaperrors.LDAPBusy.resultCode, 'Too many pending requests.'))
+        else:
+            self.queuedRequests.append((request, controls, reply))
+            self._dial_backend()
+
+    def _sendToProxiedServer(self, request, controls, reply):
+        """
+        Send a request to the LDAP backend via ``self.client`` and pass all responses
+        to ``_gotResponseFromProxiedServer``.
+        """
+        if request.needs_answer:
+            if reply.span:
+                reply.span.child('ldap-backend', SPAN_KIND_CLIENT,
+                                 {'ldap.route': self.route.name if self.route is not None else 'default',
+                                  'ldap.operation': request.__class__.__name__})
+            dseq = []
+            if self._should_page(request, controls):
+                self._sendSearchPage(request, controls, reply, dseq, b'')
+                return
+            if self._can_forward_raw(request, reply):
+                d = self.client.send_multiResponse_raw(
+                    request,
+                    partial(self._gotRawResponseFromProxiedServer, reply.message_id, dseq),
+                    self._gotResponseFromProxiedServer,
+                    reply,
+                    request,
+                    controls,
+                    dseq,
+                )
+            else:
+                d = self.client.send_multiResponse(
+                    request,
+                    self._gotResponseFromProxiedServer,
+                    reply,
+                    request,
+                    controls,
+                    dseq,
+                )
+            d.addErrback(self._failedToForwardRequest, request, reply)
+        else:
+            self.client.send_noResponse(request)
+
+    def _should_page(self, request, controls):
+        """
+        Determine whether *request* should be forwarded to the LDAP backend using the Simple Paged Results
+        Control, i.e. whether ``paged-search-size`` is set and the client did not ask for paging itself.
+        """
+        return (self.factory.paged_search_size > 0
+                and isinstance(request, pureldap.LDAPSearchRequest)
+                and not has_paged_results_control(controls))
+
+    def _sendSearchPage(self, request, controls, reply, dseq, cookie):
+        """
+        Forward the search request *request* to the LDAP backend, asking for the page identified by *cookie*.
+        """
+        page_controls = [paged_results_control(self.factory.paged_search_size, cookie)]
+        if self._can_forward_raw(request, reply):
+            d = self.client.send_multiResponse_raw_ex(
+                request,
+                page_controls,
+                partial(self._gotRawResponseFromProxiedServer, reply.message_id, dseq),
+                self._gotPagedResponseFromProxiedServer,
+                reply,
+                request,
+                controls,
+                dseq,
+            )
+        else:
+            d = self.client.send_multiResponse_ex(
+                request,
+                page_controls,
+                self._gotPagedResponseFromProxiedServer,
+                reply,
+                request,
+                controls,
+                dseq,
+            )
+        d.addErrback(self._failedToForwardRequest, request, reply)
+
+    def _gotPagedResponseFromProxiedServer(self, response, response_controls, reply, request, controls, dseq):
+        """
+        Called for each response to a page of a search request. If the LDAP backend indicates that there are
+        more pages, request the next page instead of passing the ``LDAPSearchResultDone`` to the client.
+        :return: True if this is the last response to the page
+        """
+        if isinstance(response, pureldap.LDAPSearchResultDone) \
+                and response.resultCode == ldaperrors.Success.resultCode:
+            cookie = paged_results_cookie(response_controls)
+            if cookie:
+                if self.client is not None and self.client.connected:
+                    self._sendSearchPage(request, controls, reply, dseq, cookie)
+                else:
+                    reply(pureldap.LDAPSearchResultDone(ldaperrors.LDAPOther.resultCode,
+                                                        errorMessage='Connection to LDAP backend lost.'))
+                return True
+        return self._gotResponseFromProxiedServer(response, reply, request, controls, dseq)
+
+    def _can_forward_raw(self, request, reply):
+        """
+        Determine whether the search result entries of *request* can be forwarded as raw PDUs.
+        This is not the case if the responses are collected for the search cache.
+        """
+        return (self.factory.raw_forwarding
+                and isinstance(request, pureldap.LDAPSearchRequest)
+                and isinstance(self.client, RawForwardingLDAPClient)
+                and not (self.search_cache_collectors and id(request) in self.search_cache_collectors))
+
+    def _gotRawResponseFromProxiedServer(self, message_id, dseq, pdu, op_offset):
+        """
+        Called for each search result entry which is forwarded as a raw PDU. Only its DN is extracted
+        for the login preamble detection (see ``handleProxiedResponse``).
+        :return: True if the entry has been sent to the client, False if it needs to be decoded
+        """
+        if dseq or not self.connected:
+            # Previous responses are still being processed, so we must not overtake them
+            return False
+        self.last_search_response_dn = peek_object_name(pdu, op_offset)
+        self.search_response_entries += 1
+        self.transport.write(rewrite_message_id(pdu, op_offset, message_id))
+        return True
 
-    def request_validate(self, url, user, realm, password):
+    def request_validate(self, url, user, realm, password, traceparent=None):
         """
         Issue an HTTP request to authenticate an user with a password in a given
         realm using the specified privacyIDEA /validate/check endpoint.
@@ -64,31 +669,36 @@ class TwoFactorAuthenticationProxy(ProxyBase):
         :param user: username to authenticate
         :param realm: realm of the user, empty string for default realm
         :param password: password for authentication
+        :param traceparent: W3C trace context which is passed to privacyIDEA (see ``tracing``), or None
         :return: A Twisted Deferred which yields a `twisted.web.client.Response` instance or fails.
         """
         body = urllib.parse.urlencode({'user': user,
                                        'realm': realm,
                                        'pass': password})
         # TODO: Is this really the preferred way to pass a string body?
-        log.info('Validating user password')
+        log.sampled_info('Validating user password')
         producer = FileBodyProducer(BytesIO(body.encode('ascii')))
+        headers = Headers({
+            'Content-Type': ['application/x-www-form-urlencoded'],
+            'User-Agent': ['privacyIDEA-LDAP-Proxy']
+        })
+        if traceparent is not None:
+            headers.addRawHeader('traceparent', traceparent)
         d = self.factory.agent.request(b'POST',
                            url,
-                           Headers({
-                               'Content-Type': ['application/x-www-form-urlencoded'],
-                               'User-Agent': ['privacyIDEA-LDAP-Proxy']
-                           }),
+                           headers,
                            producer)
         return d
 
     @defer.inlineCallbacks
-    def authenticate_bind_request(self, request):
+    def authenticate_bind_request(self, request, span=NOOP_SPAN):
         """
         Given a LDAP bind request:
          * Check if it is contained in the bind cache.
             If yes: Return success and bind the service account.
          * If not: resolve the DN and redirect the request to privacyIDEA.
         :param request: An `pureldap.LDAPBindRequest` instance.
+        :param span: span of the bind request (see ``tracing``), to which spans of the phases are added
         :return: Deferred that fires a tuple ``(success, message)``, whereas ``success`` denotes whether privacyIDEA
         successfully validated the given password. If ``success`` is ``False``, ``message`` contains an error message.
         """
@@ -99,64 +709,122 @@ class TwoFactorAuthenticationProxy(ProxyBase):
         #: the error message.
         result = (False, '')
         request.auth = ensure_str(request.auth)
+        metrics = self.factory.metrics
+        # Timestamp of the start of the current phase (see ``Metrics.lap``)
+        started = timestamp = metrics.seconds()
+        # Timestamps of the ends of the phases, for the slow-operation log
+        realm_resolved = user_resolved = cache_checked = validated = service_bound = None
+        app_marker = realm = user = cached = result = error = None
         try:
-            app_marker, realm = yield self.factory.resolve_realm(request.dn)
-            user = yield self.factory.resolve_user(request.dn)
-        except UserMappingError:
-            # User could not be found
-            log.info('Could not resolve {dn!r} to user', dn=request.dn)
-            result = (False, 'Invalid user.')
-        except RealmMappingError as e:
-            # Realm could not be mapped
-            log.info('Could not resolve {dn!r} to realm: {message!r}', dn=request.dn, message=e.args)
-            # TODO: too much information revealed?
-            result = (False, 'Could not determine realm.')
-        else:
-            log.info('Resolved {dn!r} to {user!r}@{realm!r} ({marker!r})',
-                     dn=request.dn, user=user, realm=realm, marker=app_marker)
-            password = request.auth
-            if self.factory.is_bind_cached(request.dn, app_marker, request.auth):
-                log.info('Combination found in bind cache!')
-                result = (True, app_marker)
+            try:
+                phase_span = span.child('realm-mapping')
+                app_marker, realm = yield self.factory.resolve_realm(request.dn)
+                timestamp = realm_resolved = metrics.lap('realm-resolution', timestamp)
+                phase_span.end()
+                phase_span = span.child('user-lookup')
+                user = yield self.factory.resolve_user(request.dn)
+                timestamp = user_resolved = metrics.lap('user-resolution', timestamp)
+                phase_span.end()
+            except UserMappingError:
+                # User could not be found
+                log.info('Could not resolve {dn!r} to user', dn=request.dn)
+                result = (False, 'Invalid user.')
+                phase_span.end(result[1])
+            except RealmMappingError as e:
+                # Realm could not be mapped
+                log.info('Could not resolve {dn!r} to realm: {message!r}', dn=request.dn, message=e.args)
+                # TODO: too much information revealed?
+                result = (False, 'Could not determine realm.')
+                phase_span.end(result[1])
             else:
-                response = yield self.request_validate(self.factory.validate_url,
-                                                       user,
-                                                       realm,
-                                                       password)
-                json_body = yield readBody(response)
-                if response.code == 200:
-                    body = json.loads(json_body)
-                    if body['result']['status']:
-                        if body['result']['value']:
-                            result = (True, app_marker)
+                log.sampled_info('Resolved {dn!r} to {user!r}@{realm!r} ({marker!r})',
+                                 dn=request.dn, user=user, realm=realm, marker=app_marker)
+                password = request.auth
+                cached = self.factory.is_bind_cached(request.dn, app_marker, request.auth)
+                timestamp = cache_checked = metrics.lap('bind-cache', timestamp)
+                if span:
+                    span.set_attribute('privacyidea.realm', realm)
+                    span.set_attribute('bind_cache.hit', cached)
+                if cached:
+                    log.sampled_info('Combination found in bind cache!')
+                    result = (True, app_marker)
+                else:
+                    phase_span = span.child('privacyidea', SPAN_KIND_CLIENT,
+                                            {'http.url': ensure_str(self.factory.validate_url)} if span else None)
+                    d = self.request_validate(self.factory.validate_url,
+                                              user,
+                                              realm,
+                                              password,
+                                              phase_span.traceparent)
+                    d.addCallback(self._read_validate_response)
+                    d = self.factory.with_deadline(d, 'privacyidea')
+                    d.addBoth(self.factory.health.privacyidea.observe)
+                    response, json_body = yield d
+                    timestamp = validated = metrics.lap('privacyidea', timestamp)
+                    phase_span.set_attribute('http.status_code', response.code)
+                    phase_span.end()
+                    if response.code == 200:
+                        body = json.loads(json_body)
+                        if body['result']['status']:
+                            if body['result']['value']:
+                                result = (True, app_marker)
+                            else:
+                                result = (False, 'Failed to authenticate.')
                         else:
-                            result = (False, 'Failed to authenticate.')
+                            result = (False, 'Failed to authenticate. privacyIDEA error.')
                     else:
-                        result = (False, 'Failed to authenticate. privacyIDEA error.')
-                else:
-                    result = (False, 'Failed to authenticate. Wrong HTTP response ({})'.format(response.code))
-        # TODO: Is this the right place to bind the service user?
-        # (check that result[0] is actually True and not just truthy)
-        if result[0] is True and self.factory.bind_service_account:
-            log.info('Successful authentication, authenticating as service user ...')
-            # Reset value in case the connection is re-used
-            self.forwarded_passthrough_bind = False
-            yield self.bind_service_account()
+                        result = (False, 'Failed to authenticate. Wrong HTTP response ({})'.format(response.code))
+            # TODO: Is this the right place to bind the service user?
+            # (check that result[0] is actually True and not just truthy)
+            if result[0] is True and self.factory.bind_service_account:
+                log.sampled_info('Successful authentication, authenticating as service user ...')
+                # Reset value in case the connection is re-used
+                self.forwarded_passthrough_bind = False
+                phase_span = span.child('service-account-bind', SPAN_KIND_CLIENT)
+                yield self.factory.with_deadline(self.bind_service_account(), 'service-account-bind')
+                service_bound = metrics.lap('service-account-bind', timestamp)
+                phase_span.end()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            slow_log = self.factory.slow_log
+            if slow_log.threshold:
+                finished = metrics.seconds()
+                if finished - started >= slow_log.threshold:
+                    slow_log.log_bind(self, request.dn, app_marker, realm, user, result, cached, started,
+                                      (realm_resolved, user_resolved, cache_checked, validated, service_bound),
+                                      finished, error)
         defer.returnValue(result)
 
-    def send_bind_response(self, result, request, reply):
+    def _read_validate_response(self, response):
+        """
+        Read the body of the response to a privacyIDEA /validate/check request.
+        :return: A Deferred that fires a tuple ``(response, body)``
+        """
+        d = readBody(response)
+        d.addCallback(lambda body: (response, body))
+        return d
+
+    def send_bind_response(self, result, request, reply, outcome=None):
         """
         Given a bind request, authentication result and a reply function, send a successful or a failed bind response.
         :param result: A tuple ``(success, message/app marker)``
         :param request: The corresponding ``LDAPBindRequest``
         :param reply: A function that expects a ``LDAPResult`` object
+        :param outcome: outcome which is counted in the metrics (see ``metrics.BIND_OUTCOMES``). By default,
+        this is ``success`` or ``invalid-credentials``.
         :return: nothing
         """
         success, message = result
+        if outcome is None:
+            outcome = 'success' if success else 'invalid-credentials'
+        self.factory.metrics.bind_outcomes[outcome] += 1
         if success:
-            log.info('Sending BindResponse "success"')
+            log.sampled_info('Sending BindResponse "success"')
             app_marker = message
             self.factory.finalize_authentication(request.dn, app_marker, request.auth)
+            self.authenticated = True
             reply(pureldap.LDAPBindResponse(ldaperrors.Success.resultCode))
         else:
             log.info('Sending BindResponse "invalid credentials": {message}', message=message)
@@ -170,17 +838,34 @@ class TwoFactorAuthenticationProxy(ProxyBase):
         :param reply: A function that expects a ``LDAPResult`` object
         :return:
         """
+        if failure.check(defer.CancelledError) and not self.connected:
+            log.info('Client has disconnected, cancelled authentication')
+            self.factory.metrics.bind_outcomes['cancelled'] += 1
+            return
         log.failure("Could not bind", failure)
+        reply.span.set_error(failure.getErrorMessage())
         # TODO: Is it right to send LDAPInvalidCredentials here?
-        self.send_bind_response((False, 'LDAP Proxy failed.'), request, reply)
+        self.send_bind_response((False, 'LDAP Proxy failed.'), request, reply, 'error')
 
     @defer.inlineCallbacks
     def bind_service_account(self):
         """
         :return: A deferred that sends a bind request for the service account at `self.client`
         """
-        log.info('Binding service account ...')
-        yield self.client.bind(self.factory.service_account_dn, self.factory.service_account_password)
+        if self.route is not None:
+            log.sampled_info('Binding service account of {route!r} ...', route=self.route)
+            client = yield self.connect_backend()
+            yield client.bind(self.route.service_account_dn, self.route.service_account_password)
+            self.backend_identity = (self.route.name, self.route.service_account_dn)
+        elif self.factory.shared_connections is not None:
+            log.sampled_info('Using a shared connection of the service account ...')
+            yield self.use_shared_connection()
+            self.backend_identity = (None, self.factory.service_account_dn)
+        else:
+            log.sampled_info('Binding service account ...')
+            client = yield self.connect_backend()
+            yield client.bind(self.factory.service_account_dn, self.factory.service_account_password)
+            self.backend_identity = (None, self.factory.service_account_dn)
 
     def handleProxiedResponse(self, response, request, controls):
         """
@@ -191,22 +876,29 @@ class TwoFactorAuthenticationProxy(ProxyBase):
         :return:
         """
         try:
+            if isinstance(request, pureldap.LDAPBindRequest):
+                # Remember the identity the connection to the LDAP backend is bound as (for the search cache)
+                if response.resultCode == ldaperrors.Success.resultCode:
+                    self.backend_identity = (None if self.route is None else self.route.name, request.dn)
+                    self.authenticated = True
             # Try to detect login preamble
-            if isinstance(request, pureldap.LDAPSearchRequest):
+            elif isinstance(request, pureldap.LDAPSearchRequest):
                 # If we are sending back a search result entry, we just save it for preamble detection
                 # and count the total number of search result entries.
                 if isinstance(response, pureldap.LDAPSearchResultEntry):
-                    self.last_search_response_entry = response
+                    self.last_search_response_dn = response.objectName
                     self.search_response_entries += 1
                 elif isinstance(response, pureldap.LDAPSearchResultDone):
+                    app_marker = self.stripped_app_markers.pop(id(request), None) if self.stripped_app_markers else None
                     # only check for preambles if we returned exactly one search result entry
                     # and if this connection was established in the context of a passthrough bind
                     # (i.e. an app service account)
                     if self.search_response_entries == 1 and self.forwarded_passthrough_bind:
-                        self.factory.process_search_response(request, self.last_search_response_entry)
+                        entry = pureldap.LDAPSearchResultEntry(self.last_search_response_dn, [])
+                        self.factory.process_search_response(request, entry, app_marker)
                     # reset counter and storage
                     self.search_response_entries = 0
-                    self.last_search_response_entry = None
+                    self.last_search_response_dn = None
                 elif isinstance(response, pureldap.LDAPSearchResultReference):
                     if self.factory.ignore_search_result_references:
                         log.info('Ignoring LDAP SEARCH result reference ...')
@@ -214,31 +906,100 @@ class TwoFactorAuthenticationProxy(ProxyBase):
                     else:
                         log.warn('Possibly sending an invalid LDAP SEARCH result reference, '
                                  'check the ignore-search-result-reference config option for more details.')
+                if self.search_cache_collectors:
+                    self.collect_search_response(response, request)
         except Exception as e:
             log.failure("Unhandled error in handleProxiedResponse: {e}", e=e)
             raise
         return response
 
+    def collect_search_response(self, response, request):
+        """
+        If the responses to *request* are collected for the search cache, add *response*.
+        Once the search is done, add all responses to the search cache if the search was successful.
+        """
+        collector = self.search_cache_collectors.get(id(request)) if self.search_cache_collectors else None
+        if collector is None:
+            return
+        cache = self.factory.search_cache
+        collector[1].append(response)
+        collector[2] += len(response.toWire())
+        if isinstance(response, pureldap.LDAPSearchResultDone):
+            del self.search_cache_collectors[id(request)]
+            if response.resultCode == ldaperrors.Success.resultCode:
+                cache.add(collector[0], collector[1], collector[2])
+        elif collector[2] > cache.max_size:
+            # The responses would not be cached anyway
+            del self.search_cache_collectors[id(request)]
+
+    def strip_app_marker(self, request):
+        """
+        Remove the app marker expression from the filter of the search request *request* (if possible
+        without changing the semantics of the filter), so that the LDAP backend does not need to evaluate it.
+        The app marker is remembered for the login preamble detection.
+        :param request: ``LDAPSearchRequest``, which is modified in-place
+        """
+        attribute, value_prefix = self.factory.app_cache_attribute, self.factory.app_cache_value_prefix
+        marker = find_app_marker(request.filter, attribute, value_prefix)
+        if marker is not None:
+            stripped_filter = strip_app_marker(request.filter, attribute, value_prefix)
+            if stripped_filter is not request.filter:
+                log.debug('Stripped app marker {marker!r} from search filter', marker=marker)
+                request.filter = stripped_filter
+                if self.stripped_app_markers is None:
+                    self.stripped_app_markers = {}
+                self.stripped_app_markers[id(request)] = marker
+
+    def lookup_search_cache(self, request, controls, reply):
+        """
+        If the search cache is enabled, look up the responses to *request*. On a cache hit, replay the responses
+        to the client. Otherwise, prepare to collect the responses of the LDAP backend.
+        :return: True if the request has been answered from the search cache
+        """
+        cache = self.factory.search_cache
+        if cache is None or self.backend_identity is None:
+            return False
+        key = search_cache_key(self.backend_identity, request, controls)
+        responses = cache.get(key)
+        if responses is None:
+            if self.search_cache_collectors is None:
+                self.search_cache_collectors = {}
+            self.search_cache_collectors[id(request)] = [key, [], 0]
+            return False
+        log.sampled_info('Answering search request from search cache ({count!r} responses)', count=len(responses))
+        for response in responses:
+            # ``reply`` assigns the message ID of the current request
+            reply(self.handleProxiedResponse(response, request, controls))
+        return True
+
     def reset_state(self):
         """
         Reset the internal state of the connection to its initial state.
         This is used in case a LDAP conneciton is reused, i.e. more than
         one bind request is received:
         """
+        if self.shared_backend:
+            # The session might issue a passthrough bind now, which must not affect the shared
+            # connection. Thus, the session needs a connection of its own again.
+            self.client = None
+            self.shared_backend = False
         #: Specifies whether we have received a Bind Request at some point
         self.received_bind_request = False
         #: Specifies whether we forwarded a Bind Request to the LDAP backend because the
         #: DN was found in passthrough_binds.
         self.forwarded_passthrough_bind = False
-        #: If we are currently processing a search request, this stores the last entry
+        #: Tuple ``(route name, DN)`` the connection to the LDAP backend is known to be bound as, or None.
+        #: This is used as part of the search cache key.
+        self.backend_identity = None
+        #: If we are currently processing a search request, this stores the DN of the last entry
         #: sent during its response. Otherwise, it is None.
-        self.last_search_response_entry = None
+        self.last_search_response_dn = None
         #: If we are currently processing a search request, this stores the total number of
         #: entries sent during its response.
         # Why do we have these two attributes here? For preamble detection, we need to make sure
         # that the search request returns only one entry. To achieve that, we could store all entries
         # in a list. However, this introduces unnecessary space overhead (e.g. if the app queries
-        # all users). Thus, we only store the last entry and the total entry count.
+        # all users). Thus, we only store the DN of the last entry and the total entry count.
         self.search_response_entries = 0
 
     def handleBeforeForwardRequest(self, request, controls, reply):
@@ -254,31 +1015,41 @@ class TwoFactorAuthenticationProxy(ProxyBase):
                 # We have already received a bind request in this connection!
                 if self.factory.allow_connection_reuse:
                     # We need to reset the state before further processing the request
-                    log.info('Reusing LDAP connection, resetting state ...')
+                    log.sampled_info('Reusing LDAP connection, resetting state ...')
                     self.reset_state()
                 else:
                     log.warn('Rejected a second bind request in the same connection. '
                              'Please check the `allow-connection-reuse` config option.')
-                    self.send_bind_response((False, 'Reusing connections is disabled.'), request, reply)
+                    self.send_bind_response((False, 'Reusing connections is disabled.'), request, reply, 'rejected')
                     return None
             self.received_bind_request = True
             request.dn = ensure_str(request.dn)
+            route = self.factory.route_for(request.dn)
+            self.select_route(None if route is self.factory.routes.default else route)
             if request.dn == '':
                 if self.factory.forward_anonymous_binds:
                     return request, controls
                 else:
-                    self.send_bind_response((False, 'Anonymous binds are not supported.'), request, reply)
+                    self.send_bind_response((False, 'Anonymous binds are not supported.'), request, reply, 'rejected')
                     return None
             elif self.factory.is_dn_blacklisted(request.dn):
-                self.send_bind_response((False, 'DN is blacklisted.'), request, reply)
+                self.send_bind_response((False, 'DN is blacklisted.'), request, reply, 'rejected')
                 return None
             elif request.dn in self.factory.passthrough_binds:
-                log.info('BindRequest for {dn!r}, passing through ...', dn=request.dn)
+                log.sampled_info('BindRequest for {dn!r}, passing through ...', dn=request.dn)
                 self.forwarded_passthrough_bind = True
                 return request, controls
+            elif self.factory.lag_monitor.reject_binds:
+                # The proxy is overloaded, see ``loadshedding``
+                self.factory.metrics.bind_outcomes['busy'] += 1
+                reply(pureldap.LDAPBindResponse(ldaperrors.LDAPBusy.resultCode,
+                                                errorMessage='The LDAP proxy is overloaded.'))
+                return None
             else:
-                log.info("BindRequest for {dn!r} received ...", dn=request.dn)
-                d = self.authenticate_bind_request(request)
+                log.sampled_info("BindRequest for {dn!r} received ...", dn=request.dn)
+                if reply.span:
+                    reply.span.set_attribute('ldap.dn', request.dn)
+                d = self._track(self.authenticate_bind_request(request, reply.span))
                 d.addCallback(self.send_bind_response, request, reply)
                 d.addErrback(self.send_error_bind_response, request, reply)
                 return None
@@ -290,11 +1061,19 @@ class TwoFactorAuthenticationProxy(ProxyBase):
                 reply(pureldap.LDAPSearchResultDone(ldaperrors.LDAPInsufficientAccessRights.resultCode,
                                         errorMessage='LDAP Search disallowed according to the configuration.'))
                 return None
+            if self.lookup_search_cache(request, controls, reply):
+                return None
+            if self.factory.app_cache_strip_marker:
+                self.strip_app_marker(request)
             # Apparently, we can forward the search request.
             # Assuming `bind-service-account` is enabled and the privacyIDEA authentication was successful,
             # the service account is already authenticated for `self.client`.
             return request, controls
         elif isinstance(request, pureldap.LDAPUnbindRequest):
+            if self.shared_backend or self.factory.backend_pool is not None:
+                # The connection to the LDAP backend is returned to the pool once the client has disconnected,
+                # so we must not forward the Unbind Request.
+                return None
             # We just forward any Unbind Request, regardless of whether we have sent a Bind Request to
             # the LDAP backend earlier.
             return request, controls
@@ -307,9 +1086,60 @@ class TwoFactorAuthenticationProxy(ProxyBase):
 
 class ProxyServerFactory(protocol.ServerFactory):
     protocol = TwoFactorAuthenticationProxy
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
 
     def __init__(self, config):
         # NOTE: ServerFactory.__init__ does not exist?
+        #: The current configuration
+        self.config = None
+        self.bind_cache = None
+        self.app_cache = None
+        self.search_cache = None
+        self.backend_pool = None
+        self.shared_connections = None
+        self.session_limits = SessionLimits()
+        #: Deferred which fires once the factory has been stopped (see ``stopFactory``), or None
+        self.stopped = None
+        #: Object which is notified of new bind cache and app cache entries in order to share them
+        #: with other worker processes (see ``workers.WorkerControl``), or None
+        self.cache_replicator = None
+        #: Metrics of the proxy (see ``metrics.Metrics``)
+        self.metrics = Metrics()
+        #: Tracer of the incoming operations (see ``tracing.Tracer``)
+        self.tracer = Tracer()
+        #: Log of slow binds and searches (see ``slowlog.SlowOperationLog``)
+        self.slow_log = SlowOperationLog()
+        #: Profiler of the reactor thread, started on demand (see ``profiling.Profiler``)
+        self.profiler = Profiler()
+        #: Monitor of the reactor lag, which decides whether load is shed (see ``loadshedding.LagMonitor``)
+        self.lag_monitor = LagMonitor()
+        #: Scheduler of the incoming operations (see ``scheduling.PriorityScheduler``)
+        self.scheduler = PriorityScheduler()
+        #: Health and readiness of the proxy, which are served to load balancers (see ``health.HealthCheck``)
+        self.health = HealthCheck(self)
+        #: Warm-up of the connections once the proxy has started (see ``startup.Warmup``)
+        self.warmup = Warmup(self)
+        self.add_metrics()
+        self.apply_config(config)
+
+    def apply_config(self, config):
+        """
+        Read all configuration options from *config*. This is used on startup and to reload the configuration
+        at runtime (see ``services.reload_config``): All settings, mappers and connection pools are built
+        first and only then swapped in at once, so an invalid configuration leaves the factory unchanged.
+        Existing client sessions are kept. The bind cache, app cache and search cache, the connection pool
+        and the shared connections (including their contents) are kept if the respective settings are
+        compatible with the previous configuration.
+        :param config: validated configuration (see ``config.read_config``)
+        """
+        previous = self.config
+
+        def unchanged(*sections):
+            return previous is not None and all(previous[section] == config[section] for section in sections)
+
+        #: Map of attribute names to their new values
+        settings = {'config': config}
         # Read configuration options.
         if config['privacyidea']['verify']:
             if config['privacyidea']['certificate']:
@@ -324,85 +1154,315 @@ class ProxyServerFactory(protocol.ServerFactory):
         else:
             log.warn('privacyIDEA HTTPS certificate will NOT be checked!')
             https_policy = DisabledVerificationPolicyForHTTPS()
-        self.agent = Agent(reactor, https_policy)
+        keep_alive_connections = config['privacyidea']['keep-alive-connections']
+        if keep_alive_connections:
+            # Idle connections must be closed before privacyIDEA closes them, as Twisted does not retry
+            # POST requests which fail because the server has closed the connection
+            http_pool = settings['http_pool'] = HTTPConnectionPool(reactor, persistent=True)
+            http_pool.maxPersistentPerHost = keep_alive_connections
+            http_pool.cachedConnectionTimeout = config['privacyidea']['keep-alive-timeout']
+        else:
+            http_pool = settings['http_pool'] = None
+        settings['agent'] = Agent(reactor, https_policy, pool=http_pool)
         if config['ldap-backend']['use-tls']:
             # TODO: This seems to get lost if we use log.info
             log.warn('The use-tls config option is deprecated and will be ignored.')
 
-        self.proxied_endpoint_string = config['ldap-backend']['endpoint']
-        self.privacyidea_instance = config['privacyidea']['instance']
+        settings['lazy_connect'] = config['ldap-backend']['lazy-connect']
+        settings['max_pending_requests'] = config['ldap-backend']['max-pending-requests']
+        privacyidea_instance = config['privacyidea']['instance']
         # Construct the validate url from the instance location
-        if self.privacyidea_instance[-1] != '/':
-            self.privacyidea_instance += '/'
-        self.validate_url = VALIDATE_URL_TEMPLATE.format(self.privacyidea_instance).encode('ascii')
+        if privacyidea_instance[-1] != '/':
+            privacyidea_instance += '/'
+        settings['privacyidea_instance'] = privacyidea_instance
+        settings['validate_url'] = VALIDATE_URL_TEMPLATE.format(privacyidea_instance).encode('ascii')
+
+        service_account_dn = settings['service_account_dn'] = config['service-account']['dn']
+        service_account_password = settings['service_account_password'] = config['service-account']['password']
+        #: Map of phase names to deadlines in seconds (see ``with_deadline``)
+        settings['timeouts'] = dict(config['timeouts'])
 
-        self.service_account_dn = config['service-account']['dn']
-        self.service_account_password = config['service-account']['password']
+        # Connections to the LDAP backends are kept unless their configuration has changed
+        backends_unchanged = unchanged('ldap-backend', 'routes', 'service-account')
+        if backends_unchanged:
+            settings['backends'], settings['routes'] = self.backends, self.routes
+        else:
+            backends = settings['backends'] = BackendSet(config['ldap-backend']['endpoint'],
+                                                         config['ldap-backend']['balancing'],
+                                                         config['ldap-backend']['ejection-time'])
+            log.info('LDAP backends: {endpoints!r} ({balancing})',
+                     endpoints=config['ldap-backend']['endpoint'], balancing=backends.balancing)
+            routes = []
+            for name, route_config in config['routes'].items():
+                route_backends = BackendSet(route_config['endpoint'],
+                                            route_config['balancing'],
+                                            config['ldap-backend']['ejection-time'])
+                route = Route(name, route_config['suffix'], route_backends,
+                              route_config['service-account-dn'] or service_account_dn,
+                              route_config['service-account-password'] or service_account_password)
+                log.info('Routing {suffix!r} to LDAP backends {endpoints!r}',
+                         suffix=route.suffix, endpoints=route_config['endpoint'])
+                routes.append(route)
+            settings['routes'] = RoutingTable(routes, Route('default', None, backends,
+                                                            service_account_dn, service_account_password))
+        if backends_unchanged:
+            settings['backend_pool'] = self.backend_pool
+        elif config['ldap-backend']['pool-size'] > 0:
+            log.info('Keeping up to {size!r} idle connections to the LDAP backend',
+                     size=config['ldap-backend']['pool-size'])
+            settings['backend_pool'] = BackendConnectionPool(self.connect_backend,
+                                                             config['ldap-backend']['pool-size'],
+                                                             config['ldap-backend']['pool-max-lifetime'],
+                                                             config['ldap-backend']['pool-idle-timeout'])
+        else:
+            settings['backend_pool'] = None
 
         # We have to make a small workaround for configobj here: An empty config value
         # is interpreted as a list with one element, the empty string.
-        self.passthrough_binds = config['ldap-proxy']['passthrough-binds']
-        if len(self.passthrough_binds) == 1 and self.passthrough_binds[0]  == '':
-            self.passthrough_binds = []
-        log.info('Passthrough DNs: {binds!r}', binds=self.passthrough_binds)
+        passthrough_binds = config['ldap-proxy']['passthrough-binds']
+        if len(passthrough_binds) == 1 and passthrough_binds[0]  == '':
+            passthrough_binds = []
+        settings['passthrough_binds'] = passthrough_binds
+        log.info('Passthrough DNs: {binds!r}', binds=passthrough_binds)
 
-        self.forward_anonymous_binds = config['ldap-proxy']['forward-anonymous-binds']
+        settings['forward_anonymous_binds'] = config['ldap-proxy']['forward-anonymous-binds']
 
-        self.allow_search = config['ldap-proxy']['allow-search']
-        self.bind_service_account = config['ldap-proxy']['bind-service-account']
-        self.allow_connection_reuse = config['ldap-proxy']['allow-connection-reuse']
-        self.ignore_search_result_references = config['ldap-proxy']['ignore-search-result-references']
+        settings['allow_search'] = config['ldap-proxy']['allow-search']
+        bind_service_account = settings['bind_service_account'] = config['ldap-proxy']['bind-service-account']
+        multiplex = (config['ldap-proxy']['multiplex-service-account'], config['ldap-proxy']['multiplex-connections'])
+        if backends_unchanged and bind_service_account == self.bind_service_account \
+                and multiplex == self.multiplex:
+            settings['shared_connections'] = self.shared_connections
+        elif bind_service_account and config['ldap-proxy']['multiplex-service-account']:
+            log.info('Sharing {count!r} connections of the service account between sessions',
+                     count=config['ldap-proxy']['multiplex-connections'])
+            settings['shared_connections'] = SharedServiceAccountConnections(
+                self.connect_service_account, config['ldap-proxy']['multiplex-connections'])
+        else:
+            settings['shared_connections'] = None
+        settings['multiplex'] = multiplex
+        settings['allow_connection_reuse'] = config['ldap-proxy']['allow-connection-reuse']
+        settings['ignore_search_result_references'] = config['ldap-proxy']['ignore-search-result-references']
+        settings['raw_forwarding'] = config['ldap-proxy']['raw-forwarding']
+        settings['flow_control'] = config['ldap-backend']['flow-control']
+        settings['paged_search_size'] = config['ldap-backend']['paged-search-size']
 
         user_mapping_strategy = USER_MAPPING_STRATEGIES[config['user-mapping']['strategy']]
         log.info('Using user mapping strategy: {strategy!r}', strategy=user_mapping_strategy)
 
-        self.user_mapper = user_mapping_strategy(self, config['user-mapping'])
+        settings['user_mapper'] = user_mapping_strategy(self, config['user-mapping'])
 
         realm_mapping_strategy = REALM_MAPPING_STRATEGIES[config['realm-mapping']['strategy']]
         log.info('Using realm mapping strategy: {strategy!r}', strategy=realm_mapping_strategy)
 
-        self.realm_mapper = realm_mapping_strategy(self, config['realm-mapping'])
+        settings['realm_mapper'] = realm_mapping_strategy(self, config['realm-mapping'])
 
         enable_bind_cache = config['bind-cache']['enabled']
-        if enable_bind_cache:
-            self.bind_cache = BindCache(config['bind-cache']['timeout'])
+        if enable_bind_cache and self.bind_cache is not None:
+            settings['bind_cache'] = self.bind_cache
+        elif enable_bind_cache:
+            settings['bind_cache'] = BindCache(config['bind-cache']['timeout'])
         else:
-            self.bind_cache = None
+            settings['bind_cache'] = None
 
         enable_app_cache = config['app-cache']['enabled']
-        if enable_app_cache:
-            self.app_cache = AppCache(config['app-cache']['timeout'], config['app-cache']['case-insensitive'])
+        if enable_app_cache and self.app_cache is not None \
+                and self.app_cache.case_insensitive == config['app-cache']['case-insensitive']:
+            settings['app_cache'] = self.app_cache
+        elif enable_app_cache:
+            settings['app_cache'] = AppCache(config['app-cache']['timeout'], config['app-cache']['case-insensitive'])
+        else:
+            settings['app_cache'] = None
+        if config['search-cache']['enabled'] and backends_unchanged and unchanged('search-cache'):
+            settings['search_cache'] = self.search_cache
+        elif config['search-cache']['enabled']:
+            log.info('Caching search responses for {timeout!r} seconds (up to {size!r} bytes)',
+                     timeout=config['search-cache']['timeout'], size=config['search-cache']['max-size'])
+            settings['search_cache'] = SearchCache(config['search-cache']['timeout'],
+                                                   config['search-cache']['max-size'])
         else:
-            self.app_cache = None
-        self.app_cache_attribute = config['app-cache']['attribute']
-        self.app_cache_value_prefix = config['app-cache']['value-prefix']
+            settings['search_cache'] = None
+        settings['app_cache_attribute'] = config['app-cache']['attribute']
+        settings['app_cache_value_prefix'] = config['app-cache']['value-prefix']
+        settings['app_cache_strip_marker'] = config['app-cache']['strip-marker']
 
-        if config['ldap-backend']['test-connection']:
-            self.test_connection()
+        # Swap in the new configuration
+        replaced = dict((name, getattr(self, name, None)) for name in settings)
+        self.__dict__.update(settings)
+        if self.bind_cache is not None:
+            self.bind_cache.timeout = config['bind-cache']['timeout']
+        if self.app_cache is not None:
+            self.app_cache.timeout = config['app-cache']['timeout']
+        self.session_limits.configure(config['limits']['max-connections'],
+                                      config['limits']['max-connections-per-ip'],
+                                      config['limits']['idle-timeout'],
+                                      config['limits']['bind-timeout'],
+                                      config['limits']['max-session-lifetime'])
+        self.tracer.configure(config['tracing']['sample-rate'], build_exporter(config['tracing']),
+                              config['tracing']['export-interval'], config['tracing']['max-queue-size'],
+                              service_name=config['tracing']['service-name'])
+        self.slow_log.configure(config['slow-log']['threshold'] / 1000.0, config['slow-log']['file'] or None)
+        configure_logging(config['logging'])
+        self.profiler.configure(config['profiling']['mode'], config['profiling']['duration'],
+                                config['profiling']['directory'] or None,
+                                config['profiling']['sample-interval'] / 1000.0)
+        self.lag_monitor.configure(config['load-shedding']['check-interval'] / 1000.0,
+                                   config['load-shedding']['reject-connections'] / 1000.0,
+                                   config['load-shedding']['reject-binds'] / 1000.0)
+        self.scheduler.configure(config['scheduling']['max-concurrent'], config['scheduling']['max-queued'])
+        self.health.configure(config['health']['max-privacyidea-failures'])
+
+        # Retire the connections to the LDAP backends which have been replaced. Sessions which use them
+        # keep their connections.
+        if replaced['routes'] not in (None, self.routes):
+            for route in replaced['routes']:
+                route.backends.stop_health_checks()
+        if replaced['backend_pool'] not in (None, self.backend_pool):
+            replaced['backend_pool'].close()
+        if replaced['shared_connections'] not in (None, self.shared_connections):
+            replaced['shared_connections'].close()
+        if replaced['http_pool'] is not None:
+            replaced['http_pool'].closeCachedConnections()
+        if replaced['routes'] is not self.routes:
+            for route in self.routes:
+                # On startup, the connections are tested by the warm-up (see ``warm_up``)
+                if config['ldap-backend']['test-connection'] and previous is not None:
+                    for backend in route.backends.backends:
+                        self.test_connection(backend, route)
+                if config['ldap-backend']['health-check-interval'] > 0:
+                    route.backends.start_health_checks(partial(self.test_connection, route=route),
+                                                       config['ldap-backend']['health-check-interval'])
+
+    def add_metrics(self):
+        """
+        Add the metrics which are determined from the current state of the factory whenever they are scraped.
+        As the callbacks look up the caches, pools and routes on each scrape, they are not affected by a reload.
+        """
+        def size(name):
+            return lambda: len(getattr(self, name)) if getattr(self, name) is not None else 0
+
+        def backend_samples(attribute):
+            return lambda: [((('route', route.name), ('endpoint', backend.endpoint)), getattr(backend, attribute))
+                            for route in self.routes for backend in route.backends.backends]
+
+        metrics = self.metrics
+        metrics.add_metric('ldapproxy_client_connections', 'gauge', 'Open client connections',
+                           lambda: len(self.session_limits))
+        metrics.add_metric('ldapproxy_rejected_connections_total', 'counter',
+                           'Client connections rejected because of a connection limit',
+                           lambda: self.session_limits.rejected)
+        metrics.add_metric('ldapproxy_shed_connections_total', 'counter',
+                           'Client connections refused because the reactor lag was too high',
+                           lambda: self.lag_monitor.rejected_connections)
+        metrics.add_metric('ldapproxy_reactor_lag_seconds', 'gauge', 'Smoothed lag of the reactor',
+                           lambda: self.lag_monitor.smoothed_lag)
+        metrics.add_metric('ldapproxy_load_shedding_level', 'gauge',
+                           'Load shedding level (0: none, 1: refusing connections, 2: also rejecting binds)',
+                           lambda: self.lag_monitor.level)
+        metrics.add_metric('ldapproxy_startup_seconds', 'gauge', 'Duration of the phases of the startup',
+                           lambda: [((('phase', phase),), seconds)
+                                    for phase, seconds in startup_timings.phases.items()])
+        metrics.add_metric('ldapproxy_scheduler_running_operations', 'gauge',
+                           'Operations which occupy a slot of the scheduler', lambda: self.scheduler.running)
+        metrics.add_metric('ldapproxy_scheduler_queued_operations', 'gauge',
+                           'Operations which wait for a slot of the scheduler, by priority class',
+                           lambda: [((('class', name),), count) for name, count in self.scheduler.queued_by_class()])
+        metrics.add_metric('ldapproxy_scheduler_rejected_operations_total', 'counter',
+                           'Operations rejected because the scheduler queue was full',
+                           lambda: self.scheduler.rejected)
+        metrics.add_metric('ldapproxy_bind_cache_entries', 'gauge', 'Entries in the bind cache', size('bind_cache'))
+        metrics.add_metric('ldapproxy_app_cache_entries', 'gauge', 'Entries in the app cache', size('app_cache'))
+        metrics.add_metric('ldapproxy_search_cache_entries', 'gauge', 'Entries in the search cache',
+                           size('search_cache'))
+        metrics.add_metric('ldapproxy_search_cache_bytes', 'gauge', 'Total size of the search cache entries',
+                           lambda: self.search_cache.size if self.search_cache is not None else 0)
+        metrics.add_metric('ldapproxy_search_cache_lookups_total', 'counter', 'Search cache lookups, by result',
+                           lambda: [((('result', 'hit'),), self.search_cache.hits),
+                                    ((('result', 'miss'),), self.search_cache.misses)]
+                           if self.search_cache is not None else [])
+        metrics.add_metric('ldapproxy_backend_pool_idle_connections', 'gauge',
+                           'Idle connections in the connection pool',
+                           lambda: self.backend_pool.idle_count if self.backend_pool is not None else 0)
+        metrics.add_metric('ldapproxy_shared_connections', 'gauge', 'Established shared connections',
+                           lambda: self.shared_connections.connected_count
+                           if self.shared_connections is not None else 0)
+        metrics.add_metric('ldapproxy_backend_active_connections', 'gauge', 'Open connections to the LDAP backends',
+                           backend_samples('active_connections'))
+        metrics.add_metric('ldapproxy_backend_connection_failures_total', 'counter',
+                           'Failed connection attempts to the LDAP backends', backend_samples('connection_failures'))
 
     @defer.inlineCallbacks
-    def connect_service_account(self):
+    def connect_service_account(self, backend=None, route=None):
         """
         Make a new connection to the LDAP backend server using the credentials of the service account
+        :param backend: connect to this specific ``Backend``. If None, pick one of the backends of the route.
+        :param route: use the backends and the service account of this ``Route``. If None, use the default route.
         :return: A Deferred that fires a `LDAPClient` instance
         """
-        client = yield connectToLDAPEndpoint(reactor, self.proxied_endpoint_string, LDAPClient)
+        if route is None:
+            route = self.routes.default
+        if backend is None:
+            d = route.backends.connect()
+        else:
+            d = route.backends.connect_to(backend)
+        client = yield self.with_deadline(d, 'backend-connect')
         try:
-            yield client.bind(self.service_account_dn, self.service_account_password)
-        except ldaperrors.LDAPException as e:
-            # Call unbind() here if an exception occurs: Otherwise, Twisted will keep the file open
-            # and slowly run out of open files.
-            yield client.unbind()
-            raise e
+            yield self.with_deadline(defer.maybeDeferred(client.bind, route.service_account_dn,
+                                                         route.service_account_password),
+                                     'service-account-bind')
+        except Exception:
+            # Call unbind() here if an exception occurs (including a cancellation): Otherwise, Twisted
+            # will keep the file open and slowly run out of open files.
+            self.unbind(client)
+            raise
         defer.returnValue(client)
 
+    def with_deadline(self, d, phase):
+        """
+        Cancel the Deferred *d* if it has not fired within the deadline configured for *phase*
+        in the ``[timeouts]`` section.
+        :param d: a Deferred
+        :param phase: name of a config option in ``[timeouts]``, e.g. ``privacyidea``
+        :return: *d*, which fails with ``DeadlineExceeded`` once the deadline has passed
+        """
+        return with_deadline(d, self.timeouts[phase], phase, self.callLater)
+
+    def unbind(self, client):
+        """
+        Unbind and close the connection *client* to the LDAP backend. The connection is aborted
+        if it has not been closed within the ``unbind`` deadline.
+        :param client: ``LDAPClient`` instance
+        """
+        unbind_with_deadline(client, self.timeouts['unbind'], self.callLater)
+
+    def route_for(self, dn):
+        """
+        Find the route of the given DN.
+        :param dn: Distinguished Name as string
+        :return: a ``Route`` instance
+        """
+        return self.routes.route_for(dn)
+
+    def connect_service_account_for(self, dn):
+        """
+        Make a new connection to the LDAP backend server responsible for *dn*
+        using the credentials of the corresponding service account.
+        :param dn: Distinguished Name as string
+        :return: A Deferred that fires a `LDAPClient` instance
+        """
+        route = self.route_for(dn)
+        if route is self.routes.default:
+            return self.connect_service_account()
+        else:
+            return self.connect_service_account(route=route)
+
     def resolve_user(self, dn):
         """
         Invoke the user mapper to find the username of the user identified by the DN *dn*.
         :param dn: LDAP distinguished name as string
         :return: a Deferred firing a string (or raising a UserMappingError)
         """
-        return self.user_mapper.resolve(dn)
+        return self.with_deadline(defer.maybeDeferred(self.user_mapper.resolve, dn), 'user-lookup')
 
     def resolve_realm(self, dn):
         """
@@ -410,7 +1470,7 @@ class ProxyServerFactory(protocol.ServerFactory):
         :param dn: LDAP distinguished name as string
         :return: a Deferred firing a string (or raising a RealmMappingError)
         """
-        return self.realm_mapper.resolve(dn)
+        return self.with_deadline(defer.maybeDeferred(self.realm_mapper.resolve, dn), 'user-lookup')
 
     def finalize_authentication(self, dn, app_marker, password):
         """
@@ -422,24 +1482,30 @@ class ProxyServerFactory(protocol.ServerFactory):
         """
         if self.bind_cache is not None:
             self.bind_cache.add_to_cache(dn, app_marker, password)
+            if self.cache_replicator is not None:
+                self.cache_replicator.bind_cache_added(dn, app_marker, password)
 
-    def process_search_response(self, request, response):
+    def process_search_response(self, request, response, app_marker=None):
         """
         Called when ``response`` is sent in response to ``request``. If the app cache is enabled,
         ``detect_login_preamble`` is invoked in order to detect a login preamble. If one was detected,
         the corresponding entry is added to the app cache.
         :param request: LDAPSearchRequest
         :param response: LDAPSearchResultEntry or LDAPSearchResultDone
+        :param app_marker: app marker which has been stripped from the request filter, or None
         :return:
         """
         if self.app_cache is not None:
             result = detect_login_preamble(request,
                                            response,
                                            self.app_cache_attribute,
-                                           self.app_cache_value_prefix)
+                                           self.app_cache_value_prefix,
+                                           app_marker)
             if result is not None:
                 dn, marker = result
-                self.app_cache.add_to_cache(dn, marker)
+                self.app_cache.add_to_cache(ensure_str(dn), marker)
+                if self.cache_replicator is not None:
+                    self.cache_replicator.app_cache_added(ensure_str(dn), marker)
 
     def is_bind_cached(self, dn, app_marker, password):
         """
@@ -451,7 +1517,9 @@ class ProxyServerFactory(protocol.ServerFactory):
         :return: a boolean
         """
         if self.bind_cache is not None:
-            return self.bind_cache.is_cached(dn, app_marker, password)
+            cached = self.bind_cache.is_cached(dn, app_marker, password)
+            self.metrics.bind_cache_lookups['hit' if cached else 'miss'] += 1
+            return cached
         else:
             return False
 
@@ -465,29 +1533,112 @@ class ProxyServerFactory(protocol.ServerFactory):
 
     def buildProtocol(self, addr):
         """
-        called by Twisted for each new incoming connection.
+        called by Twisted for each new incoming connection. If a connection limit has been reached or load
+        is shed because the reactor lags behind (see ``loadshedding``), return None, which closes the connection.
         """
+        if self.lag_monitor.reject_connections:
+            self.lag_monitor.rejected_connections += 1
+            return None
+        if not self.session_limits.admit(getattr(addr, 'host', None)):
+            return None
         proto = self.protocol()
-        client_connector = partial(
-                            connectToLDAPEndpoint,
-                            reactor,
-                            self.proxied_endpoint_string,
-                            LDAPClient)
         proto.factory = self
-        proto.clientConnector = client_connector
         return proto
 
+    def startFactory(self):
+        """
+        Called by Twisted once the proxy has started listening. Start monitoring the lag of the reactor.
+        """
+        self.lag_monitor.start()
+
+    def stopFactory(self):
+        """
+        Called by Twisted once the proxy has stopped listening, i.e. on shutdown. Drain the client sessions:
+        Each session is closed once its operations have completed, and all sessions are aborted after
+        the ``drain`` deadline. Afterwards, stop the health checks of the LDAP backends, close all idle
+        connections of the connection pool and all shared connections, and export the remaining spans.
+        ``stopped`` fires once this is done.
+        """
+        self.lag_monitor.stop()
+        self.stopped = self.session_limits.drain(self.timeouts['drain'])
+        self.stopped.addCallback(self._release_backends)
+
+    def _release_backends(self, _=None):
+        for route in self.routes:
+            route.backends.stop_health_checks()
+        self.session_limits.close()
+        if self.backend_pool is not None:
+            self.backend_pool.close()
+        if self.shared_connections is not None:
+            self.shared_connections.close()
+        self.slow_log.close()
+        deferreds = [self.profiler.stop(), self.tracer.close()]
+        if self.http_pool is not None:
+            deferreds.append(self.http_pool.closeCachedConnections())
+        return defer.gatherResults(deferreds)
+
+    def warm_up(self):
+        """
+        Start warming up the connections to the LDAP backends and to privacyIDEA (see ``startup.Warmup``).
+        :return: a list of Deferreds, one for each task
+        """
+        config = self.config
+        tasks = []
+        if config['ldap-backend']['test-connection']:
+            for route in self.routes:
+                tasks.append(route.backends.check_health(partial(self.test_connection, route=route)))
+        if self.shared_connections is not None:
+            tasks.append(self.shared_connections.connect_all())
+        if self.backend_pool is not None and config['startup']['fill-pool']:
+            tasks.append(self.backend_pool.fill())
+        for _ in range(config['privacyidea']['keep-alive-connections']):
+            tasks.append(self.connect_privacyidea())
+        return tasks
+
+    def connect_privacyidea(self):
+        """
+        Open a connection to privacyIDEA by requesting the start page, so that the connection is kept alive
+        for the next request (see ``[privacyidea] keep-alive-connections``).
+        :return: a Deferred which fires once the response has been read
+        """
+        d = self.agent.request(b'GET', self.privacyidea_instance.encode('utf-8'),
+                               Headers({'User-Agent': ['privacyIDEA-LDAP-Proxy']}))
+        d.addCallback(readBody)
+        return self.with_deadline(d, 'privacyidea')
+
+    def connect_backend(self):
+        """
+        Make a new connection to one of the LDAP backend servers
+        :return: A Deferred that fires a `LDAPClient` instance
+        """
+        return self.backends.connect()
+
+    def connect_session_backend(self):
+        """
+        Get a connection to one of the LDAP backend servers for a client session. If the connection pool
+        is enabled, the connection is acquired from the pool.
+        :return: A Deferred that fires a `LDAPClient` instance
+        """
+        if self.backend_pool is not None:
+            return self.backend_pool.acquire()
+        return self.connect_backend()
+
     @defer.inlineCallbacks
-    def test_connection(self):
+    def test_connection(self, backend=None, route=None):
         """
-        Connect to the LDAP backend using an anonymous bind and unbind after that.
+        Connect to the LDAP backend using the service account and unbind after that.
+        This is also used as the health check of the LDAP backends.
+        :param backend: test this specific ``Backend``. If None, pick one of the backends of the route.
+        :param route: ``Route`` of the backend. If None, use the default route.
         :return: a Deferred that fires True or False
         """
+        endpoint = backend.endpoint if backend is not None else None
         try:
-            client = yield self.connect_service_account()
-            yield client.unbind()
-            log.info('Successfully tested the connection to the LDAP backend using the service account')
+            client = yield self.connect_service_account(backend, route)
+            self.unbind(client)
+            log.info('Successfully tested the connection to the LDAP backend {endpoint!r} using the service account',
+                     endpoint=endpoint)
             defer.returnValue(True)
         except Exception as e:
-            log.failure('Could not connect to LDAP backend', exception=e)
+            log.failure('Could not connect to LDAP backend {endpoint!r}', exception=e, endpoint=endpoint)
             defer.returnValue(False)
@@ -0,0 +1,156 @@
+"""
+Forwarding of LDAP response PDUs without decoding them.
+
+Usually, every response of the LDAP backend is BER-decoded into ldaptor objects and encoded again
+before it is sent to the client. For search result entries, this is unnecessary: The proxy only needs
+to know their DN. ``RawForwardingLDAPClient`` allows to register a handler which receives the raw PDUs
+of search result entries of a specific request. Only the outer message header, the tag of the protocol
+operation and (on demand) the ``objectName`` are parsed. ``rewrite_message_id`` then replaces the
+message ID of the PDU, which amounts to copying the PDU once.
+"""
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.ldap.ldapclient import LDAPClient
+from twisted.internet import defer
+
+#: BER tag of a ``LDAPSearchResultEntry`` on the wire (structured, application class)
+SEARCH_RESULT_ENTRY_TAG = pureldap.LDAPSearchResultEntry.tag | pureber.STRUCTURED
+#: BER tag of the LDAPMessage sequence
+SEQUENCE_TAG = pureber.BERSequence.tag | pureber.STRUCTURED
+
+
+def _read_length(data, offset):
+    """
+    Read a BER length at *offset*.
+    :return: a tuple ``(length, offset of the content)``, or None if *data* is incomplete
+    """
+    if offset >= len(data):
+        return None
+    first = data[offset]
+    if first < 0x80:
+        return first, offset + 1
+    count = first & 0x7f
+    if offset + 1 + count > len(data):
+        return None
+    return int.from_bytes(data[offset + 1:offset + 1 + count], 'big'), offset + 1 + count
+
+
+def pdu_end(data, offset=0):
+    """
+    Determine the end of the PDU starting at *offset*.
+    :param data: bytes
+    :return: the offset after the PDU, or None if *data* does not contain the complete PDU
+    """
+    result = _read_length(data, offset + 1)
+    if result is None:
+        return None
+    length, content = result
+    if content + length > len(data):
+        return None
+    return content + length
+
+
+def peek_message(data, offset=0):
+    """
+    Parse the header of the complete LDAPMessage PDU starting at *offset*.
+    :param data: bytes
+    :return: a tuple ``(message ID, tag of the protocol operation, offset of the protocol operation)``
+    """
+    if data[offset] != SEQUENCE_TAG:
+        raise ValueError('Not an LDAPMessage: tag {!r}'.format(data[offset]))
+    length, content = _read_length(data, offset + 1)
+    if data[content] != pureber.BERInteger.tag:
+        raise ValueError('Invalid message ID: tag {!r}'.format(data[content]))
+    id_length, id_content = _read_length(data, content + 1)
+    op_offset = id_content + id_length
+    message_id = int.from_bytes(data[id_content:op_offset], 'big', signed=True)
+    return message_id, data[op_offset], op_offset
+
+
+def peek_object_name(pdu, op_offset):
+    """
+    Extract the ``objectName`` of a search result entry PDU without decoding its attributes.
+    :param pdu: bytes or memoryview of a complete PDU
+    :param op_offset: offset of the protocol operation in *pdu*, as returned by ``peek_message``
+    :return: the DN as bytes
+    """
+    op_length, op_content = _read_length(pdu, op_offset + 1)
+    name_length, name_content = _read_length(pdu, op_content + 1)
+    return bytes(pdu[name_content:name_content + name_length])
+
+
+def rewrite_message_id(pdu, op_offset, message_id):
+    """
+    Replace the message ID of a PDU.
+    :param pdu: bytes or memoryview of a complete PDU
+    :param op_offset: offset of the protocol operation in *pdu*, as returned by ``peek_message``
+    :param message_id: the new message ID
+    :return: the new PDU as bytes
+    """
+    encoded_id = pureber.BERInteger(message_id).toWire()
+    body_length = len(encoded_id) + len(pdu) - op_offset
+    return bytes([SEQUENCE_TAG]) + pureber.int2berlen(body_length) + encoded_id + pdu[op_offset:]
+
+
+class RawForwardingLDAPClient(LDAPClient):
+    """
+    ``LDAPClient`` which passes raw search result entry PDUs to a handler instead of decoding them,
+    see ``send_multiResponse_raw``. As long as no such handler is registered, this behaves like ``LDAPClient``.
+    """
+    def __init__(self):
+        LDAPClient.__init__(self)
+        #: Map of message IDs to raw handlers
+        self.raw_handlers = {}
+
+    def send_multiResponse_raw(self, op, raw_handler, handler, *args, **kwargs):
+        """
+        Like ``send_multiResponse``, but search result entries are passed to *raw_handler* as raw PDUs.
+        :param raw_handler: a callable which is called with a memoryview of the PDU and the offset
+        of the protocol operation. It returns True if it has consumed the entry. Otherwise,
+        the entry is decoded and passed to *handler* as usual.
+        """
+        return self._send_raw(op, None, False, raw_handler, handler, args, kwargs)
+
+    def send_multiResponse_raw_ex(self, op, controls, raw_handler, handler, *args, **kwargs):
+        """
+        Like ``send_multiResponse_ex``, but search result entries are passed to *raw_handler* as raw PDUs
+        (see ``send_multiResponse_raw``).
+        """
+        return self._send_raw(op, controls, True, raw_handler, handler, args, kwargs)
+
+    def _send_raw(self, op, controls, return_controls, raw_handler, handler, args, kwargs):
+        msg = self._send(op, controls=controls)
+        assert op.needs_answer
+        d = defer.Deferred()
+        self.onwire[msg.id] = (d, return_controls, handler, args, kwargs)
+        self.raw_handlers[msg.id] = raw_handler
+        self.transport.write(msg.toWire())
+        return d
+
+    def dataReceived(self, recd):
+        if not self.raw_handlers:
+            return LDAPClient.dataReceived(self, recd)
+        buffer = self.buffer + recd
+        view = memoryview(buffer)
+        offset = 0
+        while True:
+            end = pdu_end(buffer, offset)
+            if end is None:
+                break
+            message_id, op_tag, op_offset = peek_message(buffer, offset)
+            raw_handler = self.raw_handlers.get(message_id)
+            if raw_handler is None or op_tag != SEARCH_RESULT_ENTRY_TAG \
+                    or not raw_handler(view[offset:end], op_offset - offset):
+                o, length = pureber.berDecodeObject(self.berdecoder, buffer[offset:end])
+                self.handle(o)
+            offset = end
+        self.buffer = buffer[offset:]
+
+    def handle(self, msg):
+        LDAPClient.handle(self, msg)
+        if msg.id not in self.onwire:
+            self.raw_handlers.pop(msg.id, None)
+
+    def connectionLost(self, reason=None):
+        self.raw_handlers.clear()
+        LDAPClient.connectionLost(self, reason)
+
@@ -1,10 +1,11 @@
 from ldaptor.protocols.pureldap import LDAPFilter_and, LDAPFilter_or, LDAPFilter_equalityMatch, LDAPSearchRequest, \
     LDAPSearchResultEntry
 from twisted.internet import defer
-from twisted.logger import Logger
 from six import ensure_str
 
-log = Logger()
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
 
 
 def find_app_marker(filter, attribute='objectclass', value_prefix='App-'):
@@ -25,15 +26,50 @@ def find_app_marker(filter, attribute='objectclass', value_prefix='App-'):
             if app_marker:
                 return app_marker
     elif isinstance(filter, LDAPFilter_equalityMatch):
-        # check attribute name and value prefix
-        if ensure_str(filter.attributeDesc.value).lower() == attribute.lower():
-            value = ensure_str(filter.assertionValue.value)
-            if value.startswith(value_prefix):
-                return value[len(value_prefix):]
+        return _marker_of_clause(filter, attribute, value_prefix)
+    return None
+
+
+def _marker_of_clause(filter, attribute, value_prefix):
+    """
+    Given an ldaptor equality match filter, check attribute name and value prefix and return the app marker.
+    :return: None or an app marker (a string)
+    """
+    if ensure_str(filter.attributeDesc.value).lower() == attribute.lower():
+        value = ensure_str(filter.assertionValue.value)
+        if value.startswith(value_prefix):
+            return value[len(value_prefix):]
     return None
 
 
-def detect_login_preamble(request, response, attribute='objectclass', value_prefix='App-'):
+def strip_app_marker(filter, attribute='objectclass', value_prefix='App-'):
+    """
+    Given an ldaptor filter, remove app marker expressions (see ``find_app_marker``) from |() expressions
+    which contain other expressions as well, e.g. turn (|(objectclass=*)(objectclass=App-ownCloud))
+    into (objectclass=*). Assuming that no entry actually matches the app marker expression, this does not
+    change the semantics of the filter. Other app marker expressions (e.g. in &() expressions) are kept.
+    :param filter: ldaptor filter
+    :param attribute: see ``find_app_marker``
+    :param value_prefix: see ``find_app_marker``
+    :return: the given filter if nothing has been removed, or a new filter
+    """
+    if isinstance(filter, LDAPFilter_and) or isinstance(filter, LDAPFilter_or):
+        subfilters = [strip_app_marker(subfilter, attribute, value_prefix) for subfilter in filter]
+        if isinstance(filter, LDAPFilter_or):
+            remaining = [subfilter for subfilter in subfilters
+                         if not (isinstance(subfilter, LDAPFilter_equalityMatch)
+                                 and _marker_of_clause(subfilter, attribute, value_prefix) is not None)]
+            if remaining:
+                subfilters = remaining
+        if len(subfilters) == len(filter.data) and all(new is old for new, old in zip(subfilters, filter)):
+            return filter
+        if len(subfilters) == 1 and isinstance(filter, LDAPFilter_or):
+            return subfilters[0]
+        return filter.__class__(subfilters)
+    return filter
+
+
+def detect_login_preamble(request, response, attribute='objectclass', value_prefix='App-', marker=None):
     """
     Determine whether the request/response pair constitutes a login preamble.
     If it does, return the login DN and the app marker.
@@ -41,11 +77,14 @@ def detect_login_preamble(request, response, attribute='objectclass', value_pref
     :param response: LDAP response
     :param attribute: see ``find_app_marker``
     :param value_prefix: see ``find_app_marker``
+    :param marker: app marker which has been found in the request filter before it has been
+    stripped (see ``strip_app_marker``). If None, search the request filter.
     :return: A tuple ``(DN, app marker)`` or None
     """
     if isinstance(request, LDAPSearchRequest) and request.filter:
         # TODO: Check base dn?
-        marker = find_app_marker(request.filter, attribute, value_prefix)
+        if marker is None:
+            marker = find_app_marker(request.filter, attribute, value_prefix)
         # i.e. we do not notice if the response has >1 entries
         if marker is not None and isinstance(response, LDAPSearchResultEntry):
             return (response.objectName, marker)
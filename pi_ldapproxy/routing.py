@@ -0,0 +1,83 @@
+import re
+
+#: Matches commas which separate two RDNs, i.e. which are not escaped using a backslash
+RDN_SEPARATOR = re.compile(r'(?<!\\),')
+
+
+def split_dn(dn):
+    """
+    Split a distinguished name into its normalized RDNs, i.e. in lowercase and without
+    surrounding whitespace.
+    :param dn: Distinguished Name as string
+    :return: a list of strings
+    """
+    if not dn.strip():
+        return []
+    return [rdn.strip().lower() for rdn in RDN_SEPARATOR.split(dn)]
+
+
+class Route(object):
+    """
+    Sessions whose DN ends with ``suffix`` are routed to ``backends`` and use the given service account.
+    """
+    def __init__(self, name, suffix, backends, service_account_dn, service_account_password):
+        """
+        :param name: name of the route, used for logging
+        :param suffix: DN suffix as string, or None for the default route
+        :param backends: ``BackendSet`` instance
+        :param service_account_dn: DN of the service account as string
+        :param service_account_password: Password of the service account as string
+        """
+        self.name = name
+        self.suffix = suffix
+        self.backends = backends
+        self.service_account_dn = service_account_dn
+        self.service_account_password = service_account_password
+
+    def __repr__(self):
+        return '<Route {!r} ({!r})>'.format(self.name, self.suffix)
+
+
+class RoutingTable(object):
+    """
+    Maps distinguished names to routes by their longest matching suffix.
+    The suffixes are compiled into a dictionary which maps tuples of normalized RDNs to routes,
+    so a lookup takes one dictionary access per RDN of the DN.
+    """
+    def __init__(self, routes, default):
+        """
+        :param routes: list of ``Route`` instances
+        :param default: ``Route`` which is used if no suffix matches
+        """
+        self.routes = list(routes)
+        self.default = default
+        self._table = {}
+        for route in self.routes:
+            key = tuple(split_dn(route.suffix))
+            if not key:
+                raise ValueError('Route {!r} has an empty suffix'.format(route.name))
+            if key in self._table:
+                raise ValueError('Routes {!r} and {!r} have the same suffix'.format(self._table[key].name,
+                                                                                    route.name))
+            self._table[key] = route
+
+    def route_for(self, dn):
+        """
+        :param dn: Distinguished Name as string
+        :return: the ``Route`` with the longest suffix matching *dn*, or the default route
+        """
+        if self._table:
+            rdns = tuple(split_dn(dn))
+            for start in range(len(rdns)):
+                route = self._table.get(rdns[start:])
+                if route is not None:
+                    return route
+        return self.default
+
+    def __iter__(self):
+        """
+        Iterate over all routes, including the default route.
+        """
+        yield self.default
+        for route in self.routes:
+            yield route
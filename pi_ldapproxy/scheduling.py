@@ -0,0 +1,148 @@
+"""
+Priority scheduling of the incoming operations.
+
+Under overload, user binds which wait for privacyIDEA may occupy the proxy, the LDAP backends and privacyIDEA
+to the point that applications cannot even look up their users anymore. If ``[scheduling] max-concurrent``
+is set, at most that many operations are processed at a time, across all sessions. Further operations are
+queued in one of three priority classes, and are started in the order of their classes:
+
+ 1. ``passthrough``: passthrough binds and all operations of sessions which have issued a passthrough bind
+ 2. ``service-account``: operations of sessions which have authenticated via privacyIDEA, i.e. which use the
+    service account (e.g. searches of applications)
+ 3. ``user``: user binds (which are validated by privacyIDEA) and all other operations
+
+Within each class, the source IP addresses take turns, so a single host cannot starve the other hosts of its
+class by flooding the proxy with operations. An operation occupies its slot until its final response has
+been sent, or until the client has disconnected.
+"""
+from collections import OrderedDict, deque
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+#: Priority classes, from the highest priority to the lowest
+PRIORITY_PASSTHROUGH = 0
+PRIORITY_SERVICE_ACCOUNT = 1
+PRIORITY_USER = 2
+#: Names of the priority classes, e.g. for metrics
+PRIORITY_CLASSES = ('passthrough', 'service-account', 'user')
+
+
+class PriorityScheduler(object):
+    """
+    Limits the number of concurrent operations to ``max_concurrent`` and queues further operations
+    by priority class and source IP. Scheduling is disabled as long as ``max_concurrent`` is 0.
+    """
+    def __init__(self, max_concurrent=0, max_queued=0):
+        #: One queue per priority class: Map of source IPs to queues of tuples ``(session, start)``.
+        #: The IP which is served next comes first.
+        self._queues = [OrderedDict() for _ in PRIORITY_CLASSES]
+        #: Map of sessions to the sets of tokens of their running operations
+        self._running = {}
+        #: Number of running operations
+        self.running = 0
+        #: Number of queued operations
+        self.queued = 0
+        #: Number of operations which have been rejected because the queue was full
+        self.rejected = 0
+        self.configure(max_concurrent, max_queued)
+
+    def configure(self, max_concurrent=0, max_queued=0):
+        """
+        Change the limits, e.g. after the configuration has been reloaded. Queued operations are started
+        if the new limits allow it.
+        :param max_concurrent: maximum number of concurrent operations, or 0 to disable scheduling
+        :param max_queued: maximum number of queued operations, or 0 for no limit
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self._dispatch()
+
+    @property
+    def enabled(self):
+        return bool(self.max_concurrent)
+
+    def queued_by_class(self):
+        """
+        :return: list of tuples ``(class name, number of queued operations)``
+        """
+        return [(name, sum(len(jobs) for jobs in queue.values()))
+                for name, queue in zip(PRIORITY_CLASSES, self._queues)]
+
+    def submit(self, session, priority, host, start, reject):
+        """
+        Start an operation of *session* as soon as a slot is free and no operations of higher priority (or of
+        other hosts which are next in turn) are waiting.
+        :param session: the session which has issued the operation (see ``forget``)
+        :param priority: one of the ``PRIORITY_*`` constants
+        :param host: source IP of the session, or None
+        :param start: A callable which starts the operation. It is passed a callable which must be invoked
+        once the operation has completed, in order to free its slot.
+        :param reject: A callable which is invoked instead of *start* if the queue is full
+        """
+        if not self.max_concurrent or (self.running < self.max_concurrent and not self.queued):
+            self._start(session, start)
+        elif self.max_queued and self.queued >= self.max_queued:
+            log.warn('Rejecting operation from {host!r}: {count!r} operations queued', host=host, count=self.queued)
+            self.rejected += 1
+            reject()
+        else:
+            queue = self._queues[priority]
+            jobs = queue.get(host)
+            if jobs is None:
+                jobs = queue[host] = deque()
+            jobs.append((session, start))
+            self.queued += 1
+
+    def _start(self, session, start):
+        token = object()
+        self._running.setdefault(session, set()).add(token)
+        self.running += 1
+        start(lambda: self._release(session, token))
+
+    def _release(self, session, token):
+        tokens = self._running.get(session)
+        # The slot may have been freed already (see ``forget``)
+        if tokens is None or token not in tokens:
+            return
+        tokens.remove(token)
+        if not tokens:
+            del self._running[session]
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Start queued operations as long as slots are free.
+        """
+        while self.queued and (not self.max_concurrent or self.running < self.max_concurrent):
+            queue = next(queue for queue in self._queues if queue)
+            host, jobs = next(iter(queue.items()))
+            session, start = jobs.popleft()
+            if jobs:
+                # It is the turn of the next host
+                queue.move_to_end(host)
+            else:
+                del queue[host]
+            self.queued -= 1
+            self._start(session, start)
+
+    def forget(self, session):
+        """
+        Drop the queued operations of *session* and free the slots of its running operations,
+        e.g. once the client has disconnected.
+        """
+        for queue in self._queues:
+            for host, jobs in list(queue.items()):
+                if any(job[0] is session for job in jobs):
+                    remaining = deque(job for job in jobs if job[0] is not session)
+                    self.queued -= len(jobs) - len(remaining)
+                    if remaining:
+                        queue[host] = remaining
+                    else:
+                        del queue[host]
+        tokens = self._running.pop(session, None)
+        if tokens:
+            self.running -= len(tokens)
+            self._dispatch()
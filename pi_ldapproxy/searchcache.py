@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+from six import ensure_str
+from twisted.internet import reactor
+
+from pi_ldapproxy.logs import GatedLogger
+from pi_ldapproxy.routing import split_dn
+
+log = GatedLogger()
+
+
+def search_cache_key(identity, request, controls):
+    """
+    Build the search cache key of a search request.
+    :param identity: Identity which the connection to the LDAP backend is bound as (any hashable object)
+    :param request: ``LDAPSearchRequest``
+    :param controls: List of tuples ``(controlType, criticality, controlValue)`` or None
+    :return: a hashable tuple
+    """
+    return (
+        identity,
+        ','.join(split_dn(ensure_str(request.baseObject))),
+        request.scope,
+        request.derefAliases,
+        request.sizeLimit,
+        request.timeLimit,
+        request.typesOnly,
+        request.filter.toWire(),
+        tuple(sorted(ensure_str(attribute).lower() for attribute in request.attributes)),
+        tuple(tuple(control) for control in controls or ()),
+    )
+
+
+class SearchCache(object):
+    """
+    The search cache stores the responses to search requests which have been forwarded to the LDAP backend,
+    so that identical search requests issued in the context of the same identity can be answered without
+    contacting the LDAP backend. Entries expire after ``timeout`` seconds. The total size of the cached
+    responses (in BER-encoded bytes) is limited by ``max_size``; if it is exceeded, the least recently used
+    entries are evicted.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    seconds = reactor.seconds
+
+    def __init__(self, timeout, max_size):
+        """
+        :param timeout: Number of seconds after which an entry expires
+        :param max_size: Maximum total size of all entries in bytes
+        """
+        self.timeout = timeout
+        self.max_size = max_size
+        #: Map of keys to tuples (responses, size, insertion timestamp), in order of their last use
+        self._entries = OrderedDict()
+        #: Total size of all entries in bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up the responses stored for the given key.
+        :param key: key as returned by ``search_cache_key``
+        :return: a list of responses, or None if there is no valid entry
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            responses, size, timestamp = entry
+            if self.seconds() - timestamp < self.timeout:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return responses
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def add(self, key, responses, size):
+        """
+        Store the responses for the given key, evicting the least recently used entries if necessary.
+        Responses which are larger than ``max_size`` are not stored.
+        :param key: key as returned by ``search_cache_key``
+        :param responses: list of ``LDAPSearchResultEntry``, ``LDAPSearchResultReference``
+        and ``LDAPSearchResultDone`` objects
+        :param size: size of the responses in bytes
+        :return: True if the responses have been stored
+        """
+        if size > self.max_size:
+            log.info('Not adding {size!r} bytes to search cache', size=size)
+            return False
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (responses, size, self.seconds())
+        self.size += size
+        while self.size > self.max_size:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+        return True
+
+    def _remove(self, key):
+        responses, size, timestamp = self._entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        self._entries.clear()
+        self.size = 0
@@ -0,0 +1,83 @@
+import signal
+
+from twisted.application import internet
+from twisted.internet import reactor
+
+from pi_ldapproxy.config import ConfigError, read_config
+from pi_ldapproxy.logs import GatedLogger
+from pi_ldapproxy.startup import report_ready, sd_notify
+
+log = GatedLogger()
+
+
+def install_signal_handler(signum, callback):
+    """
+    Invoke *callback* in the reactor thread whenever the process receives the signal *signum*.
+    :return: the previous signal handler
+    """
+    # Signal handlers may interrupt the reactor at any point
+    return signal.signal(signum, lambda received, frame: reactor.callFromThread(callback))
+
+
+def reload_config(factory, filename):
+    """
+    Read the configuration file *filename* and apply it to the ``ProxyServerFactory`` *factory*
+    (see ``ProxyServerFactory.apply_config``). If the configuration is invalid, the errors are logged
+    and the current configuration is kept.
+    :return: a boolean specifying whether the configuration has been reloaded
+    """
+    log.info('Reloading configuration from {filename!r} ...', filename=filename)
+    try:
+        config = read_config(filename)
+        if config['ldap-proxy']['endpoint'] != factory.config['ldap-proxy']['endpoint']:
+            log.warn('Changing the endpoint of the LDAP proxy requires a restart')
+        factory.apply_config(config)
+    except ConfigError as e:
+        log.error('Not reloading invalid configuration: {errors}', errors='; '.join(e.errors))
+        return False
+    except Exception as e:
+        log.failure('Could not apply configuration, keeping the current configuration', exception=e)
+        return False
+    log.info('Reloaded configuration')
+    return True
+
+
+class ProxyService(internet.StreamServerEndpointService):
+    """
+    Serves a ``ProxyServerFactory`` on an endpoint. Stopping the service stops listening and waits until
+    the client sessions have been drained (see ``ProxyServerFactory.stopFactory``). If *config_filename*
+    is given, the configuration is reloaded from this file on ``reload_signal``. On ``profile_signal``,
+    a profiling session is started (see ``profiling.Profiler``). Once the proxy has started, it warms up
+    its connections and then notifies systemd that it is ready (see ``startup``).
+    """
+    reload_signal = signal.SIGHUP
+    profile_signal = signal.SIGTTIN
+
+    def __init__(self, endpoint, factory, config_filename=None):
+        internet.StreamServerEndpointService.__init__(self, endpoint, factory)
+        self.config_filename = config_filename
+        #: Map of signals to the signal handlers which have been replaced
+        self._previous_handlers = {}
+        #: Deferred which fires once the warm-up has completed, or None
+        self.warmed_up = None
+
+    def startService(self):
+        internet.StreamServerEndpointService.startService(self)
+        if self.config_filename is not None and self.reload_signal is not None:
+            self._previous_handlers[self.reload_signal] = install_signal_handler(self.reload_signal, self.reload)
+        if self.profile_signal is not None:
+            self._previous_handlers[self.profile_signal] = install_signal_handler(self.profile_signal,
+                                                                                  self.factory.profiler.start)
+        self.warmed_up = self.factory.warmup.run(self.factory.config['startup']['timeout'])
+        self.warmed_up.addCallback(lambda _: report_ready())
+
+    def reload(self):
+        return reload_config(self.factory, self.config_filename)
+
+    def stopService(self):
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers.clear()
+        sd_notify('STOPPING=1')
+        d = internet.StreamServerEndpointService.stopService(self)
+        return d.addCallback(lambda _: self.factory.stopped)
@@ -0,0 +1,185 @@
+from twisted.internet import defer, reactor
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+
+def peer_host(transport):
+    """
+    :return: the host of the peer of *transport*, or None if it has no host (e.g. for UNIX sockets)
+    """
+    return getattr(transport.getPeer(), 'host', None)
+
+
+class SessionLimits(object):
+    """
+    Keeps track of all client sessions in order to enforce the connection limits and session timeouts:
+
+     * At most ``max_connections`` sessions in total and ``max_connections_per_ip`` sessions per
+       source IP are admitted (see ``admit``).
+     * Sessions without outstanding operations are closed after ``idle_timeout`` seconds of inactivity.
+     * Sessions which have not completed a successful bind ``bind_timeout`` seconds after connecting are closed.
+     * Sessions are closed ``max_lifetime`` seconds after connecting.
+
+    A limit or timeout of 0 disables it. Instead of scheduling timers for each session, one sweep runs every
+    ``sweep_interval`` seconds while sessions are open, so timeouts are enforced with that granularity.
+
+    On shutdown, ``drain`` closes the sessions once their operations have completed.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = reactor.seconds
+    sweep_interval = 1
+
+    def __init__(self, max_connections=0, max_connections_per_ip=0, idle_timeout=0, bind_timeout=0,
+                 max_lifetime=0):
+        #: Map of sessions to their source IP (or None)
+        self._sessions = {}
+        #: Map of source IPs to the number of their sessions
+        self._per_ip = {}
+        #: DelayedCall of the next sweep, or None
+        self._sweep_call = None
+        #: Number of connections which have been rejected because of a connection limit
+        self.rejected = 0
+        #: Time at which all remaining sessions are aborted, or None if the sessions are not drained
+        self.drain_deadline = None
+        self._drained = []
+        self.configure(max_connections, max_connections_per_ip, idle_timeout, bind_timeout, max_lifetime)
+
+    def configure(self, max_connections=0, max_connections_per_ip=0, idle_timeout=0, bind_timeout=0,
+                  max_lifetime=0):
+        """
+        Change the limits and timeouts, e.g. after the configuration has been reloaded. Open sessions are kept
+        (even if they exceed a connection limit), but the new timeouts apply to them.
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.idle_timeout = idle_timeout
+        self.bind_timeout = bind_timeout
+        self.max_lifetime = max_lifetime
+        self._schedule_sweep()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def has_timeouts(self):
+        return bool(self.idle_timeout or self.bind_timeout or self.max_lifetime)
+
+    def admit(self, host):
+        """
+        Check whether a new connection from *host* may be accepted.
+        :param host: source IP as string, or None
+        :return: a boolean
+        """
+        if self.drain_deadline is not None:
+            log.info('Rejecting connection from {host!r}: shutting down', host=host)
+            return False
+        if self.max_connections and len(self._sessions) >= self.max_connections:
+            log.warn('Rejecting connection from {host!r}: {count!r} connections open',
+                     host=host, count=len(self._sessions))
+        elif self.max_connections_per_ip and host is not None \
+                and self._per_ip.get(host, 0) >= self.max_connections_per_ip:
+            log.warn('Rejecting connection from {host!r}: {count!r} connections open from this address',
+                     host=host, count=self._per_ip[host])
+        else:
+            return True
+        self.rejected += 1
+        return False
+
+    def register(self, session, host):
+        """
+        Start tracking *session*, which has connected from *host*. The session must provide the attributes
+        ``connected_at``, ``last_activity`` and ``authenticated`` and the methods ``is_idle`` and
+        ``close_session`` (which is passed whether the connection should be aborted).
+        """
+        self._sessions[session] = host
+        if host is not None:
+            self._per_ip[host] = self._per_ip.get(host, 0) + 1
+        self._schedule_sweep()
+
+    def unregister(self, session):
+        """
+        Stop tracking *session* once it has disconnected. Unknown sessions are ignored.
+        """
+        if session not in self._sessions:
+            return
+        host = self._sessions.pop(session)
+        if host is not None:
+            count = self._per_ip[host] - 1
+            if count:
+                self._per_ip[host] = count
+            else:
+                del self._per_ip[host]
+        if not self._sessions:
+            if self._sweep_call is not None:
+                self._sweep_call.cancel()
+                self._sweep_call = None
+            self._fire_drained()
+
+    def _schedule_sweep(self):
+        if self._sweep_call is None and self._sessions and (self.has_timeouts or self.drain_deadline is not None):
+            self._sweep_call = self.callLater(self.sweep_interval, self.sweep)
+
+    def drain(self, timeout):
+        """
+        Close every session as soon as it has no outstanding operations. Sessions which are still
+        open after *timeout* seconds are aborted. New sessions should not be admitted anymore.
+        :param timeout: number of seconds, or 0 to close all sessions right away
+        :return: a Deferred which fires once all sessions have been closed
+        """
+        d = defer.Deferred()
+        self._drained.append(d)
+        if self.drain_deadline is None:
+            log.info('Draining {count!r} sessions ...', count=len(self._sessions))
+            self.drain_deadline = self.seconds() + timeout
+            self.sweep()
+        self._fire_drained()
+        return d
+
+    def _fire_drained(self):
+        if self._drained and not self._sessions:
+            drained, self._drained = self._drained, []
+            for d in drained:
+                d.callback(None)
+
+    def sweep(self):
+        """
+        Close all sessions which have exceeded one of the timeouts.
+        """
+        self._sweep_call = None
+        now = self.seconds()
+        expired = []
+        for session in self._sessions:
+            reason = self._expiry_reason(session, now)
+            if reason is not None:
+                expired.append((session, reason))
+        abort = self.drain_deadline is not None and now >= self.drain_deadline
+        for session, reason in expired:
+            log.info('Closing session from {host!r}: {reason}', host=self._sessions[session], reason=reason)
+            # This might unregister the session right away
+            session.close_session(abort)
+        self._schedule_sweep()
+
+    def _expiry_reason(self, session, now):
+        if self.drain_deadline is not None:
+            if now >= self.drain_deadline:
+                return 'shutting down, operations have not completed in time'
+            elif session.is_idle():
+                return 'shutting down'
+        if self.max_lifetime and now - session.connected_at >= self.max_lifetime:
+            return 'maximum session lifetime exceeded'
+        if self.bind_timeout and not session.authenticated and now - session.connected_at >= self.bind_timeout:
+            return 'no successful bind'
+        if self.idle_timeout and now - session.last_activity >= self.idle_timeout and session.is_idle():
+            return 'idle'
+        return None
+
+    def close(self):
+        """
+        Stop sweeping, e.g. on shutdown.
+        """
+        if self._sweep_call is not None:
+            self._sweep_call.cancel()
+            self._sweep_call = None
@@ -0,0 +1,189 @@
+"""
+Log of slow operations.
+
+Binds and searches which take at least ``threshold`` seconds are recorded, along with the details needed to
+find out why they were slow (e.g. the duration of each phase of a bind). The proxy only takes a few timestamps
+per operation (see ``TwoFactorAuthenticationProxy.authenticate_bind_request``), records are only built once
+an operation has turned out to be slow.
+
+Records are appended as JSON lines to a file, or logged in the ``pi_ldapproxy.slowlog`` namespace if no
+file has been configured.
+"""
+import json
+import time
+
+from ldaptor.protocols import pureldap
+from six import ensure_str
+
+from pi_ldapproxy.logs import GatedLogger
+from pi_ldapproxy.metrics import BIND_PHASES
+
+log = GatedLogger()
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+
+_COMPARISON_OPERATORS = {
+    pureldap.LDAPFilter_equalityMatch: '=',
+    pureldap.LDAPFilter_greaterOrEqual: '>=',
+    pureldap.LDAPFilter_lessOrEqual: '<=',
+    pureldap.LDAPFilter_approxMatch: '~=',
+}
+
+
+def _text(value):
+    return ensure_str(value, errors='replace')
+
+
+def filter_text(filter):
+    """
+    Render an ldaptor filter in the string representation of RFC 4515. Unlike ``asText``, this also works
+    for filters which have been decoded from the wire (and thus contain bytes).
+    :param filter: ldaptor filter
+    :return: string
+    """
+    if isinstance(filter, pureldap.LDAPFilter_and):
+        return '(&' + ''.join(filter_text(subfilter) for subfilter in filter) + ')'
+    elif isinstance(filter, pureldap.LDAPFilter_or):
+        return '(|' + ''.join(filter_text(subfilter) for subfilter in filter) + ')'
+    elif isinstance(filter, pureldap.LDAPFilter_not):
+        return '(!' + filter_text(filter.value) + ')'
+    elif isinstance(filter, pureldap.LDAPFilter_present):
+        return '({}=*)'.format(_text(filter.value))
+    elif type(filter) in _COMPARISON_OPERATORS:
+        return '({}{}{})'.format(_text(filter.attributeDesc.value), _COMPARISON_OPERATORS[type(filter)],
+                                 pureldap.escape(_text(filter.assertionValue.value)))
+    elif isinstance(filter, pureldap.LDAPFilter_substrings):
+        initial = final = ''
+        middle = []
+        for substring in filter.substrings:
+            value = pureldap.escape(_text(substring.value))
+            if isinstance(substring, pureldap.LDAPFilter_substrings_initial):
+                initial = value
+            elif isinstance(substring, pureldap.LDAPFilter_substrings_final):
+                final = value
+            else:
+                middle.append(value)
+        return '({}={})'.format(_text(filter.type), '*'.join([initial] + middle + [final]))
+    # e.g. extensible matches
+    return repr(filter)
+
+
+def backend_address(client):
+    """
+    :param client: ``LDAPClient`` instance or None
+    :return: the address of the LDAP backend *client* is connected to (as string), or None
+    """
+    get_peer = getattr(getattr(client, 'transport', None), 'getPeer', None)
+    if get_peer is None:
+        return None
+    peer = get_peer()
+    if hasattr(peer, 'host'):
+        return '{}:{}'.format(peer.host, peer.port)
+    return str(peer)
+
+
+class SlowOperationLog(object):
+    """
+    Records slow operations. The log is disabled as long as ``threshold`` is 0.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    time = time.time
+
+    def __init__(self):
+        self.threshold = 0
+        self.filename = None
+        self._file = None
+
+    def configure(self, threshold=0, filename=None):
+        """
+        Change the settings, e.g. after the configuration has been reloaded.
+        :param threshold: minimum duration of recorded operations in seconds, or 0 to disable the log
+        :param filename: file to which records are appended, or None
+        """
+        self.threshold = threshold
+        if filename != self.filename:
+            self.close()
+            self.filename = filename
+
+    def log_bind(self, proxy, dn, app_marker, realm, user, result, cached, started, boundaries, finished,
+                 error=None):
+        """
+        Record a slow bind handled by ``authenticate_bind_request``.
+        :param proxy: the ``TwoFactorAuthenticationProxy`` of the session
+        :param result: tuple ``(success, message)`` as returned by ``authenticate_bind_request``, or None if
+        the bind has failed with *error*
+        :param cached: whether the credentials were found in the bind cache, or None if this was not checked
+        :param started: timestamp at which the bind has started
+        :param boundaries: tuple of timestamps at which the phases (see ``metrics.BIND_PHASES``) have ended,
+        which are None for phases that have not been completed
+        :param finished: timestamp at which the bind has completed
+        :param error: exception which has caused the bind to fail, or None
+        """
+        phases = {}
+        previous = started
+        for phase, boundary in zip(BIND_PHASES, boundaries):
+            if boundary is not None:
+                phases[phase] = _milliseconds(boundary - previous)
+                previous = boundary
+        if error is not None:
+            outcome, message = 'error', repr(error)
+        elif result[0] is True:
+            outcome, message = 'success', None
+        else:
+            outcome, message = 'failure', result[1]
+        self.write({
+            'operation': 'bind',
+            'duration_ms': _milliseconds(finished - started),
+            'dn': dn,
+            'marker': app_marker,
+            'realm': realm,
+            'user': user,
+            'result': outcome,
+            'message': message,
+            'bind_cache': None if cached is None else 'hit' if cached else 'miss',
+            'phases_ms': phases,
+            'privacyidea': proxy.factory.privacyidea_instance if cached is False else None,
+            'route': proxy.route.name if proxy.route is not None else 'default',
+            'backend': backend_address(proxy.client),
+        })
+
+    def log_search(self, proxy, request, started, finished):
+        """
+        Record a slow search.
+        :param proxy: the ``TwoFactorAuthenticationProxy`` of the session
+        :param request: ``LDAPSearchRequest``
+        :param started: timestamp at which the search has started
+        :param finished: timestamp at which the final response has been sent
+        """
+        self.write({
+            'operation': 'search',
+            'duration_ms': _milliseconds(finished - started),
+            'base': ensure_str(request.baseObject),
+            'scope': request.scope,
+            'filter': filter_text(request.filter),
+            'bound_as': proxy.backend_identity[1] if proxy.backend_identity is not None else None,
+            'route': proxy.route.name if proxy.route is not None else 'default',
+            'backend': backend_address(proxy.client),
+        })
+
+    def write(self, record):
+        """
+        Write the record *record* (a dictionary) to the slow-operation log.
+        """
+        record['time'] = self.time()
+        if self.filename:
+            if self._file is None:
+                self._file = open(self.filename, 'a')
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._file.flush()
+        else:
+            log.warn('Slow {operation}: {record}', operation=record['operation'],
+                     record=json.dumps(record, sort_keys=True))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
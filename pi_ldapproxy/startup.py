@@ -0,0 +1,144 @@
+"""
+Startup phase of the proxy.
+
+The proxy listens for connections right after it has started, while its connections to the LDAP backends and
+to privacyIDEA are still cold. Once the proxy has started, ``Warmup`` runs the following tasks (see
+``ProxyServerFactory.warm_up``) and waits at most ``[startup] timeout`` seconds for them:
+
+ * test the connections to all LDAP backends using the service account (if ``[ldap-backend] test-connection``
+   is set), which also records the health of the backends (see ``backends.BackendSet.check_health``)
+ * establish the shared connections of the service account (if ``multiplex-service-account`` is set)
+ * fill the connection pool (if ``[startup] fill-pool`` is set and ``[ldap-backend] pool-size`` is positive)
+ * open ``[privacyidea] keep-alive-connections`` connections to privacyIDEA, which are kept alive
+
+While the warm-up is in progress, the health endpoint reports that the proxy is not ready (see ``health``).
+Afterwards, the proxy notifies systemd that it is ready (see ``sd_notify``) if it runs as a ``Type=notify``
+service. In worker mode, the supervisor notifies systemd once all workers have warmed up.
+
+The durations of the phases of the startup (importing the modules, reading the configuration and the
+warm-up) are logged once the proxy is ready, and are exported as metrics.
+"""
+import os
+import socket
+import time
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+
+class StartupTimings(object):
+    """
+    Durations of the phases of the startup of this process.
+    """
+    def __init__(self):
+        #: Map of phase names to durations in seconds, in the order of the phases
+        self.phases = OrderedDict()
+
+    def lap(self, phase, started, now=None):
+        """
+        Record that *phase*, which has started at the timestamp *started*, has ended at *now*.
+        :param now: timestamp, or None for the current time
+        :return: *now*, i.e. the start of the next phase
+        """
+        if now is None:
+            now = time.time()
+        self.phases[phase] = now - started
+        return now
+
+    def summary(self):
+        """
+        :return: the durations as a string, e.g. ``imports: 0.412s, configuration: 0.012s``
+        """
+        return ', '.join('{}: {:.3f}s'.format(phase, seconds) for phase, seconds in self.phases.items())
+
+
+#: Durations of the startup phases of this process
+timings = StartupTimings()
+
+
+def sd_notify(state, environ=os.environ):
+    """
+    Send *state* (e.g. ``READY=1``) to systemd, if the process has been started by systemd as a
+    ``Type=notify`` service, i.e. if ``NOTIFY_SOCKET`` is set.
+    :return: whether the notification has been sent
+    """
+    address = environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state.encode('utf-8'))
+    except OSError as e:
+        log.warn('Could not notify systemd: {error!r}', error=e)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class Warmup(object):
+    """
+    Runs the warm-up tasks of a ``ProxyServerFactory`` and waits for them for a bounded time.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    time = time.time
+
+    def __init__(self, factory):
+        self.factory = factory
+        #: Specifies whether the warm-up is in progress
+        self.running = False
+
+    def run(self, timeout):
+        """
+        Start the warm-up tasks. Tasks which have not completed after *timeout* seconds continue in the
+        background, but are not waited for.
+        :param timeout: number of seconds, or 0 to wait for all tasks
+        :return: a Deferred which fires once all tasks have completed or the timeout has passed
+        """
+        self.running = True
+        started = self.time()
+        finished = defer.Deferred()
+        tasks = self.factory.warm_up()
+        log.info('Warming up ({count!r} tasks) ...', count=len(tasks))
+        timeout_call = self.callLater(timeout, self._finish, finished, started, None) if timeout else None
+        d = defer.DeferredList(tasks, consumeErrors=True)
+        d.addCallback(lambda results: self._finish(finished, started, results, timeout_call))
+        return finished
+
+    def _finish(self, finished, started, results, timeout_call=None):
+        if finished.called:
+            return
+        if timeout_call is not None and timeout_call.active():
+            timeout_call.cancel()
+        self.running = False
+        timings.lap('warm-up', started, self.time())
+        if results is None:
+            log.warn('Warm-up has not completed within the timeout, continuing in the background')
+        else:
+            failures = [result for success, result in results if not success]
+            for failure in failures:
+                if failure.check(defer.FirstError):
+                    # Tasks which consist of several connection attempts fail with the first error
+                    failure = failure.value.subFailure
+                log.warn('Warm-up task has failed: {failure!r}', failure=failure.value)
+            log.info('Warm-up has completed ({failed!r} of {count!r} tasks failed)',
+                     failed=len(failures), count=len(results))
+        finished.callback(None)
+
+
+def report_ready(notify=True):
+    """
+    Log the durations of the startup phases and, if *notify* is set, notify systemd that the proxy is ready.
+    """
+    log.info('Ready after {total:.3f}s ({summary})', total=sum(timings.phases.values()), summary=timings.summary())
+    if notify:
+        sd_notify('READY=1')
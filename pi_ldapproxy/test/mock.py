@@ -3,6 +3,7 @@ import json
 import http.client
 from ldaptor import testutil
 from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
 from ldaptor.protocols.ldap.ldapclient import LDAPClient
 from twisted.internet import defer
 from twisted.web.client import Response
@@ -31,6 +32,7 @@ class MockPrivacyIDEA(object):
         self.status = True
         self.response_code = 200
         self.authentication_requests = []
+        self.traceparents = []
 
     def is_password_correct(self, user, realm, password):
         key = '{}@{}'.format(user, realm)
@@ -61,7 +63,8 @@ class MockPrivacyIDEA(object):
         response = MockResponse(b'HTTP/1.1', self.response_code, http.client.responses[self.response_code], headers, body)
         return response
 
-    def authenticate(self, url, user, realm, password):
+    def authenticate(self, url, user, realm, password, traceparent=None):
+        self.traceparents.append(traceparent)
         result = self.is_password_correct(user, realm, password)
         self.authentication_requests.append((user, realm, password, result))
         return defer.succeed(self.build_response(result))
@@ -74,3 +77,23 @@ class MockLDAPClient(testutil.LDAPClientTestDriver):
     def bind(self, dn, auth):
         self.send(pureldap.LDAPBindRequest(dn=dn, auth=auth))
 
+
+class MockPooledLDAPClient(MockLDAPClient):
+    """
+    Used to test the connection pool: As opposed to ``MockLDAPClient``, ``bind`` behaves
+    like ``LDAPClient.bind``, i.e. it returns a Deferred which fails for unsuccessful binds.
+    Additionally, it has an (always empty) ``onwire`` attribute.
+    """
+    def __init__(self, *responses):
+        MockLDAPClient.__init__(self, *responses)
+        self.onwire = {}
+
+    def bind(self, dn, auth):
+        d = self.send(pureldap.LDAPBindRequest(dn=dn, auth=auth))
+
+        def _check_result(response):
+            if response.resultCode != ldaperrors.Success.resultCode:
+                raise ldaperrors.get(response.resultCode, response.errorMessage)
+            return response
+        d.addCallback(_check_result)
+        return d
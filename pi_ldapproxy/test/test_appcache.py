@@ -115,4 +115,15 @@ class TestAppCache(TestCase):
         self.assertEqual(cache.get_cached_marker(DN1), MARKER1)
         # TODO: This is not perfect - find a way to test this without sleeping
         time.sleep(1)
-        self.assertEqual(cache.get_cached_marker(DN1), None)
\ No newline at end of file
+        self.assertEqual(cache.get_cached_marker(DN1), None)
+    def test_entries_with_age(self):
+        cache = AppCache(TIMEOUT, case_insensitive=True)
+        clock = task.Clock()
+        cache.callLater = clock.callLater
+        cache.add_to_cache(DN1_OTHERCASE, MARKER1, age=2)
+        [(dn, marker, age)] = cache.entries()
+        self.assertEqual((dn, marker), (DN1, MARKER1))
+        self.assertGreaterEqual(age, 2)
+        self.assertEqual([call.getTime() for call in clock.getDelayedCalls()], [TIMEOUT - 2])
+        cache.add_to_cache(DN2, MARKER1, age=TIMEOUT)
+        self.assertEqual(cache.get_cached_marker(DN2), None)
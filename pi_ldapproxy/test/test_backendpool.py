@@ -0,0 +1,193 @@
+import gc
+import weakref
+
+from ldaptor.protocols import pureldap
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.backendpool import BackendConnectionPool, SharedServiceAccountConnections
+from pi_ldapproxy.test.mock import MockPooledLDAPClient
+
+
+def anonymous_bind(result_code=0):
+    return [pureldap.LDAPBindResponse(resultCode=result_code)]
+
+
+class BackendConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clients = []
+
+    def connect(self):
+        client = MockPooledLDAPClient(*self.responses.pop(0))
+        client.connectionMade()
+        self.clients.append(client)
+        return defer.succeed(client)
+
+    def create_pool(self, responses, size=2, max_lifetime=300, idle_timeout=60):
+        self.responses = list(responses)
+        pool = BackendConnectionPool(self.connect, size, max_lifetime, idle_timeout)
+        pool.callLater = self.clock.callLater
+        pool.seconds = self.clock.seconds
+        return pool
+
+    @defer.inlineCallbacks
+    def test_reuse_connection(self):
+        pool = self.create_pool([[anonymous_bind()]])
+        client = yield pool.acquire()
+        added = yield pool.release(client)
+        self.assertTrue(added)
+        self.assertEqual(pool.idle_count, 1)
+        client.assertSent(pureldap.LDAPBindRequest(dn='', auth=''))
+        client2 = yield pool.acquire()
+        self.assertIs(client, client2)
+        self.assertEqual(pool.idle_count, 0)
+        self.assertEqual(len(self.clients), 1)
+
+    @defer.inlineCallbacks
+    def test_failed_reset_closes_connection(self):
+        pool = self.create_pool([[anonymous_bind(49)], []])
+        client = yield pool.acquire()
+        added = yield pool.release(client)
+        self.assertFalse(added)
+        self.assertFalse(client.connected)
+        client2 = yield pool.acquire()
+        self.assertIsNot(client, client2)
+
+    @defer.inlineCallbacks
+    def test_pool_size(self):
+        pool = self.create_pool([[anonymous_bind()], [anonymous_bind()], []], size=1)
+        client1 = yield pool.acquire()
+        client2 = yield pool.acquire()
+        client3 = yield pool.acquire()
+        self.assertTrue((yield pool.release(client1)))
+        self.assertFalse((yield pool.release(client3)))
+        self.assertFalse(client3.connected)
+        self.assertEqual(pool.idle_count, 1)
+        pool.close()
+        self.assertFalse(client1.connected)
+        self.assertEqual(pool.idle_count, 0)
+        client2.responses = []
+
+    @defer.inlineCallbacks
+    def test_max_lifetime(self):
+        pool = self.create_pool([[anonymous_bind()], []], max_lifetime=10, idle_timeout=60)
+        client = yield pool.acquire()
+        self.assertTrue((yield pool.release(client)))
+        self.clock.advance(11)
+        client2 = yield pool.acquire()
+        self.assertIsNot(client, client2)
+        self.assertFalse(client.connected)
+
+    @defer.inlineCallbacks
+    def test_idle_eviction(self):
+        pool = self.create_pool([[anonymous_bind()]], idle_timeout=5)
+        client = yield pool.acquire()
+        self.assertTrue((yield pool.release(client)))
+        self.clock.advance(3)
+        self.assertEqual(pool.idle_count, 1)
+        self.clock.advance(3)
+        self.assertEqual(pool.idle_count, 0)
+        self.assertFalse(client.connected)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_dead_connection_is_not_reused(self):
+        pool = self.create_pool([[anonymous_bind()], []])
+        client = yield pool.acquire()
+        self.assertTrue((yield pool.release(client)))
+        # The LDAP backend closes the connection
+        client.connectionLost()
+        client2 = yield pool.acquire()
+        self.assertIsNot(client, client2)
+
+    @defer.inlineCallbacks
+    def test_idle_eviction_uses_oldest_release(self):
+        pool = self.create_pool([[anonymous_bind()], [anonymous_bind()]], idle_timeout=5)
+        client1 = yield pool.acquire()
+        client2 = yield pool.acquire()
+        self.assertTrue((yield pool.release(client1)))
+        self.clock.advance(4)
+        self.assertTrue((yield pool.release(client2)))
+        self.clock.advance(1)
+        # client1 has been idle for 5 seconds, client2 only for 1 second
+        self.assertFalse(client1.connected)
+        self.assertEqual(pool.idle_count, 1)
+        self.clock.advance(4)
+        self.assertFalse(client2.connected)
+        self.assertEqual(pool.idle_count, 0)
+
+    def test_unreleased_connection_is_not_referenced(self):
+        pool = self.create_pool([[]])
+        client = self.successResultOf(pool.acquire())
+        # The connection is closed without being released to the pool, e.g. by ``ProxyBase.connectionLost``
+        client.unbind()
+        client_ref = weakref.ref(client)
+        del client
+        self.clients = []
+        gc.collect()
+        self.assertIsNone(client_ref())
+
+    def test_unknown_connection_is_not_reused(self):
+        pool = self.create_pool([])
+        client = MockPooledLDAPClient()
+        client.connectionMade()
+        d = pool.release(client)
+        self.assertFalse(self.successResultOf(d))
+        self.assertFalse(client.connected)
+        self.assertEqual(pool.idle_count, 0)
+
+
+class SharedServiceAccountConnectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.connects = []
+
+    def connect(self):
+        d = defer.Deferred()
+        self.connects.append(d)
+        return d
+
+    def test_round_robin(self):
+        shared = SharedServiceAccountConnections(self.connect, 2)
+        d1 = shared.get_connection()
+        d2 = shared.get_connection()
+        d3 = shared.get_connection()
+        # The third request waits for the first connection
+        self.assertEqual(len(self.connects), 2)
+        client1, client2 = MockPooledLDAPClient(), MockPooledLDAPClient()
+        client1.connectionMade()
+        client2.connectionMade()
+        self.connects[0].callback(client1)
+        self.connects[1].callback(client2)
+        self.assertIs(self.successResultOf(d1), client1)
+        self.assertIs(self.successResultOf(d2), client2)
+        self.assertIs(self.successResultOf(d3), client1)
+        self.assertIs(self.successResultOf(shared.get_connection()), client2)
+        shared.close()
+        self.assertFalse(client1.connected)
+        self.assertFalse(client2.connected)
+
+    def test_connect_all(self):
+        shared = SharedServiceAccountConnections(self.connect, 2)
+        d = shared.connect_all()
+        self.assertEqual(len(self.connects), 2)
+        clients = [MockPooledLDAPClient(), MockPooledLDAPClient()]
+        for connect, client in zip(self.connects, clients):
+            client.connectionMade()
+            connect.callback(client)
+        self.assertEqual(self.successResultOf(d), clients)
+
+    def test_reconnect(self):
+        shared = SharedServiceAccountConnections(self.connect, 1)
+        d1 = shared.get_connection()
+        self.connects[0].errback(RuntimeError('connection refused'))
+        self.failureResultOf(d1, RuntimeError)
+        d2 = shared.get_connection()
+        client = MockPooledLDAPClient()
+        client.connectionMade()
+        self.connects[1].callback(client)
+        self.assertIs(self.successResultOf(d2), client)
+        # The LDAP backend closes the connection
+        client.connectionLost()
+        shared.get_connection()
+        self.assertEqual(len(self.connects), 3)
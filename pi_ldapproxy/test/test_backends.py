@@ -0,0 +1,109 @@
+from twisted.internet import defer, error, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.backends import BackendSet
+
+
+class BackendSetTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dialed = []
+        #: endpoints which refuse connections
+        self.down = set()
+
+    def dial(self, backend):
+        self.dialed.append(backend.endpoint)
+        if backend.endpoint in self.down:
+            return defer.fail(error.ConnectionRefusedError())
+        backend.active_connections += 1
+        return defer.succeed(backend.endpoint)
+
+    def create_backends(self, endpoints, balancing='round-robin', ejection_time=30):
+        backends = BackendSet(endpoints, balancing, ejection_time)
+        backends.callLater = self.clock.callLater
+        backends.seconds = self.clock.seconds
+        backends._dial = self.dial
+        return backends
+
+    def test_no_backends(self):
+        self.assertRaises(ValueError, BackendSet, [])
+
+    def test_round_robin(self):
+        backends = self.create_backends(['a', 'b', 'c'])
+        results = [self.successResultOf(backends.connect()) for _ in range(4)]
+        self.assertEqual(results, ['a', 'b', 'c', 'a'])
+
+    def test_least_connections(self):
+        backends = self.create_backends(['a', 'b'], balancing='least-connections')
+        backends.backends[0].active_connections = 3
+        results = [self.successResultOf(backends.connect()) for _ in range(3)]
+        self.assertEqual(results, ['b', 'b', 'b'])
+        # now both have three connections, ties are broken by rotation
+        self.assertEqual(self.successResultOf(backends.connect()), 'b')
+        self.assertEqual(self.successResultOf(backends.connect()), 'a')
+
+    def test_failover_ejects_backend(self):
+        backends = self.create_backends(['a', 'b'], ejection_time=30)
+        self.down.add('a')
+        self.assertEqual(self.successResultOf(backends.connect()), 'b')
+        self.assertEqual(self.dialed, ['a', 'b'])
+        a = backends.backends[0]
+        self.assertEqual(a.ejections, 1)
+        self.assertEqual(a.connection_failures, 1)
+        # 'a' is not tried while it is ejected
+        del self.dialed[:]
+        self.assertEqual(self.successResultOf(backends.connect()), 'b')
+        self.assertEqual(self.successResultOf(backends.connect()), 'b')
+        self.assertEqual(self.dialed, ['b', 'b'])
+        # ... but afterwards
+        self.down.clear()
+        self.clock.advance(30)
+        results = set(self.successResultOf(backends.connect()) for _ in range(2))
+        self.assertEqual(results, {'a', 'b'})
+
+    def test_all_backends_down(self):
+        backends = self.create_backends(['a', 'b'])
+        self.down.update(['a', 'b'])
+        self.failureResultOf(backends.connect(), error.ConnectionRefusedError)
+        self.assertEqual(self.dialed, ['a', 'b'])
+        # If all backends are ejected, all of them are tried anyway
+        self.down.remove('b')
+        self.assertEqual(self.successResultOf(backends.connect()), 'b')
+
+    def test_health_checks(self):
+        backends = self.create_backends(['a', 'b'], ejection_time=30)
+        healthy = {'a': True, 'b': False}
+        checked = []
+
+        def check(backend):
+            checked.append(backend.endpoint)
+            return defer.succeed(healthy[backend.endpoint])
+        backends.start_health_checks(check, 10)
+        self.assertEqual(checked, [])
+        self.clock.advance(10)
+        self.assertEqual(checked, ['a', 'b'])
+        a, b = backends.backends
+        self.assertTrue(a.healthy)
+        self.assertFalse(b.healthy)
+        self.assertEqual(b.ejections, 1)
+        self.assertEqual([self.successResultOf(backends.connect()) for _ in range(2)], ['a', 'a'])
+        # 'b' recovers and is reinstated by the next health check, before its ejection time is over
+        healthy['b'] = True
+        self.clock.advance(10)
+        self.assertEqual(checked, ['a', 'b', 'a', 'b'])
+        self.assertEqual(b.ejected_until, 0)
+        self.assertEqual(set(self.successResultOf(backends.connect()) for _ in range(2)), {'a', 'b'})
+        backends.stop_health_checks()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_statistics(self):
+        backends = self.create_backends(['a', 'b'])
+        self.down.add('b')
+        self.successResultOf(backends.connect())
+        self.successResultOf(backends.connect())
+        stats = backends.statistics()
+        self.assertEqual(stats[0]['endpoint'], 'a')
+        self.assertEqual(stats[0]['connection-attempts'], 2)
+        self.assertEqual(stats[0]['active-connections'], 2)
+        self.assertEqual(stats[1]['connection-failures'], 1)
+        self.assertEqual(stats[1]['ejections'], 1)
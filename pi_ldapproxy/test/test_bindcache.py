@@ -74,3 +74,20 @@ class BindCacheTest(unittest.TestCase):
         time.sleep(1)
         self.assertFalse(cache.is_cached(DN, APP, PASSWORD))
         self.assertFalse(cache.is_cached(DN, APP_OTHER, PASSWORD))
+
+    def test_entries_with_age(self):
+        cache = BindCache(timeout=5)
+        clock = task.Clock()
+        cache.callLater = clock.callLater
+        cache.add_to_cache(DN, APP, PASSWORD)
+        [(dn, app, password, age)] = cache.entries()
+        self.assertEqual((dn, app, password), (DN, APP, PASSWORD))
+        self.assertGreaterEqual(age, 0)
+        other = BindCache(timeout=5)
+        other.callLater = clock.callLater
+        other.add_to_cache(DN_OTHER, APP, PASSWORD, age=3)
+        self.assertTrue(other.is_cached(DN_OTHER, APP, PASSWORD))
+        self.assertEqual(sorted(call.getTime() for call in clock.getDelayedCalls()), [2, 5])
+        # Expired entries are not added
+        other.add_to_cache(DN, APP, PASSWORD, age=5)
+        self.assertFalse(other.is_cached(DN, APP, PASSWORD))
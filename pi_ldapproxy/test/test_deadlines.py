@@ -0,0 +1,66 @@
+from ldaptor.protocols.ldap.ldapclient import LDAPClient
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from pi_ldapproxy.deadlines import DeadlineExceeded, unbind_with_deadline, with_deadline
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_deadline_exceeded(self):
+        cancelled = []
+        d = with_deadline(defer.Deferred(cancelled.append), 5, 'lookup', self.clock.callLater)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(len(cancelled), 1)
+        self.failureResultOf(d, DeadlineExceeded)
+
+    def test_fired_in_time(self):
+        d = defer.Deferred()
+        with_deadline(d, 5, 'lookup', self.clock.callLater)
+        d.callback('result')
+        self.assertEqual(self.successResultOf(d), 'result')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancelled_before_deadline(self):
+        d = with_deadline(defer.Deferred(), 5, 'lookup', self.clock.callLater)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_disabled(self):
+        d = with_deadline(defer.Deferred(), 0, 'lookup', self.clock.callLater)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
+
+class UnbindTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = LDAPClient()
+        self.transport = proto_helpers.StringTransport()
+        self.client.makeConnection(self.transport)
+
+    def test_abort_after_deadline(self):
+        unbind_with_deadline(self.client, 5, self.clock.callLater)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse(self.transport.disconnected)
+        self.clock.advance(5)
+        self.assertTrue(self.transport.disconnected)
+
+    def test_closed_in_time(self):
+        unbind_with_deadline(self.client, 5, self.clock.callLater)
+        self.client.connectionLost()
+        self.clock.advance(5)
+        self.assertFalse(self.transport.disconnected)
+
+    def test_not_connected(self):
+        self.client.connectionLost()
+        unbind_with_deadline(self.client, 5, self.clock.callLater)
+        self.assertEqual(self.transport.value(), b'')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,38 @@
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from pi_ldapproxy.flowcontrol import BackendReadThrottle, has_paged_results_control, paged_results_control, \
+    paged_results_cookie, PAGED_RESULTS_OID
+
+
+class BackendReadThrottleTest(unittest.TestCase):
+    def test_pause_resume(self):
+        transport = proto_helpers.StringTransport()
+        throttle = BackendReadThrottle(transport)
+        throttle.pauseProducing()
+        self.assertEqual(transport.producerState, 'paused')
+        throttle.resumeProducing()
+        self.assertEqual(transport.producerState, 'producing')
+
+    def test_stop_resumes(self):
+        transport = proto_helpers.StringTransport()
+        throttle = BackendReadThrottle(transport)
+        throttle.pauseProducing()
+        throttle.stopProducing()
+        # The connection to the LDAP backend is not closed, but read from again
+        self.assertEqual(transport.producerState, 'producing')
+        self.assertFalse(transport.disconnecting)
+
+
+class PagedResultsControlTest(unittest.TestCase):
+    def test_cookie(self):
+        control = paged_results_control(100, b'some-cookie')
+        self.assertEqual(control[0], PAGED_RESULTS_OID)
+        self.assertEqual(paged_results_cookie([control]), b'some-cookie')
+        self.assertEqual(paged_results_cookie([paged_results_control(100)]), b'')
+        self.assertEqual(paged_results_cookie(None), b'')
+
+    def test_has_control(self):
+        self.assertTrue(has_paged_results_control([(b'1.2.840.113556.1.4.319', False, None)]))
+        self.assertFalse(has_paged_results_control([('1.2.3', False, None)]))
+        self.assertFalse(has_paged_results_control(None))
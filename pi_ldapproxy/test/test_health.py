@@ -0,0 +1,78 @@
+import json
+
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from pi_ldapproxy.health import HealthResource
+from pi_ldapproxy.loadshedding import LEVEL_REJECT_CONNECTIONS
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestHealth(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+    }
+    additional_config = {
+        'health': {
+            'max-privacyidea-failures': 2,
+        },
+    }
+
+    def probe(self, path=b'ready'):
+        """
+        :return: a tuple ``(response code, body)``
+        """
+        request = DummyRequest([path])
+        body = HealthResource(self.factory.health).render_GET(request)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'Content-Type'), [b'application/json'])
+        return request.responseCode or 200, json.loads(body)
+
+    def assertNotReady(self, check):
+        code, body = self.probe()
+        self.assertEqual((code, body['status']), (503, 'not ready'))
+        self.assertEqual([name for name, result in body['checks'].items() if not result['ok']], [check])
+
+    def test_ready(self):
+        code, body = self.probe()
+        self.assertEqual((code, body['status']), (200, 'ready'))
+        self.assertEqual(body['checks']['ldap-backends']['routes'], {'default': {'available': 1, 'total': 1}})
+        self.assertEqual(self.probe(b'live'), (200, {'status': 'ok'}))
+        # Probes do not involve the LDAP backend
+        [backend] = self.factory.routes.default.backends.backends
+        self.assertEqual(backend.connection_attempts, 0)
+
+    def test_backends_ejected(self):
+        backends = self.factory.routes.default.backends
+        backends.eject(backends.backends[0], 'connection refused')
+        self.assertNotReady('ldap-backends')
+        backends.reinstate(backends.backends[0])
+        backends.backends[0].healthy = False
+        self.assertNotReady('ldap-backends')
+        # The proxy is still alive
+        self.assertEqual(self.probe(b'live'), (200, {'status': 'ok'}))
+
+    def test_draining(self):
+        self.factory.session_limits.drain(0)
+        self.assertNotReady('draining')
+
+    def test_startup(self):
+        self.factory.warmup.running = True
+        self.assertNotReady('startup')
+
+    def test_reactor_lag(self):
+        self.factory.lag_monitor.level = LEVEL_REJECT_CONNECTIONS
+        self.assertNotReady('reactor-lag')
+
+    @defer.inlineCallbacks
+    def test_privacyidea_failures(self):
+        self.privacyidea.response_code = 500
+        for _ in range(2):
+            server, client = self.create_server_and_client([])
+            yield self.assertFailure(client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret'), Exception)
+        self.assertNotReady('privacyidea')
+        self.assertEqual(self.probe()[1]['checks']['privacyidea']['consecutive-failures'], 2)
+        # A successful request resets the failures
+        self.privacyidea.response_code = 200
+        server, client = self.create_server_and_client([])
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertEqual(self.probe()[0], 200)
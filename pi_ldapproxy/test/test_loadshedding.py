@@ -0,0 +1,95 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from twisted.internet import address, defer, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.loadshedding import LEVEL_NORMAL, LEVEL_REJECT_BINDS, LEVEL_REJECT_CONNECTIONS, LagMonitor
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+def make_monitor(clock):
+    monitor = LagMonitor()
+    monitor.callLater = clock.callLater
+    monitor.seconds = clock.seconds
+    return monitor
+
+
+class LagMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.monitor = make_monitor(self.clock)
+        self.monitor.configure(0.1, reject_connections=0.05, reject_binds=0.2)
+        self.monitor.start()
+
+    def test_lag(self):
+        self.clock.pump([0.1] * 5)
+        self.assertEqual((self.monitor.lag, self.monitor.smoothed_lag), (0, 0))
+        # The reactor is blocked for 0.5 seconds
+        self.clock.advance(0.6)
+        self.assertAlmostEqual(self.monitor.lag, 0.5)
+        self.assertAlmostEqual(self.monitor.smoothed_lag, 0.125)
+        self.assertEqual(self.monitor.level, LEVEL_REJECT_CONNECTIONS)
+        self.assertTrue(self.monitor.reject_connections)
+        self.assertFalse(self.monitor.reject_binds)
+        self.clock.advance(0.6)
+        self.assertAlmostEqual(self.monitor.smoothed_lag, 0.21875)
+        self.assertEqual(self.monitor.level, LEVEL_REJECT_BINDS)
+        self.assertTrue(self.monitor.reject_binds)
+        # The lag decreases again once the reactor keeps up
+        self.clock.pump([0.1] * 10)
+        self.assertEqual(self.monitor.level, LEVEL_NORMAL)
+
+    def test_disabled(self):
+        self.monitor.configure(0.1)
+        self.clock.advance(10)
+        self.assertEqual(self.monitor.level, LEVEL_NORMAL)
+
+    def test_stop(self):
+        self.clock.advance(10)
+        self.monitor.stop()
+        self.assertEqual(self.monitor.level, LEVEL_NORMAL)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestProxyLoadShedding(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+    }
+    additional_config = {
+        'load-shedding': {
+            'reject-connections': 50,
+            'reject-binds': 100,
+        },
+    }
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        monitor = self.factory.lag_monitor
+        monitor.callLater = self.clock.callLater
+        monitor.seconds = self.clock.seconds
+        self.factory.startFactory()
+        self.addCleanup(monitor.stop)
+
+    def lag(self, seconds):
+        """ Let the reactor lag behind until the smoothed lag is at least *seconds* """
+        while self.factory.lag_monitor.smoothed_lag < seconds:
+            self.clock.advance(0.1 + 4 * seconds)
+
+    def test_reject_connections(self):
+        addr = address.IPv4Address('TCP', '192.0.2.1', 12345)
+        self.assertIsNotNone(self.factory.buildProtocol(addr))
+        self.lag(0.05)
+        self.assertIsNone(self.factory.buildProtocol(addr))
+        self.assertIn('ldapproxy_shed_connections_total 1', self.factory.metrics.render().splitlines())
+
+    @defer.inlineCallbacks
+    def test_reject_binds(self):
+        server, client = self.create_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        self.lag(0.1)
+        yield self.assertFailure(client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret'), ldaperrors.LDAPBusy)
+        self.assertEqual(self.factory.metrics.bind_outcomes['busy'], 1)
+        # Passthrough binds are not affected
+        server, client = self.create_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        lines = self.factory.metrics.render().splitlines()
+        self.assertIn('ldapproxy_load_shedding_level 2', lines)
@@ -0,0 +1,118 @@
+import json
+
+import configobj
+import validate
+from twisted.application import service
+from twisted.internet import defer, task
+from twisted.logger import LogLevel, LogPublisher
+from twisted.trial import unittest
+
+from pi_ldapproxy import logs
+from pi_ldapproxy.config import CONFIG_SPEC
+from pi_ldapproxy.logs import GatedLogger, JSONLogWriter, LoggedService
+from pi_ldapproxy.test.util import BASE_CONFIG
+
+
+class GatedLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.addCleanup(logs.settings.configure)
+
+    def logger(self, namespace):
+        return GatedLogger(namespace, observer=self.events.append)
+
+    def test_levels(self):
+        logs.settings.configure(LogLevel.info, {'pi_ldapproxy.bindcache': LogLevel.warn})
+        bind_cache_log = self.logger('pi_ldapproxy.bindcache')
+        proxy_log = self.logger('pi_ldapproxy.proxy')
+        bind_cache_log.info('Adding to bind cache')
+        bind_cache_log.warn('Inconsistent bind cache')
+        proxy_log.debug('Stripped app marker')
+        proxy_log.info('Sending BindResponse')
+        self.assertEqual([event['log_format'] for event in self.events],
+                         ['Inconsistent bind cache', 'Sending BindResponse'])
+        self.assertFalse(bind_cache_log.enabled(LogLevel.info))
+        self.assertTrue(proxy_log.enabled(LogLevel.info))
+        # Levels apply to the namespaces below
+        logs.settings.configure(LogLevel.info, {'pi_ldapproxy': LogLevel.error})
+        self.assertFalse(proxy_log.enabled(LogLevel.warn))
+
+    def test_sampled_info(self):
+        logs.settings.configure(info_sample_rate=0.25)
+        log = self.logger('pi_ldapproxy.proxy')
+        for i in range(8):
+            log.sampled_info('BindRequest {i!r}', i=i)
+        self.assertEqual([event['i'] for event in self.events], [3, 7])
+        logs.settings.configure(LogLevel.warn)
+        log.sampled_info('BindRequest')
+        self.assertEqual(len(self.events), 2)
+
+    def test_configure(self):
+        config = configobj.ConfigObj((BASE_CONFIG + """
+[logging]
+level = warn
+info-sample-rate = 0.5
+[[levels]]
+pi_ldapproxy.bindcache = debug
+""").splitlines(), configspec=CONFIG_SPEC.splitlines())
+        self.assertEqual(config.validate(validate.Validator()), True)
+        logs.configure(config['logging'])
+        self.assertTrue(self.logger('pi_ldapproxy.bindcache').enabled(LogLevel.debug))
+        self.assertFalse(self.logger('pi_ldapproxy.proxy').enabled(LogLevel.info))
+        self.assertEqual(logs.settings.info_sample_rate, 0.5)
+
+
+class JSONLogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.publisher = LogPublisher()
+        self.filename = self.mktemp()
+        self.writer = JSONLogWriter(self.filename, buffer_size=4, flush_interval=1, publisher=self.publisher)
+        self.writer.callLater = self.clock.callLater
+        self.writer.startService()
+
+    def emit(self, count):
+        for i in range(count):
+            self.publisher({'log_format': 'Event {i!r}', 'log_level': LogLevel.info, 'log_time': 1000, 'i': i})
+
+    def read(self):
+        with open(self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    @defer.inlineCallbacks
+    def test_write(self):
+        self.emit(1)
+        # Events are written after the flush interval
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 1)
+        self.clock.advance(1)
+        yield self.writer._writing
+        self.assertEqual([event['i'] for event in self.read()], [0])
+        yield self.writer.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_buffer_is_bounded(self):
+        self.emit(6)
+        self.assertEqual(self.writer.dropped, 2)
+        yield self.writer.stopService()
+        events = self.read()
+        self.assertEqual([event.get('i') for event in events], [2, 3, 4, 5, None])
+        self.assertEqual(events[-1]['count'], 2)
+        # The writer does not observe the publisher anymore
+        self.emit(1)
+        self.assertEqual(len(self.writer._buffer), 0)
+
+    def test_logged_service(self):
+        main_service = service.Service()
+        stopped = defer.Deferred()
+        main_service.stopService = lambda: stopped
+        self.writer.stopService()
+        parent = LoggedService(main_service, self.writer)
+        parent.startService()
+        self.assertTrue(self.writer.running)
+        d = parent.stopService()
+        # The writer keeps running until the main service has stopped
+        self.assertTrue(self.writer.running)
+        stopped.callback(None)
+        self.assertFalse(self.writer.running)
+        return d
@@ -0,0 +1,18 @@
+from twisted.trial import unittest
+
+from pi_ldapproxy.proxy import ProxyServerFactory
+from pi_ldapproxy.test.util import load_test_config, measure_idle_connection_memory
+
+#: Memory budget per idle client connection in bytes. Currently, an idle connection needs less than
+#: 500 bytes (measured with CPython 3.11), so this leaves some headroom for other Python versions.
+IDLE_CONNECTION_BUDGET = 1024
+
+
+class IdleConnectionMemoryTest(unittest.TestCase):
+    def test_idle_connection_budget(self):
+        config = load_test_config()
+        config['ldap-backend']['lazy-connect'] = True
+        factory = ProxyServerFactory(config)
+        per_connection = measure_idle_connection_memory(factory, 2000)
+        self.assertLess(per_connection, IDLE_CONNECTION_BUDGET)
+        self.assertEqual(len(factory.session_limits), 0)
@@ -0,0 +1,130 @@
+import itertools
+
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from pi_ldapproxy.metrics import Histogram, Metrics, MetricsResource
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class HistogramTest(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.samples('duration', (('phase', 'test'),)), [
+            'duration_bucket{phase="test",le="0.1"} 2',
+            'duration_bucket{phase="test",le="1"} 3',
+            'duration_bucket{phase="test",le="+Inf"} 4',
+            'duration_sum{phase="test"} 2.65',
+            'duration_count{phase="test"} 4',
+        ])
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self):
+        metrics = Metrics()
+        metrics.seconds = lambda: 10.5
+        self.assertEqual(metrics.lap('privacyidea', 10), 10.5)
+        metrics.bind_outcomes['success'] += 1
+        metrics.add_metric('connections', 'gauge', 'Open connections', lambda: 3)
+        metrics.add_metric('backend_connections', 'gauge', 'Backend connections',
+                           lambda: [((('endpoint', 'tcp:host="a"'),), 2)])
+        lines = metrics.render().splitlines()
+        self.assertIn('ldapproxy_bind_phase_duration_seconds_bucket{phase="privacyidea",le="0.5"} 1', lines)
+        self.assertIn('ldapproxy_bind_phase_duration_seconds_bucket{phase="privacyidea",le="0.25"} 0', lines)
+        self.assertIn('ldapproxy_bind_phase_duration_seconds_count{phase="realm-resolution"} 0', lines)
+        self.assertIn('ldapproxy_bind_requests_total{outcome="success"} 1', lines)
+        self.assertIn('ldapproxy_bind_requests_total{outcome="error"} 0', lines)
+        self.assertEqual(lines[-6:], [
+            '# HELP connections Open connections',
+            '# TYPE connections gauge',
+            'connections 3',
+            '# HELP backend_connections Backend connections',
+            '# TYPE backend_connections gauge',
+            'backend_connections{endpoint="tcp:host=\\"a\\""} 2',
+        ])
+
+    def test_resource(self):
+        metrics = Metrics()
+        request = DummyRequest([b'metrics'])
+        body = MetricsResource(metrics).render_GET(request)
+        self.assertEqual(body, metrics.render().encode('utf-8'))
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'Content-Type'),
+                         [b'text/plain; version=0.0.4; charset=utf-8'])
+
+
+class TestProxyMetrics(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+    }
+    additional_config = {
+        'bind-cache': {
+            'enabled': True,
+        },
+    }
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        self.factory.bind_cache.callLater = self.clock.callLater
+        # Every phase takes 2ms
+        self.factory.metrics.seconds = itertools.count(step=0.002).__next__
+
+    def phase_counts(self):
+        return dict((phase, histogram.count) for phase, histogram in self.factory.metrics.bind_phases.items())
+
+    @defer.inlineCallbacks
+    def test_bind_phases(self):
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        metrics = self.factory.metrics
+        self.assertEqual(self.phase_counts(), {
+            'realm-resolution': 1,
+            'user-resolution': 1,
+            'bind-cache': 1,
+            'privacyidea': 1,
+            'service-account-bind': 0,
+        })
+        self.assertEqual(metrics.bind_phases['privacyidea'].counts[:3], [0, 1, 0])
+        self.assertEqual(metrics.bind_cache_lookups, {'hit': 0, 'miss': 1})
+        self.assertEqual(metrics.bind_outcomes['success'], 1)
+        server2, client2 = self.create_server_and_client()
+        yield client2.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertEqual(metrics.bind_cache_lookups, {'hit': 1, 'miss': 1})
+        self.assertEqual(self.phase_counts()['privacyidea'], 1)
+        self.assertEqual(metrics.bind_outcomes['success'], 2)
+
+    @defer.inlineCallbacks
+    def test_bind_outcomes(self):
+        server, client = self.create_server_and_client()
+        yield self.assertFailure(client.bind('uid=hugo,cn=users,dc=test,dc=local', 'wrong'),
+                                 ldaperrors.LDAPInvalidCredentials)
+        server, client = self.create_server_and_client()
+        yield self.assertFailure(client.bind('', ''), ldaperrors.LDAPInvalidCredentials)
+        self.privacyidea.authenticate = lambda *args: defer.fail(RuntimeError('unreachable'))
+        server, client = self.create_server_and_client()
+        yield self.assertFailure(client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret'),
+                                 ldaperrors.LDAPInvalidCredentials)
+        self.flushLoggedErrors(RuntimeError)
+        self.assertEqual(self.factory.metrics.bind_outcomes, {
+            'success': 0,
+            'invalid-credentials': 1,
+            'rejected': 1,
+            'busy': 0,
+            'error': 1,
+            'cancelled': 0,
+        })
+
+    def test_gauges(self):
+        server, client = self.create_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        self.factory.finalize_authentication('uid=hugo,cn=users,dc=test,dc=local', None, 'secret')
+        lines = self.factory.metrics.render().splitlines()
+        self.assertIn('ldapproxy_bind_cache_entries 1', lines)
+        self.assertIn('ldapproxy_app_cache_entries 0', lines)
+        self.assertIn('ldapproxy_backend_pool_idle_connections 0', lines)
+        self.assertIn('ldapproxy_rejected_connections_total 0', lines)
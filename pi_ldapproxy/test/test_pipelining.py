@@ -0,0 +1,171 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.pipelining import MessageReply, OperationSequencer
+from pi_ldapproxy.test.util import BackendTestCase
+
+
+class OperationSequencerTest(unittest.TestCase):
+    def setUp(self):
+        self.sequencer = OperationSequencer()
+        self.started = []
+        self.done = {}
+
+    def submit(self, name, is_bind=False):
+        def start(done):
+            self.started.append(name)
+            self.done[name] = done
+        self.sequencer.submit(is_bind, start)
+
+    def test_concurrent_operations(self):
+        self.submit('search1')
+        self.submit('search2')
+        self.assertEqual(self.started, ['search1', 'search2'])
+        self.assertEqual(self.sequencer.outstanding, 2)
+
+    def test_bind_waits_for_outstanding_operations(self):
+        self.submit('search')
+        self.submit('bind', is_bind=True)
+        self.submit('search2')
+        self.assertEqual(self.started, ['search'])
+        self.done['search']()
+        self.assertEqual(self.started, ['search', 'bind'])
+        self.done['bind']()
+        self.assertEqual(self.started, ['search', 'bind', 'search2'])
+
+    def test_operations_wait_for_bind(self):
+        self.submit('bind', is_bind=True)
+        self.submit('search1')
+        self.submit('search2')
+        self.assertEqual(self.started, ['bind'])
+        self.done['bind']()
+        self.assertEqual(self.started, ['bind', 'search1', 'search2'])
+        self.assertFalse(self.sequencer.held)
+
+    def test_done_is_idempotent(self):
+        self.submit('bind', is_bind=True)
+        self.done['bind']()
+        self.done['bind']()
+        self.assertEqual(self.sequencer.outstanding, 0)
+
+    def test_clear(self):
+        self.submit('bind', is_bind=True)
+        self.submit('search')
+        self.sequencer.clear()
+        self.done['bind']()
+        self.assertEqual(self.started, ['bind'])
+
+    def test_message_reply(self):
+        responses = []
+        completed = []
+        reply = MessageReply(responses.append, 5)
+        reply.on_complete = lambda: completed.append(True)
+        reply(pureldap.LDAPSearchResultEntry('cn=foo', []))
+        self.assertEqual(completed, [])
+        reply(pureldap.LDAPSearchResultDone(0))
+        reply(pureldap.LDAPSearchResultDone(0))
+        self.assertEqual(completed, [True])
+        self.assertEqual(len(responses), 3)
+
+
+class TestProxyPipelining(BackendTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret'
+    }
+    additional_config = {
+        'ldap-proxy': {
+            'allow-search': True,
+            'allow-connection-reuse': True,
+        },
+    }
+
+    def entry(self, name):
+        return pureldap.LDAPSearchResultEntry('uid={},cn=users,dc=test,dc=local'.format(name), [('cn', [name])])
+
+    def search(self, client, filter_text):
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        return entry.search(filter_text, scope=pureldap.LDAP_SCOPE_wholeSubtree)
+
+    @defer.inlineCallbacks
+    def test_concurrent_searches(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        d1 = self.search(client, '(uid=a)')
+        d2 = self.search(client, '(uid=b)')
+        # Both searches are forwarded before the LDAP backend has responded to either of them
+        msg1 = yield self.receive_request()
+        msg2 = yield self.receive_request()
+        self.assertNotEqual(msg1.id, msg2.id)
+        self.respond(msg2.id, self.entry('b'), pureldap.LDAPSearchResultDone(0))
+        self.respond(msg1.id, self.entry('a'), pureldap.LDAPSearchResultDone(0))
+        results1 = yield d1
+        results2 = yield d2
+        self.assertEqual([result.dn.getText() for result in results1], ['uid=a,cn=users,dc=test,dc=local'])
+        self.assertEqual([result.dn.getText() for result in results2], ['uid=b,cn=users,dc=test,dc=local'])
+
+    def test_concurrent_searches_raw(self):
+        self.factory.raw_forwarding = True
+        return self.test_concurrent_searches()
+
+    @defer.inlineCallbacks
+    def test_bind_waits_for_search(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        d_search = self.search(client, '(uid=a)')
+        msg = yield self.receive_request()
+        d_bind = client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'other-secret')
+        while not server.sequencer.held:
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.assertNothingReceived()
+        self.respond(msg.id, pureldap.LDAPSearchResultDone(0))
+        yield d_search
+        msg = yield self.receive_request()
+        self.assertIsInstance(msg.value, pureldap.LDAPBindRequest)
+        self.respond(msg.id, pureldap.LDAPBindResponse(resultCode=0))
+        yield d_bind
+
+    @defer.inlineCallbacks
+    def test_search_waits_for_bind(self):
+        server, client = self.create_backend_server_and_client()
+        self.factory.bind_service_account = True
+        validating = defer.Deferred()
+        authenticate = server.request_validate
+
+        def delayed_request_validate(*args):
+            return validating.addCallback(lambda _: authenticate(*args))
+        server.request_validate = delayed_request_validate
+        d_bind = client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        d_search = self.search(client, '(uid=a)')
+        while not server.sequencer.held:
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.assertNothingReceived()
+        validating.callback(None)
+        # The service account is bound before the search is forwarded
+        msg = yield self.receive_request()
+        self.assertEqual(msg.value.dn, b'uid=service,cn=users,dc=test,dc=local')
+        self.respond(msg.id, pureldap.LDAPBindResponse(resultCode=0))
+        yield d_bind
+        msg = yield self.receive_request()
+        self.assertIsInstance(msg.value, pureldap.LDAPSearchRequest)
+        self.respond(msg.id, self.entry('a'), pureldap.LDAPSearchResultDone(0))
+        results = yield d_search
+        self.assertEqual(len(results), 1)
+
+    @defer.inlineCallbacks
+    def test_lost_backend_completes_operations(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        d_search = self.search(client, '(uid=a)')
+        yield self.receive_request()
+        d_bind = client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'other-secret')
+        while not server.sequencer.held:
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.backend.connectionLost(ldaperrors.LDAPOther('backend gone'))
+        yield self.assertFailure(d_search, ldaperrors.LDAPOther)
+        self.flushLoggedErrors()
+        # The bind is started once the search has failed
+        yield self.assertFailure(d_bind, ldaperrors.LDAPOther)
+        self.flushLoggedErrors()
@@ -0,0 +1,83 @@
+import os
+import pstats
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.profiling import Profiler, StackSampler
+
+
+def outer(sampler):
+    return inner(sampler)
+
+
+def inner(sampler):
+    sampler.sample(sys._getframe())
+
+
+class StackSamplerTest(unittest.TestCase):
+    def test_sample(self):
+        sampler = StackSampler(None, 0.005)
+        for _ in range(3):
+            outer(sampler)
+        inner(sampler)
+        [(stack, count)] = [item for item in sampler.counts.items() if 'outer' in item[0][-2]]
+        self.assertEqual(count, 3)
+        self.assertTrue(stack[-1].startswith('inner ({}:'.format(__file__.replace('.pyc', '.py'))))
+        lines = sampler.collapsed().splitlines()
+        self.assertIn(';'.join(stack) + ' 3', lines)
+        report = sampler.report().splitlines()
+        self.assertEqual(report[0], '4 samples, one every 5 ms')
+        # inner is running in all samples
+        self.assertIn('       4  100.0%  ' + stack[-1], report)
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.profiler = Profiler()
+        self.profiler.callLater = self.clock.callLater
+        self.profiler.time = lambda: 0
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_time_boxed(self):
+        self.profiler.configure('sampling', 5, self.directory)
+        self.assertIsNotNone(self.profiler.start())
+        # Only one session runs at a time
+        self.assertIsNone(self.profiler.start())
+        self.assertEqual([call.getTime() for call in self.clock.getDelayedCalls()], [5])
+        self.profiler.stop = lambda: defer.succeed([])
+        self.clock.advance(5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_sampling(self):
+        self.profiler.configure('sampling', 5, self.directory, 0.001)
+        session = self.profiler.start()
+        session.sampler.sample(sys._getframe())
+        filenames = yield self.profiler.stop()
+        self.assertIsNone(self.profiler.session)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        prefix = 'ldapproxy-profile-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(0)), os.getpid())
+        self.assertEqual(self.files(), [prefix + '.collapsed', prefix + '.txt'])
+        self.assertEqual(filenames, [os.path.join(self.directory, prefix + suffix)
+                                     for suffix in ('.collapsed', '.txt')])
+        with open(filenames[0]) as f:
+            self.assertIn('test_sampling (', f.read())
+
+    @defer.inlineCallbacks
+    def test_cprofile(self):
+        self.profiler.configure('cprofile', 5, self.directory)
+        self.profiler.start()
+        sorted(range(10))
+        filenames = yield self.profiler.stop()
+        self.assertEqual([os.path.splitext(filename)[1] for filename in filenames],
+                         ['.collapsed', '.txt', '.pstats'])
+        stats = pstats.Stats(filenames[2])
+        self.assertTrue(any(function[2] == '<built-in method builtins.sorted>' for function in stats.stats))
@@ -1,8 +1,9 @@
 import time
+from ldaptor.ldapfilter import parseFilter
 from ldaptor.protocols import pureldap
 from ldaptor.protocols.ldap import ldaperrors
 from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from pi_ldapproxy.test.util import ProxyTestCase
 
@@ -284,4 +285,58 @@ class TestProxyUserBindCaseInsensitive(ProxyTestCase):
         yield client2.bind(dn.lower(), password) # this will work even though the DN has differing case
         self.assertEqual(self.privacyidea.authentication_requests,
                          [('hugo', 'realmSecret', password, True)])
-        time.sleep(1) # to clean the reactor
\ No newline at end of file
+        time.sleep(1) # to clean the reactor
+
+class TestProxyStripAppMarker(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@realmSecret': 'secret',
+    }
+
+    additional_config = {
+        'ldap-proxy': {
+            'bind-service-account': True,
+            'allow-search': True,
+        },
+        'realm-mapping': {
+            'strategy': 'app-cache',
+            'mappings': {
+                'markerSecret': 'realmSecret',
+            }
+        },
+        'app-cache': {
+            'enabled': True,
+            'timeout': 1,
+            'strip-marker': True,
+        }
+    }
+
+    @defer.inlineCallbacks
+    def test_marker_stripped(self):
+        self.factory.app_cache.callLater = task.Clock().callLater
+        service_dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_server_and_client([
+            pureldap.LDAPBindResponse(resultCode=0),
+        ], [
+            pureldap.LDAPSearchResultEntry(dn, [('someattr', ['somevalue'])]),
+            pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+        ])
+        yield client.bind(service_dn, 'service-secret')
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        yield entry.search('(&(cn=hugo)(|(objectClass=person)(objectclass=App-markerSecret)))',
+                           scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        # The LDAP backend does not see the app marker ...
+        server.client.assertSent(
+            pureldap.LDAPBindRequest(dn=service_dn, auth='service-secret'),
+            pureldap.LDAPSearchRequest(baseObject='cn=users,dc=test,dc=local', scope=2, derefAliases=0,
+                                       sizeLimit=0, timeLimit=0, typesOnly=0,
+                                       filter=parseFilter('(&(cn=hugo)(objectClass=person))'), attributes=()),
+        )
+        self.assertFalse(server.stripped_app_markers)
+        # ... but it has been added to the app cache nevertheless
+        server2, client2 = self.create_server_and_client([
+            pureldap.LDAPBindResponse(resultCode=0),  # for service account
+        ])
+        yield client2.bind(dn, 'secret')
+        self.assertEqual(self.privacyidea.authentication_requests,
+                         [('hugo', 'realmSecret', 'secret', True)])
@@ -0,0 +1,93 @@
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.ldap import ldaperrors, ldapserver
+from ldaptor.protocols.ldap.ldapclient import LDAPClient
+from twisted.internet import defer, error, reactor, task
+from twisted.test import proto_helpers
+
+from pi_ldapproxy.deadlines import DeadlineExceeded
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestProxyCancellation(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret'
+    }
+
+    @defer.inlineCallbacks
+    def wait_for_authentication(self, server):
+        while not server.inflight:
+            yield task.deferLater(reactor, 0, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_disconnect_cancels_validate(self):
+        server, client = self.create_server_and_client([])
+        cancelled = []
+        server.request_validate = lambda *args: defer.Deferred(cancelled.append)
+        client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for_authentication(server)
+        server.connectionLost(error.ConnectionDone())
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(server.inflight, set())
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    @defer.inlineCallbacks
+    def test_validate_deadline(self):
+        server, client = self.create_server_and_client([])
+        server.request_validate = lambda *args: defer.Deferred()
+        d = client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for_authentication(server)
+        self.clock.advance(self.factory.timeouts['privacyidea'])
+        yield self.assertFailure(d, ldaperrors.LDAPInvalidCredentials)
+        self.assertEqual(len(self.flushLoggedErrors(DeadlineExceeded)), 1)
+
+
+class TestProxyLookupCancellation(ProxyTestCase):
+    additional_config = {
+        'user-mapping': {
+            'strategy': 'lookup',
+            'attribute': 'sAMAccountName'
+        }
+    }
+
+    def inject_lookup_client(self):
+        self.lookup_client = LDAPClient()
+        self.lookup_transport = proto_helpers.StringTransport()
+        self.lookup_client.makeConnection(self.lookup_transport)
+        self.factory.connect_service_account = lambda: defer.succeed(self.lookup_client)
+
+    def sent_requests(self):
+        data = self.lookup_transport.value()
+        requests = []
+        while data:
+            msg, length = pureber.berDecodeObject(ldapserver.BaseLDAPServer.berdecoder, data)
+            requests.append(msg.value)
+            data = data[length:]
+        return requests
+
+    @defer.inlineCallbacks
+    def test_disconnect_cancels_lookup(self):
+        self.inject_lookup_client()
+        server, client = self.create_server_and_client([])
+        client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        while not self.lookup_transport.value():
+            yield task.deferLater(reactor, 0, lambda: None)
+        server.connectionLost(error.ConnectionDone())
+        # The lookup connection is unbound ...
+        self.assertIsInstance(self.sent_requests()[-1], pureldap.LDAPUnbindRequest)
+        self.assertTrue(self.lookup_transport.disconnecting)
+        # ... and aborted if the LDAP backend does not close it
+        self.clock.advance(self.factory.timeouts['unbind'])
+        self.assertTrue(self.lookup_transport.disconnected)
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    @defer.inlineCallbacks
+    def test_lookup_deadline(self):
+        self.inject_lookup_client()
+        server, client = self.create_server_and_client([])
+        d = client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        while not self.lookup_transport.value():
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.clock.advance(self.factory.timeouts['user-lookup'])
+        yield self.assertFailure(d, ldaperrors.LDAPInvalidCredentials)
+        self.assertIsInstance(self.sent_requests()[-1], pureldap.LDAPUnbindRequest)
+        self.assertEqual(len(self.flushLoggedErrors(DeadlineExceeded)), 1)
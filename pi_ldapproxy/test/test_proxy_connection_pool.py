@@ -0,0 +1,74 @@
+from ldaptor.protocols import pureldap
+from twisted.internet import defer, error
+
+from pi_ldapproxy.test.mock import MockPooledLDAPClient
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestProxyConnectionPool(ProxyTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'pool-size': 2,
+        },
+        'ldap-proxy': {
+            'allow-search': True,
+        }
+    }
+
+    def inject_pooled_backend(self, *responses):
+        backend = MockPooledLDAPClient(*responses)
+        backend.connectionMade()
+        self.factory.backend_pool.connector = lambda: defer.succeed(backend)
+        return backend
+
+    @defer.inlineCallbacks
+    def test_connection_released_after_unbind(self):
+        backend = self.inject_pooled_backend([pureldap.LDAPBindResponse(resultCode=0)],
+                                             [pureldap.LDAPBindResponse(resultCode=0)])
+        server, client = self.create_server_and_client(clientConnector=self.factory.backend_pool.acquire)
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        # Simulate the Unbind Request and the subsequent disconnect of the client
+        server.handle_LDAPUnbindRequest(pureldap.LDAPUnbindRequest(), None, lambda response: None)
+        server.connectionLost(error.ConnectionDone)
+        self.assertTrue(backend.connected)
+        # The unbind request has not been forwarded, but the connection has been reset
+        backend.assertSent(
+            pureldap.LDAPBindRequest(dn='uid=passthrough,cn=users,dc=test,dc=local', auth='some-secret'),
+            pureldap.LDAPBindRequest(dn='', auth=''),
+        )
+        self.assertEqual(self.factory.backend_pool.idle_count, 1)
+        self.factory.stopFactory()
+        self.assertFalse(backend.connected)
+        self.assertEqual(self.factory.backend_pool.idle_count, 0)
+
+    @defer.inlineCallbacks
+    def test_passthrough_connection_not_released_without_unbind(self):
+        backend = self.inject_pooled_backend([pureldap.LDAPBindResponse(resultCode=0)])
+        server, client = self.create_server_and_client(clientConnector=self.factory.backend_pool.acquire)
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        server.connectionLost(error.ConnectionDone)
+        self.assertFalse(backend.connected)
+        self.assertEqual(self.factory.backend_pool.idle_count, 0)
+
+    def test_health_check_releases_connection(self):
+        backend = self.inject_pooled_backend([pureldap.LDAPBindResponse(resultCode=0)])
+        # The connection attempt cannot be aborted anymore, the connection is established nonetheless
+        connecting = defer.Deferred(lambda d: self.factory.backend_pool.acquire().chainDeferred(d))
+        server, client = self.create_server_and_client(clientConnector=lambda: connecting)
+        # The client disconnects before the connection to the LDAP backend has been established
+        server.connectionLost(error.ConnectionDone)
+        self.assertIsNone(server.client)
+        self.assertTrue(backend.connected)
+        self.assertEqual(self.factory.backend_pool.idle_count, 1)
+        self.factory.stopFactory()
+
+    def test_connect_cancelled_on_disconnect(self):
+        cancelled = []
+        self.factory.backend_pool.connector = lambda: defer.Deferred(cancelled.append)
+        server, client = self.create_server_and_client(clientConnector=self.factory.backend_pool.acquire)
+        self.assertIsNotNone(server.backend_dial)
+        server.connectionLost(error.ConnectionDone)
+        self.assertEqual(len(cancelled), 1)
+        self.assertIsNone(server.backend_dial)
+        self.assertFalse(server.connecting_backend)
+        self.assertEqual(self.factory.backend_pool.idle_count, 0)
@@ -0,0 +1,90 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer, error
+
+from pi_ldapproxy.flowcontrol import BackendReadThrottle, paged_results_control, paged_results_cookie
+from pi_ldapproxy.test.util import BackendTestCase
+
+
+class TestProxyBackpressure(BackendTestCase):
+    @defer.inlineCallbacks
+    def test_pause_backend(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        throttle = server.transport.producer
+        self.assertIsInstance(throttle, BackendReadThrottle)
+        # The write buffer of the client connection is full
+        throttle.pauseProducing()
+        self.assertEqual(self.backend_transport.producerState, 'paused')
+        throttle.resumeProducing()
+        self.assertEqual(self.backend_transport.producerState, 'producing')
+        throttle.pauseProducing()
+        server.connectionLost(error.ConnectionDone())
+        self.assertIsNone(server.backend_throttle)
+        self.assertEqual(self.backend_transport.producerState, 'producing')
+
+
+class TestProxyNoBackpressure(BackendTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'flow-control': False,
+        },
+    }
+
+    @defer.inlineCallbacks
+    def test_no_throttle(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        self.assertIsNone(server.backend_throttle)
+
+
+class TestProxyPagedSearch(BackendTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'paged-search-size': 2,
+        },
+        'ldap-proxy': {
+            'allow-search': True,
+        },
+    }
+
+    def entry(self, name):
+        return pureldap.LDAPSearchResultEntry('uid={},cn=users,dc=test,dc=local'.format(name), [('cn', [name])])
+
+    @defer.inlineCallbacks
+    def _test_paged_search(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        d = entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        msg = yield self.receive_request()
+        self.assertEqual(paged_results_cookie(msg.controls), b'')
+        self.respond(msg.id, self.entry('a'), self.entry('b'), pureldap.LDAPSearchResultDone(0),
+                     controls=[paged_results_control(0, b'cookie1')])
+        msg = yield self.receive_request()
+        self.assertEqual(paged_results_cookie(msg.controls), b'cookie1')
+        self.respond(msg.id, self.entry('c'), pureldap.LDAPSearchResultDone(0),
+                     controls=[paged_results_control(0, b'')])
+        results = yield d
+        self.assertEqual([result.dn.getText() for result in results],
+                         ['uid={},cn=users,dc=test,dc=local'.format(name) for name in 'abc'])
+
+    def test_paged_search(self):
+        return self._test_paged_search()
+
+    def test_paged_search_raw(self):
+        self.factory.raw_forwarding = True
+        return self._test_paged_search()
+
+    @defer.inlineCallbacks
+    def test_failed_page(self):
+        server, client = self.create_backend_server_and_client()
+        yield self.passthrough_bind(client)
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        d = entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        msg = yield self.receive_request()
+        self.respond(msg.id, pureldap.LDAPSearchResultDone(ldaperrors.LDAPUnwillingToPerform.resultCode),
+                     controls=[paged_results_control(0, b'cookie1')])
+        yield self.assertFailure(d, ldaperrors.LDAPUnwillingToPerform)
+        self.assertNothingReceived()
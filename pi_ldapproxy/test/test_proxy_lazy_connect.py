@@ -0,0 +1,193 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer, error, reactor, task
+
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class LazyConnectTestCase(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret'
+    }
+
+    def create_counting_server_and_client(self, *responses):
+        """
+        Create a server and a client, but count the connection attempts to the LDAP backend
+        """
+        self.backend_connects = 0
+        server, client = self.create_server_and_client(*responses)
+        original_connector = server.clientConnector
+
+        def counting_connector():
+            self.backend_connects += 1
+            return original_connector()
+        server.clientConnector = counting_connector
+        return server, client
+
+
+class TestProxyLazyConnect(LazyConnectTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'lazy-connect': True,
+        },
+        'ldap-proxy': {
+            'allow-search': True,
+        }
+    }
+
+    @defer.inlineCallbacks
+    def test_user_bind_does_not_connect(self):
+        server, client = self.create_counting_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertEqual(self.backend_connects, 0)
+        self.assertIsNone(server.client)
+
+    @defer.inlineCallbacks
+    def test_passthrough_bind_connects(self):
+        server, client = self.create_counting_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        self.assertEqual(self.backend_connects, 1)
+        server.client.assertSent(
+            pureldap.LDAPBindRequest(dn='uid=passthrough,cn=users,dc=test,dc=local', auth='some-secret'),
+        )
+
+    @defer.inlineCallbacks
+    def test_failed_user_bind_does_not_connect(self):
+        server, client = self.create_counting_server_and_client()
+        d = client.bind('uid=hugo,cn=users,dc=test,dc=local', 'wrong')
+        yield self.assertFailure(d, ldaperrors.LDAPInvalidCredentials)
+        self.assertEqual(self.backend_connects, 0)
+
+    @defer.inlineCallbacks
+    def test_search_connects(self):
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_counting_server_and_client([
+            pureldap.LDAPSearchResultEntry(dn, [('someattr', ['somevalue'])]),
+            pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+        ])
+        yield client.bind(dn, 'secret')
+        self.assertEqual(self.backend_connects, 0)
+        entry = LDAPEntry(client, dn)
+        results = yield entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.backend_connects, 1)
+
+    def test_health_check_does_not_connect(self):
+        server, client = self.create_counting_server_and_client()
+        server.connectionLost(error.ConnectionDone)
+        self.assertEqual(self.backend_connects, 0)
+        self.assertIsNone(server.client)
+
+
+class TestProxyLazyConnectServiceAccount(LazyConnectTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'lazy-connect': True,
+        },
+        'ldap-proxy': {
+            'bind-service-account': True,
+            'allow-search': True,
+        }
+    }
+
+    @defer.inlineCallbacks
+    def test_service_account_bind_connects(self):
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_counting_server_and_client([
+            pureldap.LDAPBindResponse(resultCode=0),  # for service account
+        ], [
+            pureldap.LDAPSearchResultEntry(dn, [('someattr', ['somevalue'])]),
+            pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+        ])
+        yield client.bind(dn, 'secret')
+        self.assertEqual(self.backend_connects, 1)
+        entry = LDAPEntry(client, dn)
+        results = yield entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
+        self.assertEqual(len(results), 1)
+        server.client.assertSent(
+            pureldap.LDAPBindRequest(dn='uid=service,cn=users,dc=test,dc=local', auth='service-secret'),
+            pureldap.LDAPSearchRequest(baseObject=dn, scope=0, derefAliases=0, sizeLimit=0, timeLimit=0, typesOnly=0,
+                                       filter=pureldap.LDAPFilter_present(value='objectClass'), attributes=()),
+        )
+        self.assertEqual(self.backend_connects, 1)
+
+
+class TestProxyLazyConnectPendingLimit(ProxyTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'lazy-connect': True,
+            'max-pending-requests': 1,
+        },
+        'ldap-proxy': {
+            'allow-search': True,
+        }
+    }
+
+    @defer.inlineCallbacks
+    def test_too_many_pending_requests(self):
+        # The connection to the LDAP backend is never established
+        server, client = self.create_server_and_client(clientConnector=defer.Deferred)
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        d1 = entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        d2 = entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        yield self.assertFailure(d2, ldaperrors.LDAPBusy)
+        self.assertFalse(d1.called)
+        self.assertEqual(len(server.queuedRequests), 1)
+        self.assertTrue(server.connecting_backend)
+
+
+class TestProxyEagerConnect(ProxyTestCase):
+    """
+    Without ``lazy-connect``, the connection to the LDAP backend is established when the client connects.
+    Incoming requests are handled right away, but forwarded only once the connection has been established.
+    """
+    additional_config = {
+        'ldap-backend': {
+            'max-pending-requests': 1,
+        },
+        'ldap-proxy': {
+            'allow-search': True,
+        }
+    }
+
+    @defer.inlineCallbacks
+    def test_requests_queued_while_connecting(self):
+        dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        connecting = defer.Deferred()
+        server, client = self.create_server_and_client(clientConnector=lambda: connecting)
+        self.assertTrue(server.connecting_backend)
+        d1 = client.bind(dn, 'some-secret')
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        d2 = entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        # Wait until the bind has been queued. The search is held back until the bind has completed.
+        while len(server.queuedRequests) < 1 or not server.sequencer.held:
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.assertTrue(server.forwarded_passthrough_bind)
+        self.assertFalse(d1.called)
+        backend = server.clientTestDriver
+        backend.responses = [
+            [pureldap.LDAPBindResponse(resultCode=0)],
+            [pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode)],
+        ]
+        backend.connectionMade()
+        connecting.callback(backend)
+        yield d1
+        results = yield d2
+        self.assertEqual(len(results), 0)
+        backend.assertSent(
+            pureldap.LDAPBindRequest(dn=dn, auth='some-secret'),
+            pureldap.LDAPSearchRequest(baseObject='cn=users,dc=test,dc=local', scope=2, derefAliases=0,
+                                       sizeLimit=0, timeLimit=0, typesOnly=0,
+                                       filter=pureldap.LDAPFilter_present(value='objectClass'), attributes=()),
+        )
+
+    def test_failing_request_handler_replies(self):
+        server, client = self.create_server_and_client([])
+
+        def failing_handler(request, controls, reply):
+            raise RuntimeError('something went wrong')
+        server.handleBeforeForwardRequest = failing_handler
+        d = client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        d.addBoth(lambda result: self.flushLoggedErrors(RuntimeError) and result)
+        return self.assertFailure(d, ldaperrors.LDAPOther)
@@ -0,0 +1,86 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer, error
+
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestProxyMultiplexServiceAccount(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+        'hilda@default': 'secret2',
+    }
+
+    additional_config = {
+        'ldap-backend': {
+            'lazy-connect': True,
+        },
+        'ldap-proxy': {
+            'bind-service-account': True,
+            'multiplex-service-account': True,
+            'multiplex-connections': 1,
+            'allow-search': True,
+            'allow-connection-reuse': True,
+        }
+    }
+
+    def inject_shared_connection(self, *responses):
+        shared = self.inject_service_account_server(*responses)
+        self.factory.shared_connections.connector = self.factory.connect_service_account
+        return shared
+
+    @defer.inlineCallbacks
+    def test_sessions_share_connection(self):
+        dn1 = 'uid=hugo,cn=users,dc=test,dc=local'
+        dn2 = 'uid=hilda,cn=users,dc=test,dc=local'
+        shared = self.inject_shared_connection([
+            pureldap.LDAPBindResponse(resultCode=0),  # for service account
+        ], [
+            pureldap.LDAPSearchResultEntry(dn1, [('someattr', ['hugo'])]),
+            pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+        ], [
+            pureldap.LDAPSearchResultEntry(dn2, [('someattr', ['hilda'])]),
+            pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+        ])
+        server1, client1 = self.create_server_and_client()
+        server2, client2 = self.create_server_and_client()
+        yield client1.bind(dn1, 'secret')
+        yield client2.bind(dn2, 'secret2')
+        self.assertIs(server1.client, shared)
+        self.assertIs(server2.client, shared)
+        results1 = yield LDAPEntry(client1, dn1).search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
+        results2 = yield LDAPEntry(client2, dn2).search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
+        # Each client receives its own results
+        self.assertEqual(list(results1[0]['someattr']), [b'hugo'])
+        self.assertEqual(list(results2[0]['someattr']), [b'hilda'])
+        # Only the shared connection has been bound as the service account, and only once
+        self.assertEqual(shared.sent[0],
+                         pureldap.LDAPBindRequest(dn='uid=service,cn=users,dc=test,dc=local', auth='service-secret'))
+        self.assertEqual(len(shared.sent), 3)
+        server1.clientTestDriver.assertNothingSent()
+        server2.clientTestDriver.assertNothingSent()
+        # Disconnecting one client must not close the shared connection
+        server1.handle_LDAPUnbindRequest(pureldap.LDAPUnbindRequest(), None, lambda response: None)
+        server1.connectionLost(error.ConnectionDone)
+        self.assertTrue(shared.connected)
+        self.assertEqual(len(shared.sent), 3)
+        self.assertIs(server2.client, shared)
+
+    @defer.inlineCallbacks
+    def test_rebind_uses_own_connection(self):
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        shared = self.inject_shared_connection([
+            pureldap.LDAPBindResponse(resultCode=0),  # for service account
+        ])
+        server, client = self.create_server_and_client([
+            pureldap.LDAPBindResponse(resultCode=0),  # passthrough bind
+        ])
+        yield client.bind(dn, 'secret')
+        self.assertIs(server.client, shared)
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        self.assertIs(server.client, server.clientTestDriver)
+        server.clientTestDriver.assertSent(
+            pureldap.LDAPBindRequest(dn='uid=passthrough,cn=users,dc=test,dc=local', auth='some-secret'),
+        )
+        self.assertEqual(len(shared.sent), 1)
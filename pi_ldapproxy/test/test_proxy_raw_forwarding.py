@@ -0,0 +1,66 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+
+from pi_ldapproxy.rawforward import RawForwardingLDAPClient, peek_message
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestProxyRawForwarding(ProxyTestCase):
+    additional_config = {
+        'ldap-proxy': {
+            'allow-search': True,
+            'raw-forwarding': True,
+        },
+        'app-cache': {
+            'enabled': True,
+        },
+    }
+
+    def create_raw_server_and_client(self):
+        self.backend = RawForwardingLDAPClient()
+        self.backend_transport = proto_helpers.StringTransport()
+        self.backend.makeConnection(self.backend_transport)
+        return self.create_server_and_client(clientConnector=lambda: defer.succeed(self.backend))
+
+    @defer.inlineCallbacks
+    def receive_request(self):
+        """
+        Wait for the next request to the LDAP backend and return its message ID.
+        """
+        while not self.backend_transport.value():
+            yield task.deferLater(reactor, 0, lambda: None)
+        message_id, tag, op_offset = peek_message(self.backend_transport.value())
+        self.backend_transport.clear()
+        defer.returnValue(message_id)
+
+    def respond(self, message_id, *responses):
+        self.backend.dataReceived(b''.join(pureldap.LDAPMessage(response, id=message_id).toWire()
+                                           for response in responses))
+
+    @defer.inlineCallbacks
+    def test_raw_search(self):
+        self.factory.app_cache.callLater = task.Clock().callLater
+        passthrough_dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        server, client = self.create_raw_server_and_client()
+        d = client.bind(passthrough_dn, 'some-secret')
+        message_id = yield self.receive_request()
+        self.respond(message_id, pureldap.LDAPBindResponse(resultCode=0))
+        yield d
+        entry = LDAPEntry(client, 'cn=users,dc=test,dc=local')
+        d = entry.search('(|(uid=hugo)(objectclass=App-someApp))', scope=pureldap.LDAP_SCOPE_wholeSubtree)
+        message_id = yield self.receive_request()
+        self.respond(message_id,
+                     pureldap.LDAPSearchResultEntry('uid=hugo,cn=users,dc=test,dc=local',
+                                                    [('mail', ['hugo@example.com'])]),
+                     pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode))
+        results = yield d
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].dn.getText(), 'uid=hugo,cn=users,dc=test,dc=local')
+        self.assertEqual(list(results[0]['mail']), [b'hugo@example.com'])
+        self.assertEqual(server.search_response_entries, 0)
+        # The login preamble has been detected nevertheless
+        self.assertEqual(self.factory.app_cache.get_cached_marker('uid=hugo,cn=users,dc=test,dc=local'),
+                         'someApp')
@@ -0,0 +1,91 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer
+
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestProxySearchCache(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret'
+    }
+    additional_config = {
+        'ldap-proxy': {
+            'allow-search': True,
+        },
+        'search-cache': {
+            'enabled': True,
+        }
+    }
+
+    def search_response(self, dn):
+        return [
+            pureldap.LDAPSearchResultEntry(dn, [('someattr', ['somevalue'])]),
+            pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+        ]
+
+    def search_request(self, dn):
+        return pureldap.LDAPSearchRequest(baseObject=dn, scope=0, derefAliases=0, sizeLimit=0, timeLimit=0,
+                                          typesOnly=0, filter=pureldap.LDAPFilter_present(value='objectClass'),
+                                          attributes=())
+
+    @defer.inlineCallbacks
+    def _search(self, client, dn):
+        entry = LDAPEntry(client, dn)
+        results = yield entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_cached_search(self):
+        passthrough_dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_server_and_client(
+            [pureldap.LDAPBindResponse(resultCode=0)],
+            self.search_response(dn),
+        )
+        yield client.bind(passthrough_dn, 'some-secret')
+        results1 = yield self._search(client, dn)
+        results2 = yield self._search(client, dn)
+        self.assertEqual(len(results1), 1)
+        self.assertEqual(len(results2), 1)
+        self.assertEqual(results1[0].dn, results2[0].dn)
+        server.client.assertSent(
+            pureldap.LDAPBindRequest(dn=passthrough_dn, auth='some-secret'),
+            self.search_request(dn),
+        )
+        self.assertEqual(self.factory.search_cache.hits, 1)
+        # Another session bound as the same identity gets the cached results as well
+        server2, client2 = self.create_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        yield client2.bind(passthrough_dn, 'some-secret')
+        results3 = yield self._search(client2, dn)
+        self.assertEqual(len(results3), 1)
+        server2.client.assertSent(
+            pureldap.LDAPBindRequest(dn=passthrough_dn, auth='some-secret'),
+        )
+
+    @defer.inlineCallbacks
+    def test_failed_bind_not_cached(self):
+        passthrough_dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_server_and_client(
+            [pureldap.LDAPBindResponse(resultCode=ldaperrors.LDAPInvalidCredentials.resultCode)],
+            self.search_response(dn),
+        )
+        yield self.assertFailure(client.bind(passthrough_dn, 'wrong'), ldaperrors.LDAPInvalidCredentials)
+        yield self._search(client, dn)
+        self.assertEqual(len(self.factory.search_cache), 0)
+        self.assertIsNone(server.backend_identity)
+
+    @defer.inlineCallbacks
+    def test_failed_search_not_cached(self):
+        passthrough_dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_server_and_client(
+            [pureldap.LDAPBindResponse(resultCode=0)],
+            [pureldap.LDAPSearchResultDone(ldaperrors.LDAPNoSuchObject.resultCode)],
+        )
+        yield client.bind(passthrough_dn, 'some-secret')
+        yield self.assertFailure(self._search(client, dn), ldaperrors.LDAPNoSuchObject)
+        self.assertEqual(len(self.factory.search_cache), 0)
+        self.assertFalse(server.search_cache_collectors)
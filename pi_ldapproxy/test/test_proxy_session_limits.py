@@ -0,0 +1,87 @@
+from ldaptor.protocols import pureldap
+from twisted.internet import address, defer, error
+
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestProxySessionLimits(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret'
+    }
+    additional_config = {
+        'limits': {
+            'max-connections-per-ip': 1,
+            'idle-timeout': 60,
+            'bind-timeout': 10,
+        },
+    }
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        self.limits = self.factory.session_limits
+        self.limits.callLater = self.clock.callLater
+        self.limits.seconds = self.clock.seconds
+
+    def create_tracked_server_and_client(self, *responses):
+        server, client = self.create_server_and_client(*responses)
+        closed = []
+        server.close_session = lambda abort=False: closed.append(True)
+        return server, client, closed
+
+    def test_connection_limit(self):
+        addr = address.IPv4Address('TCP', '192.0.2.1', 12345)
+        proto = self.factory.buildProtocol(addr)
+        self.assertIsNotNone(proto)
+        self.limits.register(proto, '192.0.2.1')
+        self.assertIsNone(self.factory.buildProtocol(addr))
+        self.assertIsNotNone(self.factory.buildProtocol(address.IPv4Address('TCP', '192.0.2.2', 12345)))
+        self.limits.unregister(proto)
+        self.assertIsNotNone(self.factory.buildProtocol(addr))
+
+    def test_bind_timeout(self):
+        server, client, closed = self.create_tracked_server_and_client()
+        self.assertEqual(len(self.limits), 1)
+        self.clock.advance(10)
+        self.assertEqual(closed, [True])
+        server.connectionLost(error.ConnectionDone())
+        self.assertEqual(len(self.limits), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_idle_timeout(self):
+        server, client, closed = self.create_tracked_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertTrue(server.authenticated)
+        self.clock.advance(59)
+        self.assertEqual(closed, [])
+        self.clock.advance(1)
+        self.assertEqual(closed, [True])
+        server.connectionLost(error.ConnectionDone())
+
+    @defer.inlineCallbacks
+    def test_activity_resets_idle_timeout(self):
+        server, client, closed = self.create_tracked_server_and_client([
+            pureldap.LDAPBindResponse(resultCode=0),
+        ])
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        self.assertTrue(server.authenticated)
+        self.clock.advance(30)
+        server.handle(pureldap.LDAPMessage(pureldap.LDAPAbandonRequest(id=1)))
+        self.clock.advance(30)
+        self.assertEqual(closed, [])
+        self.clock.advance(30)
+        self.assertEqual(closed, [True])
+        server.connectionLost(error.ConnectionDone())
+
+    @defer.inlineCallbacks
+    def test_drain_on_shutdown(self):
+        server, client, closed = self.create_tracked_server_and_client([
+            pureldap.LDAPBindResponse(resultCode=0),
+        ])
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        self.factory.stopFactory()
+        self.assertEqual(closed, [True])
+        self.assertNoResult(self.factory.stopped)
+        server.connectionLost(error.ConnectionDone())
+        self.successResultOf(self.factory.stopped)
+        self.assertIsNone(self.factory.buildProtocol(address.IPv4Address('TCP', '192.0.2.2', 12345)))
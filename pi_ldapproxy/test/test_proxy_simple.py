@@ -237,7 +237,7 @@ class TestProxyReuseNoServiceBind(ProxyTestCase):
         self.assertTrue(server.received_bind_request)
         self.assertTrue(server.forwarded_passthrough_bind)
         self.assertEqual(server.search_response_entries, 0)
-        self.assertIsNone(server.last_search_response_entry)
+        self.assertIsNone(server.last_search_response_dn)
         yield client.bind(dn, 'secret')
         self.assertEqual(len(server.client.sent), 2)
         # Check that the bind requests was sent properly
@@ -247,7 +247,7 @@ class TestProxyReuseNoServiceBind(ProxyTestCase):
         self.assertTrue(server.received_bind_request)
         self.assertFalse(server.forwarded_passthrough_bind)
         self.assertEqual(server.search_response_entries, 0)
-        self.assertIsNone(server.last_search_response_entry)
+        self.assertIsNone(server.last_search_response_dn)
 
 class TestProxyForwardAnonymousBind(ProxyTestCase):
     additional_config = {
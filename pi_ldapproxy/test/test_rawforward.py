@@ -0,0 +1,83 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from pi_ldapproxy.rawforward import RawForwardingLDAPClient, pdu_end, peek_message, peek_object_name, \
+    rewrite_message_id, SEARCH_RESULT_ENTRY_TAG
+
+
+def entry_pdu(dn, message_id, attribute_count=1):
+    attributes = [('attr{}'.format(i), ['value' * 100]) for i in range(attribute_count)]
+    return pureldap.LDAPMessage(pureldap.LDAPSearchResultEntry(dn, attributes), id=message_id).toWire()
+
+
+def done_pdu(message_id):
+    return pureldap.LDAPMessage(pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode), id=message_id).toWire()
+
+
+class RawPDUTest(unittest.TestCase):
+    def test_peek_message(self):
+        for message_id in [1, 127, 128, 300, 2 ** 31 - 1]:
+            pdu = entry_pdu('uid=hugo,cn=users,dc=test,dc=local', message_id, attribute_count=5)
+            self.assertEqual(pdu_end(pdu), len(pdu))
+            self.assertIsNone(pdu_end(pdu[:-1]))
+            self.assertIsNone(pdu_end(pdu[:1]))
+            parsed_id, tag, op_offset = peek_message(pdu)
+            self.assertEqual(parsed_id, message_id)
+            self.assertEqual(tag, SEARCH_RESULT_ENTRY_TAG)
+            self.assertEqual(peek_object_name(memoryview(pdu), op_offset), b'uid=hugo,cn=users,dc=test,dc=local')
+
+    def test_rewrite_message_id(self):
+        pdu = entry_pdu('uid=hugo,cn=users,dc=test,dc=local', 5, attribute_count=5)
+        message_id, tag, op_offset = peek_message(pdu)
+        for new_id in [1, 300, 70000]:
+            self.assertEqual(rewrite_message_id(memoryview(pdu), op_offset, new_id),
+                             entry_pdu('uid=hugo,cn=users,dc=test,dc=local', new_id, attribute_count=5))
+
+
+class RawForwardingLDAPClientTest(unittest.TestCase):
+    def setUp(self):
+        self.client = RawForwardingLDAPClient()
+        self.transport = proto_helpers.StringTransport()
+        self.client.makeConnection(self.transport)
+        self.raw = []
+        self.decoded = []
+        self.consume = True
+
+    def raw_handler(self, pdu, op_offset):
+        if self.consume:
+            self.raw.append(peek_object_name(pdu, op_offset))
+        return self.consume
+
+    def handler(self, response):
+        self.decoded.append(response)
+        return isinstance(response, pureldap.LDAPSearchResultDone)
+
+    def send_search(self):
+        request = pureldap.LDAPSearchRequest(baseObject='dc=test,dc=local', filter=pureldap.LDAPFilter_present('cn'))
+        self.client.send_multiResponse_raw(request, self.raw_handler, self.handler)
+        message_id, tag, op_offset = peek_message(self.transport.value())
+        self.transport.clear()
+        return message_id
+
+    def test_raw_entries(self):
+        message_id = self.send_search()
+        data = entry_pdu('uid=a', message_id) + entry_pdu('uid=b', message_id) + done_pdu(message_id)
+        # deliver the data in small chunks
+        for offset in range(0, len(data), 7):
+            self.client.dataReceived(data[offset:offset + 7])
+        self.assertEqual(self.raw, [b'uid=a', b'uid=b'])
+        self.assertEqual(len(self.decoded), 1)
+        self.assertIsInstance(self.decoded[0], pureldap.LDAPSearchResultDone)
+        self.assertEqual(self.client.raw_handlers, {})
+        self.assertEqual(self.client.onwire, {})
+        self.assertEqual(self.client.buffer, b'')
+
+    def test_declined_entries_are_decoded(self):
+        message_id = self.send_search()
+        self.consume = False
+        self.client.dataReceived(entry_pdu('uid=a', message_id) + done_pdu(message_id))
+        self.assertEqual(self.raw, [])
+        self.assertEqual(len(self.decoded), 2)
+        self.assertEqual(self.decoded[0].objectName, b'uid=a')
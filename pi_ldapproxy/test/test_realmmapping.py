@@ -2,7 +2,7 @@ import twisted
 from ldaptor.ldapfilter import parseFilter
 from ldaptor.protocols import pureldap
 
-from pi_ldapproxy.realmmapping import find_app_marker, detect_login_preamble
+from pi_ldapproxy.realmmapping import find_app_marker, detect_login_preamble, strip_app_marker
 
 
 class TestRealmMapping(twisted.trial.unittest.TestCase):
@@ -20,6 +20,26 @@ class TestRealmMapping(twisted.trial.unittest.TestCase):
         filter = parseFilter('(&(|(objectclass=person))(cn=user123))')
         self.assertIsNone(find_app_marker(filter))
 
+    def test_strip_app_marker(self):
+        filter = parseFilter('(&(|(objectclass=person)(objectclass=App-someApp))(cn=user123))')
+        self.assertEqual(strip_app_marker(filter).asText(), '(&(objectclass=person)(cn=user123))')
+
+        filter = parseFilter('(|(objectclass=person)(cn=user123)(objectclass=App-someApp))')
+        self.assertEqual(strip_app_marker(filter).asText(), '(|(objectclass=person)(cn=user123))')
+
+        filter = parseFilter('(&(|(objectclass=person)(someOtherAttribute=Prefix-someApp))(cn=user123))')
+        self.assertEqual(strip_app_marker(filter, 'someOtherAttribute', 'Prefix-').asText(),
+                         '(&(objectclass=person)(cn=user123))')
+
+        # These filters would change their semantics, so they are kept
+        for text in ['(objectclass=App-someApp)',
+                     '(|(objectclass=App-someApp))',
+                     '(&(objectclass=App-someApp)(cn=user123))',
+                     '(!(|(objectclass=person)(objectclass=App-someApp)))',
+                     '(&(|(objectclass=person))(cn=user123))']:
+            filter = parseFilter(text)
+            self.assertIs(strip_app_marker(filter), filter)
+
     def test_detect_login_preamble(self):
         filter = parseFilter('(&(|(objectclass=person)(objectclass=App-someApp))(cn=user123))')
         request = pureldap.LDAPSearchRequest(baseObject='cn=users,dc=test,dc=local',
@@ -42,3 +62,13 @@ class TestRealmMapping(twisted.trial.unittest.TestCase):
         dn = 'cn=user123,cn=users,dc=test,dc=local'
         response = pureldap.LDAPSearchResultEntry(dn, [('cn', ['user123'])])
         self.assertEqual(detect_login_preamble(request, response, 'someAttribute', 'Foo-'), (dn, 'someApp'))
+
+        # The app marker may have been stripped from the filter already
+        filter = parseFilter('(&(objectclass=person)(cn=user123))')
+        request = pureldap.LDAPSearchRequest(baseObject='cn=users,dc=test,dc=local',
+                                             scope=pureldap.LDAP_SCOPE_wholeSubtree, derefAliases=0,
+                                             sizeLimit=0, timeLimit=0, typesOnly=0,
+                                             filter=filter,
+                                             attributes=())
+        self.assertIsNone(detect_login_preamble(request, response))
+        self.assertEqual(detect_login_preamble(request, response, marker='someApp'), (dn, 'someApp'))
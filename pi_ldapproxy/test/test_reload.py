@@ -0,0 +1,97 @@
+from ldaptor.protocols import pureldap
+from twisted.internet import defer
+
+from pi_ldapproxy.services import reload_config
+from pi_ldapproxy.test.util import BASE_CONFIG, ProxyTestCase
+
+
+class TestReloadConfig(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+    }
+    additional_config = {
+        'bind-cache': {
+            'enabled': True,
+        },
+        'app-cache': {
+            'enabled': True,
+        },
+    }
+
+    def reloaded_config(self, **changes):
+        config = self.get_config()
+        for section, contents in changes.items():
+            for key, value in contents.items():
+                config[section][key] = value
+        return config
+
+    def write_config(self, text):
+        filename = self.mktemp()
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    @defer.inlineCallbacks
+    def test_add_passthrough_dn(self):
+        server, client = self.create_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        bind_cache, routes = self.factory.bind_cache, self.factory.routes
+        self.factory.apply_config(self.reloaded_config(**{'ldap-proxy': {
+            'passthrough-binds': ['uid=passthrough,cn=users,dc=test,dc=local', 'uid=other,cn=users,dc=test,dc=local'],
+        }}))
+        self.assertEqual(len(self.factory.passthrough_binds), 2)
+        # Compatible caches and the LDAP backends are kept
+        self.assertIs(self.factory.bind_cache, bind_cache)
+        self.assertIs(self.factory.routes, routes)
+        # The existing session uses the new configuration
+        yield client.bind('uid=other,cn=users,dc=test,dc=local', 'some-secret')
+        self.assertEqual(self.privacyidea.authentication_requests, [])
+
+    def test_incompatible_caches_are_replaced(self):
+        bind_cache, app_cache = self.factory.bind_cache, self.factory.app_cache
+        self.factory.apply_config(self.reloaded_config(**{
+            'bind-cache': {'timeout': 10},
+            'app-cache': {'case-insensitive': True},
+        }))
+        self.assertIs(self.factory.bind_cache, bind_cache)
+        self.assertEqual(bind_cache.timeout, 10)
+        self.assertIsNot(self.factory.app_cache, app_cache)
+        self.assertTrue(self.factory.app_cache.case_insensitive)
+        self.factory.apply_config(self.reloaded_config(**{'bind-cache': {'enabled': False}}))
+        self.assertIsNone(self.factory.bind_cache)
+
+    def test_backends_are_replaced(self):
+        routes = self.factory.routes
+        self.factory.apply_config(self.reloaded_config(**{'ldap-backend': {
+            'endpoint': ['tcp:host=example.com:port=1338'],
+            'health-check-interval': 10,
+        }}))
+        self.assertIsNot(self.factory.routes, routes)
+        self.assertEqual([backend.endpoint for backend in self.factory.backends.backends],
+                         ['tcp:host=example.com:port=1338'])
+        self.factory.backends.stop_health_checks()
+
+    def test_session_limits_are_updated(self):
+        limits = self.factory.session_limits
+        self.factory.apply_config(self.reloaded_config(limits={'max-connections': 5}))
+        self.assertIs(self.factory.session_limits, limits)
+        self.assertEqual(limits.max_connections, 5)
+
+    def test_invalid_config_is_not_applied(self):
+        config = self.reloaded_config(**{
+            'ldap-proxy': {'allow-search': True},
+            'user-mapping': {'strategy': 'unknown'},
+        })
+        self.assertRaises(KeyError, self.factory.apply_config, config)
+        self.assertFalse(self.factory.allow_search)
+
+    def test_reload_config(self):
+        filename = self.write_config(BASE_CONFIG.replace('allow-search = false', 'allow-search = true'))
+        self.assertTrue(reload_config(self.factory, filename))
+        self.assertTrue(self.factory.allow_search)
+
+    def test_reload_invalid_config(self):
+        filename = self.write_config(BASE_CONFIG.replace('bind-service-account = false',
+                                                         'bind-service-account = maybe'))
+        self.assertFalse(reload_config(self.factory, filename))
+        self.assertFalse(reload_config(self.factory, filename + '.missing'))
+        self.assertFalse(self.factory.bind_service_account)
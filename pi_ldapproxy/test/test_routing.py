@@ -0,0 +1,150 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from pi_ldapproxy.routing import Route, RoutingTable, split_dn
+from pi_ldapproxy.test.mock import MockLDAPClient
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class RoutingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.default = Route('default', None, None, 'uid=service', 'secret')
+        self.branch = Route('branch', 'ou=Branch, dc=example,dc=com', None, 'uid=service', 'secret')
+        self.sub = Route('sub', 'ou=sub,ou=branch,dc=example,dc=com', None, 'uid=service', 'secret')
+        self.table = RoutingTable([self.branch, self.sub], self.default)
+
+    def test_split_dn(self):
+        self.assertEqual(split_dn(r'uid=Hugo\, Jr.,  OU=Users ,dc=com'), [r'uid=hugo\, jr.', 'ou=users', 'dc=com'])
+        self.assertEqual(split_dn(''), [])
+
+    def test_longest_suffix(self):
+        self.assertIs(self.table.route_for('uid=hugo,ou=branch,dc=example,dc=com'), self.branch)
+        self.assertIs(self.table.route_for('uid=hugo,ou=SUB,ou=branch,dc=example,dc=com'), self.sub)
+        self.assertIs(self.table.route_for('ou=branch,dc=example,dc=com'), self.branch)
+
+    def test_default_route(self):
+        self.assertIs(self.table.route_for('uid=hugo,ou=other,dc=example,dc=com'), self.default)
+        self.assertIs(self.table.route_for('uid=hugo,xou=branch,dc=example,dc=com'), self.default)
+        self.assertIs(self.table.route_for(''), self.default)
+
+    def test_duplicate_suffix(self):
+        other = Route('other', 'OU=Branch,dc=example,dc=com', None, 'uid=service', 'secret')
+        self.assertRaises(ValueError, RoutingTable, [self.branch, other], self.default)
+
+
+class TestProxyRouting(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret'
+    }
+    additional_config = {
+        'ldap-backend': {
+            'lazy-connect': True,
+        },
+        'ldap-proxy': {
+            'passthrough-binds': ['uid=passthrough,cn=users,dc=test,dc=local',
+                                  'uid=passthrough,ou=branch,dc=test,dc=local'],
+            'allow-search': True,
+        },
+        'user-mapping': {
+            'strategy': 'match',
+            'pattern': 'uid=([^,]+),.*',
+        },
+        'routes': {
+            'branch': {
+                'suffix': 'ou=branch,dc=test,dc=local',
+                'endpoint': ['tcp:host=branch.example.com:port=389'],
+                'balancing': 'round-robin',
+                'service-account-dn': 'uid=branch-service,ou=branch,dc=test,dc=local',
+                'service-account-password': 'branch-secret',
+            },
+        },
+    }
+
+    def create_routed_server_and_client(self, default_responses, branch_responses):
+        self.default_connects = 0
+        server, client = self.create_server_and_client(*default_responses)
+        original_connector = server.clientConnector
+
+        def counting_connector():
+            self.default_connects += 1
+            return original_connector()
+        server.clientConnector = counting_connector
+        branch_client = MockLDAPClient(*branch_responses)
+
+        def branch_connect():
+            branch_client.connectionMade()
+            return defer.succeed(branch_client)
+        route = self.factory.route_for('ou=branch,dc=test,dc=local')
+        self.assertEqual(route.name, 'branch')
+        route.backends.connect = branch_connect
+        return server, client, branch_client
+
+    @defer.inlineCallbacks
+    def test_passthrough_bind(self):
+        dn = 'uid=passthrough,ou=branch,dc=test,dc=local'
+        server, client, branch_client = self.create_routed_server_and_client([], [
+            [pureldap.LDAPBindResponse(resultCode=0)],
+            [pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode)],
+        ])
+        yield client.bind(dn, 'some-secret')
+        entry = LDAPEntry(client, 'ou=branch,dc=test,dc=local')
+        yield entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
+        self.assertIs(server.client, branch_client)
+        self.assertEqual(self.default_connects, 0)
+        branch_client.assertSent(
+            pureldap.LDAPBindRequest(dn=dn, auth='some-secret'),
+            pureldap.LDAPSearchRequest(baseObject='ou=branch,dc=test,dc=local', scope=0, derefAliases=0,
+                                       sizeLimit=0, timeLimit=0, typesOnly=0,
+                                       filter=pureldap.LDAPFilter_present(value='objectClass'), attributes=()),
+        )
+
+    @defer.inlineCallbacks
+    def test_default_route(self):
+        dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        server, client, branch_client = self.create_routed_server_and_client([
+            [pureldap.LDAPBindResponse(resultCode=0)],
+        ], [])
+        yield client.bind(dn, 'some-secret')
+        self.assertEqual(self.default_connects, 1)
+        self.assertIsNone(server.route)
+        branch_client.assertNothingSent()
+
+    @defer.inlineCallbacks
+    def test_rebind_switches_route(self):
+        self.factory.allow_connection_reuse = True
+        server, client, branch_client = self.create_routed_server_and_client([
+            [pureldap.LDAPBindResponse(resultCode=0)],
+        ], [
+            [pureldap.LDAPBindResponse(resultCode=0)],
+        ])
+        yield client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        default_client = server.client
+        yield client.bind('uid=passthrough,ou=branch,dc=test,dc=local', 'some-secret')
+        self.assertFalse(default_client.connected)
+        self.assertIs(server.client, branch_client)
+
+    @defer.inlineCallbacks
+    def test_service_account_of_route(self):
+        self.factory.bind_service_account = True
+        server, client, branch_client = self.create_routed_server_and_client([], [
+            [pureldap.LDAPBindResponse(resultCode=0)],
+        ])
+        yield client.bind('uid=hugo,ou=branch,dc=test,dc=local', 'secret')
+        self.assertEqual(self.default_connects, 0)
+        branch_client.assertSent(
+            pureldap.LDAPBindRequest(dn='uid=branch-service,ou=branch,dc=test,dc=local', auth='branch-secret'),
+        )
+
+    @defer.inlineCallbacks
+    def test_lookup_uses_route(self):
+        server, client, branch_client = self.create_routed_server_and_client([], [
+            [pureldap.LDAPBindResponse(resultCode=0)],
+        ])
+        lookup_client = yield self.factory.connect_service_account_for('uid=hugo,ou=branch,dc=test,dc=local')
+        self.assertIs(lookup_client, branch_client)
+        branch_client.assertSent(
+            pureldap.LDAPBindRequest(dn='uid=branch-service,ou=branch,dc=test,dc=local', auth='branch-secret'),
+        )
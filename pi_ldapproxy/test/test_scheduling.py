@@ -0,0 +1,175 @@
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from twisted.internet import defer, error, reactor, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.scheduling import PRIORITY_PASSTHROUGH, PRIORITY_SERVICE_ACCOUNT, PRIORITY_USER, \
+    PriorityScheduler
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class PrioritySchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = PriorityScheduler(max_concurrent=1)
+        #: Map of job names to the callables which complete them
+        self.started = {}
+        self.rejected = []
+
+    def submit(self, name, priority=PRIORITY_USER, host='192.0.2.1', session=None):
+        self.scheduler.submit(session or name, priority, host,
+                              lambda release: self.started.__setitem__(name, release),
+                              lambda: self.rejected.append(name))
+
+    def complete(self, name):
+        self.started.pop(name)()
+
+    def test_priority(self):
+        self.submit('first')
+        self.submit('user')
+        self.submit('service-account', PRIORITY_SERVICE_ACCOUNT)
+        self.submit('passthrough', PRIORITY_PASSTHROUGH)
+        self.assertEqual(list(self.started), ['first'])
+        self.assertEqual(self.scheduler.queued_by_class(), [('passthrough', 1), ('service-account', 1), ('user', 1)])
+        for name in ('first', 'passthrough', 'service-account'):
+            self.complete(name)
+        self.assertEqual(list(self.started), ['user'])
+        self.complete('user')
+        self.assertEqual((self.scheduler.running, self.scheduler.queued), (0, 0))
+
+    def test_fair_queuing(self):
+        self.submit('running')
+        # One host floods the proxy, but the other host gets its turn
+        for i in range(3):
+            self.submit('flood-{}'.format(i), host='192.0.2.1')
+        self.submit('other', host='192.0.2.2')
+        order = []
+        self.complete('running')
+        while self.started:
+            name, = self.started
+            order.append(name)
+            self.complete(name)
+        self.assertEqual(order, ['flood-0', 'other', 'flood-1', 'flood-2'])
+
+    def test_release_once(self):
+        self.submit('first')
+        release = self.started['first']
+        self.submit('second')
+        self.submit('third')
+        release()
+        release()
+        self.assertEqual(list(self.started), ['first', 'second'])
+
+    def test_max_queued(self):
+        self.scheduler.configure(1, max_queued=1)
+        self.submit('first')
+        self.submit('second')
+        self.submit('third')
+        self.assertEqual(self.rejected, ['third'])
+        self.assertEqual(self.scheduler.rejected, 1)
+
+    def test_forget(self):
+        self.submit('first', session='a')
+        self.submit('second', session='a')
+        self.submit('third', session='b')
+        self.scheduler.forget('a')
+        self.assertEqual(sorted(self.started), ['first', 'third'])
+        self.assertEqual((self.scheduler.running, self.scheduler.queued), (1, 0))
+        # Completing an operation of a forgotten session has no effect
+        self.complete('first')
+        self.assertEqual(self.scheduler.running, 1)
+
+    def test_configure(self):
+        self.submit('first')
+        self.submit('second')
+        self.scheduler.configure(2)
+        self.assertEqual(sorted(self.started), ['first', 'second'])
+        # Scheduling is disabled
+        self.scheduler.configure(0)
+        self.submit('third')
+        self.assertEqual(self.scheduler.running, 3)
+
+
+class TestProxyScheduling(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+        'anna@default': 'secret',
+    }
+    additional_config = {
+        'scheduling': {
+            'max-concurrent': 1,
+        },
+    }
+
+    def hold_validation(self, server, observe=lambda: None):
+        """
+        Let privacyIDEA requests of *server* wait until the returned Deferred has fired.
+        :param observe: callable which is invoked once a request is issued
+        """
+        validated = defer.Deferred()
+        requests = []
+
+        def request_validate(*args):
+            observe()
+            requests.append(args)
+            return validated.addCallback(lambda _: self.privacyidea.authenticate(*args))
+        server.request_validate = request_validate
+        validated.requests = requests
+        return validated
+
+    @defer.inlineCallbacks
+    def wait_for(self, predicate):
+        while not predicate():
+            yield task.deferLater(reactor, 0, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_passthrough_before_user_binds(self):
+        server1, client1 = self.create_server_and_client([])
+        validated1 = self.hold_validation(server1)
+        server3, client3 = self.create_server_and_client([pureldap.LDAPBindResponse(resultCode=0)])
+        server2, client2 = self.create_server_and_client([])
+        # The passthrough bind overtakes the user bind which has been received earlier
+        passthrough_sent = []
+        validated2 = self.hold_validation(server2, lambda: passthrough_sent.append(server3.clientTestDriver.sent[:]))
+        d1 = client1.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for(lambda: validated1.requests)
+        d2 = client2.bind('uid=anna,cn=users,dc=test,dc=local', 'secret')
+        d3 = client3.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        yield self.wait_for(lambda: self.factory.scheduler.queued == 2)
+        self.assertIn('ldapproxy_scheduler_queued_operations{class="passthrough"} 1',
+                      self.factory.metrics.render().splitlines())
+        validated1.callback(None)
+        yield defer.gatherResults([d1, d3])
+        yield self.wait_for(lambda: validated2.requests)
+        self.assertEqual(len(passthrough_sent[0]), 1)
+        validated2.callback(None)
+        yield d2
+        self.assertEqual(self.factory.scheduler.running, 0)
+
+    @defer.inlineCallbacks
+    def test_disconnect_frees_slot(self):
+        server1, client1 = self.create_server_and_client([])
+        validated1 = self.hold_validation(server1)
+        server2, client2 = self.create_server_and_client([])
+        client1.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for(lambda: validated1.requests)
+        d2 = client2.bind('uid=anna,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for(lambda: self.factory.scheduler.queued == 1)
+        server1.connectionLost(error.ConnectionDone())
+        yield d2
+        self.assertEqual(self.factory.scheduler.running, 0)
+
+    @defer.inlineCallbacks
+    def test_queue_full(self):
+        self.factory.scheduler.configure(1, max_queued=1)
+        server1, client1 = self.create_server_and_client([])
+        validated1 = self.hold_validation(server1)
+        server2, client2 = self.create_server_and_client([])
+        server3, client3 = self.create_server_and_client([])
+        d1 = client1.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for(lambda: validated1.requests)
+        d2 = client2.bind('uid=anna,cn=users,dc=test,dc=local', 'secret')
+        yield self.wait_for(lambda: self.factory.scheduler.queued == 1)
+        yield self.assertFailure(client3.bind('uid=anna,cn=users,dc=test,dc=local', 'secret'), ldaperrors.LDAPBusy)
+        self.assertEqual(self.factory.metrics.bind_outcomes['busy'], 1)
+        validated1.callback(None)
+        yield defer.gatherResults([d1, d2])
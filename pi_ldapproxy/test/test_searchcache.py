@@ -0,0 +1,71 @@
+from ldaptor.protocols import pureldap
+from twisted.internet import task
+from twisted.trial import unittest
+
+from pi_ldapproxy.searchcache import SearchCache, search_cache_key
+
+IDENTITY = (None, 'uid=service,cn=users,dc=test,dc=local')
+
+
+def search_request(base='cn=users,dc=test,dc=local', attributes=()):
+    return pureldap.LDAPSearchRequest(baseObject=base, scope=pureldap.LDAP_SCOPE_wholeSubtree,
+                                      filter=pureldap.LDAPFilter_present(value='objectClass'),
+                                      attributes=attributes)
+
+
+class SearchCacheKeyTest(unittest.TestCase):
+    def test_normalization(self):
+        key1 = search_cache_key(IDENTITY, search_request('cn=users, DC=test,dc=local', ['mail', 'CN']), None)
+        key2 = search_cache_key(IDENTITY, search_request('CN=Users,dc=test,dc=local', ['cn', 'mail']), [])
+        self.assertEqual(key1, key2)
+
+    def test_identity_and_controls(self):
+        key = search_cache_key(IDENTITY, search_request(), None)
+        self.assertNotEqual(key, search_cache_key((None, 'uid=other'), search_request(), None))
+        self.assertNotEqual(key, search_cache_key(IDENTITY, search_request(), [('1.2.840.113556.1.4.319', False, b'')]))
+        self.assertNotEqual(key, search_cache_key(IDENTITY, search_request(attributes=['cn']), None))
+
+
+class SearchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def create_cache(self, timeout=10, max_size=100):
+        cache = SearchCache(timeout, max_size)
+        cache.seconds = self.clock.seconds
+        return cache
+
+    def test_timeout(self):
+        cache = self.create_cache(timeout=10)
+        self.assertTrue(cache.add('a', ['response'], 10))
+        self.clock.advance(9)
+        self.assertEqual(cache.get('a'), ['response'])
+        self.clock.advance(1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = self.create_cache(max_size=100)
+        cache.add('a', ['a'], 40)
+        cache.add('b', ['b'], 40)
+        # 'a' is now used more recently than 'b'
+        cache.get('a')
+        cache.add('c', ['c'], 40)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), ['a'])
+        self.assertEqual(cache.get('c'), ['c'])
+        self.assertEqual(cache.size, 80)
+
+    def test_too_large(self):
+        cache = self.create_cache(max_size=100)
+        cache.add('a', ['a'], 40)
+        self.assertFalse(cache.add('b', ['b'], 101))
+        self.assertEqual(len(cache), 1)
+
+    def test_replace(self):
+        cache = self.create_cache(max_size=100)
+        cache.add('a', ['a'], 40)
+        cache.add('a', ['a2'], 50)
+        self.assertEqual(cache.get('a'), ['a2'])
+        self.assertEqual(cache.size, 50)
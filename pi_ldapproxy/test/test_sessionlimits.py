@@ -0,0 +1,128 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from pi_ldapproxy.sessionlimits import SessionLimits
+
+
+class FakeSession(object):
+    def __init__(self, now):
+        self.connected_at = self.last_activity = now
+        self.authenticated = False
+        self.idle = True
+        self.closed = False
+
+    def is_idle(self):
+        return self.idle
+
+    def close_session(self, abort=False):
+        self.closed = 'aborted' if abort else True
+
+
+class SessionLimitsTest(unittest.TestCase):
+    def create_limits(self, *args, **kwargs):
+        self.clock = task.Clock()
+        limits = SessionLimits(*args, **kwargs)
+        limits.callLater = self.clock.callLater
+        limits.seconds = self.clock.seconds
+        return limits
+
+    def connect(self, limits, host='192.0.2.1'):
+        session = FakeSession(self.clock.seconds())
+        limits.register(session, host)
+        return session
+
+    def test_max_connections(self):
+        limits = self.create_limits(max_connections=2)
+        self.connect(limits)
+        session = self.connect(limits, '192.0.2.2')
+        self.assertFalse(limits.admit('192.0.2.3'))
+        self.assertEqual(limits.rejected, 1)
+        limits.unregister(session)
+        self.assertTrue(limits.admit('192.0.2.3'))
+
+    def test_max_connections_per_ip(self):
+        limits = self.create_limits(max_connections_per_ip=1)
+        session = self.connect(limits)
+        self.assertFalse(limits.admit('192.0.2.1'))
+        self.assertTrue(limits.admit('192.0.2.2'))
+        # Connections without a source IP are not limited
+        self.connect(limits, None)
+        self.assertTrue(limits.admit(None))
+        limits.unregister(session)
+        self.assertTrue(limits.admit('192.0.2.1'))
+        self.assertEqual(limits._per_ip, {})
+
+    def test_no_sweep_without_timeouts(self):
+        limits = self.create_limits(max_connections=2)
+        self.connect(limits)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_idle_timeout(self):
+        limits = self.create_limits(idle_timeout=10)
+        idle = self.connect(limits)
+        busy = self.connect(limits)
+        busy.idle = False
+        active = self.connect(limits)
+        self.clock.advance(5)
+        active.last_activity = self.clock.seconds()
+        self.clock.advance(5)
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+        self.assertFalse(active.closed)
+        # All sessions are checked by one timer
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_bind_timeout(self):
+        limits = self.create_limits(bind_timeout=10)
+        unauthenticated = self.connect(limits)
+        authenticated = self.connect(limits)
+        authenticated.authenticated = True
+        self.clock.advance(10)
+        self.assertTrue(unauthenticated.closed)
+        self.assertFalse(authenticated.closed)
+
+    def test_max_lifetime(self):
+        limits = self.create_limits(max_lifetime=60, idle_timeout=30)
+        session = self.connect(limits)
+        session.authenticated = True
+        session.idle = False
+        self.clock.advance(59)
+        self.assertFalse(session.closed)
+        self.clock.advance(1)
+        self.assertTrue(session.closed)
+
+    def test_sweep_stops(self):
+        limits = self.create_limits(idle_timeout=10)
+        session = self.connect(limits)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        limits.unregister(session)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        limits.unregister(session)
+
+    def test_drain(self):
+        limits = self.create_limits()
+        idle = self.connect(limits)
+        busy = self.connect(limits)
+        busy.idle = False
+        stuck = self.connect(limits)
+        stuck.idle = False
+        d = limits.drain(10)
+        self.assertTrue(idle.closed)
+        self.assertFalse(limits.admit('192.0.2.2'))
+        limits.unregister(idle)
+        busy.idle = True
+        self.clock.advance(1)
+        self.assertTrue(busy.closed)
+        limits.unregister(busy)
+        self.assertFalse(stuck.closed)
+        self.clock.advance(9)
+        self.assertEqual(stuck.closed, 'aborted')
+        self.assertNoResult(d)
+        limits.unregister(stuck)
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_drain_without_sessions(self):
+        limits = self.create_limits(idle_timeout=10)
+        self.successResultOf(limits.drain(10))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,117 @@
+import itertools
+import json
+import os
+
+from ldaptor import ldapfilter
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from pi_ldapproxy.slowlog import filter_text
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TestSlowOperationLog(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+    }
+    additional_config = {
+        'ldap-proxy': {
+            'allow-search': True,
+        },
+        'bind-cache': {
+            'enabled': True,
+        },
+    }
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        self.filename = self.mktemp()
+        self.factory.slow_log.configure(0.005, self.filename)
+        self.factory.slow_log.time = lambda: 1000
+        self.factory.bind_cache.callLater = self.clock.callLater
+        self.addCleanup(self.factory.slow_log.close)
+        # Every phase takes 2ms
+        self.factory.metrics.seconds = itertools.count(step=0.002).__next__
+
+    def records(self):
+        self.factory.slow_log.close()
+        with open(self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    @defer.inlineCallbacks
+    def test_slow_bind(self):
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        [record] = self.records()
+        self.assertEqual(record, {
+            'operation': 'bind',
+            'time': 1000,
+            'duration_ms': 10.0,
+            'dn': 'uid=hugo,cn=users,dc=test,dc=local',
+            'marker': 'default',
+            'realm': 'default',
+            'user': 'hugo',
+            'result': 'success',
+            'message': None,
+            'bind_cache': 'miss',
+            'phases_ms': {'realm-resolution': 2.0, 'user-resolution': 2.0, 'bind-cache': 2.0, 'privacyidea': 2.0},
+            'privacyidea': 'http://example.com/',
+            'route': 'default',
+            'backend': None,
+        })
+
+    @defer.inlineCallbacks
+    def test_failed_bind(self):
+        self.privacyidea.authenticate = lambda *args: defer.fail(RuntimeError('unreachable'))
+        server, client = self.create_server_and_client()
+        yield self.assertFailure(client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret'),
+                                 ldaperrors.LDAPInvalidCredentials)
+        self.flushLoggedErrors(RuntimeError)
+        [record] = self.records()
+        self.assertEqual((record['result'], record['message']), ('error', "RuntimeError('unreachable')"))
+        self.assertEqual(sorted(record['phases_ms']), ['bind-cache', 'realm-resolution', 'user-resolution'])
+
+    @defer.inlineCallbacks
+    def test_fast_bind(self):
+        self.factory.slow_log.configure(0.5, self.filename)
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertFalse(os.path.exists(self.filename))
+
+    @defer.inlineCallbacks
+    def test_slow_search(self):
+        passthrough_dn = 'uid=passthrough,cn=users,dc=test,dc=local'
+        dn = 'uid=hugo,cn=users,dc=test,dc=local'
+        server, client = self.create_server_and_client(
+            [pureldap.LDAPBindResponse(resultCode=0)],
+            [pureldap.LDAPSearchResultEntry(dn, [('someattr', ['somevalue'])]),
+             pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode)],
+        )
+        yield client.bind(passthrough_dn, 'some-secret')
+        # Slow down the search
+        self.factory.metrics.seconds = iter([0, 0.01]).__next__
+        yield LDAPEntry(client, dn).search('(uid=hugo)', scope=pureldap.LDAP_SCOPE_baseObject)
+        [record] = self.records()
+        self.assertEqual(record, {
+            'operation': 'search',
+            'time': 1000,
+            'duration_ms': 10.0,
+            'base': dn,
+            'scope': 0,
+            'filter': '(uid=hugo)',
+            'bound_as': passthrough_dn,
+            'route': 'default',
+            'backend': None,
+        })
+
+
+class FilterTextTest(unittest.TestCase):
+    def test_decoded_filter(self):
+        text = '(&(objectClass=*)(|(uid=hu\\2ago)(!(cn~=x)))(mail=a*b*c)(uidNumber>=5)(uid=*o))'
+        wire = ldapfilter.parseFilter(text).toWire()
+        decoded, _ = pureber.berDecodeObject(
+            pureldap.LDAPBERDecoderContext_Filter(fallback=pureber.BERDecoderContext()), wire)
+        self.assertEqual(filter_text(decoded), text)
@@ -0,0 +1,116 @@
+import socket
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.startup import StartupTimings, Warmup, sd_notify
+from pi_ldapproxy.test.mock import MockPooledLDAPClient
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class FakeFactory(object):
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def warm_up(self):
+        return self.tasks
+
+
+class StartupTimingsTest(unittest.TestCase):
+    def test_lap(self):
+        timings = StartupTimings()
+        started = timings.lap('imports', 10, 10.5)
+        timings.lap('configuration', started, 10.75)
+        self.assertEqual(list(timings.phases.items()), [('imports', 0.5), ('configuration', 0.25)])
+        self.assertEqual(timings.summary(), 'imports: 0.500s, configuration: 0.250s')
+
+
+class SdNotifyTest(unittest.TestCase):
+    def test_not_started_by_systemd(self):
+        self.assertFalse(sd_notify('READY=1', {}))
+
+    def test_notify(self):
+        path = self.mktemp()
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(path)
+        self.assertTrue(sd_notify('READY=1', {'NOTIFY_SOCKET': path}))
+        self.assertEqual(receiver.recv(64), b'READY=1')
+
+    def test_socket_missing(self):
+        self.assertFalse(sd_notify('READY=1', {'NOTIFY_SOCKET': self.mktemp()}))
+
+
+class WarmupTest(unittest.TestCase):
+    def create_warmup(self, tasks):
+        self.clock = task.Clock()
+        warmup = Warmup(FakeFactory(tasks))
+        warmup.callLater = self.clock.callLater
+        warmup.time = self.clock.seconds
+        return warmup
+
+    def test_completed(self):
+        first, second = defer.Deferred(), defer.Deferred()
+        warmup = self.create_warmup([first, second])
+        d = warmup.run(10)
+        self.assertTrue(warmup.running)
+        self.clock.advance(1)
+        first.callback(None)
+        self.assertNoResult(d)
+        # Failed tasks do not fail the warm-up
+        second.errback(RuntimeError('connection refused'))
+        self.successResultOf(d)
+        self.assertFalse(warmup.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        pending = defer.Deferred()
+        warmup = self.create_warmup([pending])
+        d = warmup.run(10)
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.successResultOf(d)
+        self.assertFalse(warmup.running)
+        # The task continues in the background
+        pending.callback(None)
+
+    def test_no_tasks(self):
+        warmup = self.create_warmup([])
+        self.successResultOf(warmup.run(0))
+        self.assertFalse(warmup.running)
+
+
+class TestProxyWarmup(ProxyTestCase):
+    additional_config = {
+        'ldap-backend': {
+            'pool-size': 2,
+        },
+    }
+
+    def connect(self):
+        client = MockPooledLDAPClient()
+        client.connectionMade()
+        self.connected.append(client)
+        return defer.succeed(client)
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        self.connected = []
+        pool = self.factory.backend_pool
+        pool.connector = self.connect
+        pool.callLater = self.clock.callLater
+        pool.seconds = self.clock.seconds
+
+    def test_fill_pool(self):
+        self.successResultOf(self.factory.warmup.run(0))
+        self.assertEqual(len(self.connected), 2)
+        self.assertEqual(self.factory.backend_pool.idle_count, 2)
+        # Fresh connections are not reset
+        for client in self.connected:
+            client.assertNothingSent()
+
+    def test_fill_pool_disabled(self):
+        self.factory.config['startup']['fill-pool'] = False
+        self.successResultOf(self.factory.warmup.run(0))
+        self.assertEqual(self.connected, [])
@@ -0,0 +1,178 @@
+import json
+
+from twisted.internet import defer, error, reactor, task
+from twisted.trial import unittest
+
+from pi_ldapproxy.tracing import NOOP_SPAN, SPAN_KIND_CLIENT, FileExporter, Tracer
+from pi_ldapproxy.test.util import ProxyTestCase
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.batches = []
+        self.tracer = Tracer()
+        self.tracer.callLater = self.clock.callLater
+        self.tracer.seconds = self.clock.seconds
+        self.tracer.configure(1, self.export, export_interval=5, max_queue_size=4, batch_size=2)
+
+    def export(self, data):
+        self.batches.append(json.loads(data.decode('utf-8')))
+        return defer.succeed(None)
+
+    def spans(self):
+        return [span for batch in self.batches
+                for span in batch['resourceSpans'][0]['scopeSpans'][0]['spans']]
+
+    def test_not_sampled(self):
+        self.tracer.configure(0, self.export)
+        self.assertIs(self.tracer.start_trace('LDAPBindRequest'), NOOP_SPAN)
+        self.tracer.configure(1, None)
+        self.assertIs(self.tracer.start_trace('LDAPBindRequest'), NOOP_SPAN)
+        self.assertIs(NOOP_SPAN.child('privacyidea'), NOOP_SPAN)
+        self.assertIsNone(NOOP_SPAN.traceparent)
+
+    def test_export(self):
+        root = self.tracer.start_trace('LDAPBindRequest')
+        root.set_attribute('ldap.message_id', 3)
+        child = root.child('privacyidea', SPAN_KIND_CLIENT, {'http.url': 'https://privacyidea/validate/check'})
+        self.assertEqual(child.traceparent, '00-{}-{}-01'.format(root.trace_id, child.span_id))
+        self.clock.advance(0.5)
+        child.end('Failed')
+        # Spans are exported after the export interval
+        self.assertEqual(self.batches, [])
+        self.clock.advance(5)
+        [span] = self.spans()
+        self.assertEqual(span, {
+            'traceId': root.trace_id,
+            'spanId': child.span_id,
+            'parentSpanId': root.span_id,
+            'name': 'privacyidea',
+            'kind': SPAN_KIND_CLIENT,
+            'startTimeUnixNano': '1000000000000',
+            'endTimeUnixNano': '1000500000000',
+            'attributes': [{'key': 'http.url', 'value': {'stringValue': 'https://privacyidea/validate/check'}}],
+            'status': {'code': 2, 'message': 'Failed'},
+        })
+        self.assertEqual(self.batches[0]['resourceSpans'][0]['resource']['attributes'],
+                         [{'key': 'service.name', 'value': {'stringValue': 'privacyidea-ldap-proxy'}}])
+        # Children which have not ended yet are ended along with their parent, and full batches
+        # are exported right away
+        root.child('user-lookup')
+        root.end()
+        root.end()
+        self.clock.advance(0)
+        self.assertEqual([span['name'] for span in self.spans()], ['privacyidea', 'user-lookup', 'LDAPBindRequest'])
+        self.assertEqual(self.spans()[2]['attributes'], [{'key': 'ldap.message_id', 'value': {'intValue': '3'}}])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_queue_is_bounded(self):
+        pending = []
+        self.tracer.exporter = lambda data: pending.append(defer.Deferred()) or pending[-1]
+        for _ in range(2):
+            self.tracer.start_trace('LDAPSearchRequest').end()
+        self.clock.advance(0)
+        self.assertEqual(len(pending), 1)
+        for _ in range(5):
+            self.tracer.start_trace('LDAPSearchRequest').end()
+        self.clock.advance(0)
+        # One batch is being exported, the queue is full
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(self.tracer.dropped, 1)
+        pending[0].callback(None)
+        self.clock.advance(0)
+        self.assertEqual(len(pending), 2)
+
+    def test_close(self):
+        self.tracer.start_trace('LDAPBindRequest').end()
+        self.successResultOf(self.tracer.close())
+        self.assertEqual(len(self.spans()), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_export(self):
+        self.tracer.exporter = lambda data: defer.fail(RuntimeError('collector is down'))
+        self.tracer.start_trace('LDAPBindRequest').end()
+        self.clock.advance(5)
+        self.assertEqual(len(self.tracer._queue), 0)
+
+
+class FileExporterTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_write(self):
+        filename = self.mktemp()
+        exporter = FileExporter(filename)
+        yield exporter(b'{"first": 1}')
+        yield exporter(b'{"second": 2}')
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), b'{"first": 1}\n{"second": 2}\n')
+
+
+class TestProxyTracing(ProxyTestCase):
+    privacyidea_credentials = {
+        'hugo@default': 'secret',
+    }
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        self.spans = []
+        tracer = self.factory.tracer
+        tracer.callLater = self.clock.callLater
+        tracer.configure(1, lambda data: defer.succeed(None))
+        tracer.span_ended = self.spans.append
+
+    @defer.inlineCallbacks
+    def test_bind_is_traced(self):
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertEqual([span.name for span in self.spans],
+                         ['realm-mapping', 'user-lookup', 'privacyidea', 'LDAPBindRequest'])
+        root = self.spans[-1]
+        self.assertEqual(root.attributes['ldap.dn'], 'uid=hugo,cn=users,dc=test,dc=local')
+        self.assertEqual(root.attributes['ldap.result_code'], 0)
+        self.assertFalse(root.attributes['bind_cache.hit'])
+        self.assertTrue(all(span.trace_id == root.trace_id for span in self.spans))
+        self.assertEqual(self.privacyidea.traceparents, [self.spans[2].traceparent])
+
+    @defer.inlineCallbacks
+    def test_unknown_user(self):
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=other,dc=local', 'secret').addErrback(lambda _: None)
+        self.assertEqual([(span.name, span.error) for span in self.spans],
+                         [('realm-mapping', None), ('user-lookup', 'Invalid user.'), ('LDAPBindRequest', None)])
+        self.assertEqual(self.spans[-1].attributes['ldap.result_code'], 49)
+
+    @defer.inlineCallbacks
+    def test_not_sampled(self):
+        self.factory.tracer.configure(0)
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        self.assertEqual(self.spans, [])
+        self.assertEqual(self.privacyidea.traceparents, [None])
+
+    @defer.inlineCallbacks
+    def test_client_disconnects(self):
+        server, client = self.create_server_and_client()
+        server.request_validate = lambda *args: defer.Deferred()
+        client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret')
+        while not server.inflight:
+            yield task.deferLater(reactor, 0, lambda: None)
+        self.assertEqual(len(server.open_spans), 1)
+        server.connectionLost(error.ConnectionDone())
+        self.assertEqual([(span.name, span.error) for span in self.spans], [
+            ('realm-mapping', None),
+            ('user-lookup', None),
+            ('privacyidea', 'Client has disconnected'),
+            ('LDAPBindRequest', 'Client has disconnected'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_privacyidea_fails(self):
+        self.privacyidea.authenticate = lambda *args: defer.fail(RuntimeError('unreachable'))
+        server, client = self.create_server_and_client()
+        yield client.bind('uid=hugo,cn=users,dc=test,dc=local', 'secret').addErrback(lambda _: None)
+        self.flushLoggedErrors(RuntimeError)
+        self.assertEqual([(span.name, span.error) for span in self.spans][2:], [
+            ('privacyidea', 'unreachable'),
+            ('LDAPBindRequest', 'unreachable'),
+        ])
@@ -0,0 +1,280 @@
+import socket
+
+from twisted.internet import error, protocol, reactor, task
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from pi_ldapproxy import workers
+from pi_ldapproxy.test.util import BASE_CONFIG, ProxyTestCase
+from pi_ldapproxy.workers import CONTROL_READ_FD, LISTEN_FD, WorkerControl, WorkerSupervisor, \
+    adopt_listening_port, decode_message, encode_message
+
+
+class FakeProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+        self.written = []
+        self.exited = False
+
+    def signalProcess(self, signal_name):
+        if self.exited:
+            raise error.ProcessExitedAlready()
+        self.signals.append(signal_name)
+
+    def writeToChild(self, fd, data):
+        self.written.append((fd, data))
+
+
+class FakePort(object):
+    def __init__(self):
+        self.listening = True
+
+    def fileno(self):
+        return 42
+
+    def stopListening(self):
+        self.listening = False
+
+
+class MessageTest(unittest.TestCase):
+    def test_roundtrip(self):
+        line = encode_message('bind-cache', b'uid=hugo,dc=test', None, b'secret\xff')
+        self.assertNotIn(b'\n', line)
+        self.assertEqual(decode_message(line), ('bind-cache', [b'uid=hugo,dc=test', None, b'secret\xff']))
+        self.assertEqual(decode_message(encode_message('app-cache', 'uid=hugo', 'someApp')),
+                         ('app-cache', ['uid=hugo', 'someApp']))
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.spawned = []
+        self.supervisor = WorkerSupervisor('proxy.ini', 'tcp:1389', 2, restart_delay=3, heartbeat_timeout=10,
+                                           stop_timeout=5)
+        self.supervisor.callLater = self.clock.callLater
+        self.supervisor.seconds = self.clock.seconds
+        self.supervisor.spawnProcess = self.spawn
+        self.supervisor.restart_signal = self.supervisor.reload_signal = self.supervisor.profile_signal = None
+        self.supervisor.port = FakePort()
+
+    def spawn(self, worker, executable, args, env, childFDs):
+        self.assertEqual(childFDs[LISTEN_FD], 42)
+        self.assertEqual(args[-2:], ['--worker', str(worker.number)])
+        worker.makeConnection(FakeProcessTransport())
+        self.spawned.append(worker)
+
+    def end(self, worker):
+        worker.transport.exited = True
+        worker.processEnded(Failure(error.ProcessTerminated(signal=9)))
+
+    def test_start_workers(self):
+        self.supervisor.startService()
+        self.assertEqual([worker.number for worker in self.spawned], [0, 1])
+        self.assertEqual(set(self.supervisor.workers), {0, 1})
+
+    def test_restart_worker(self):
+        self.supervisor.startService()
+        self.end(self.spawned[0])
+        self.assertEqual(set(self.supervisor.workers), {1})
+        self.clock.advance(3)
+        self.assertEqual([worker.number for worker in self.spawned], [0, 1, 0])
+        self.assertIs(self.supervisor.workers[0], self.spawned[2])
+
+    def test_kill_worker_without_heartbeat(self):
+        self.supervisor.startService()
+        heartbeat = encode_message('heartbeat') + b'\n'
+        for _ in range(12):
+            self.clock.advance(1)
+            # Heartbeats might be split up
+            self.spawned[1].childDataReceived(4, heartbeat[:3])
+            self.spawned[1].childDataReceived(4, heartbeat[3:])
+        self.assertEqual(self.spawned[0].transport.signals, ['KILL'])
+        self.assertEqual(self.spawned[1].transport.signals, [])
+        self.end(self.spawned[0])
+        self.clock.advance(3)
+        self.assertEqual(len(self.spawned), 3)
+
+    def test_relay_cache_entries(self):
+        self.supervisor.startService()
+        line = encode_message('app-cache', 'uid=hugo,dc=test', 'someApp')
+        self.spawned[0].childDataReceived(4, line + b'\n')
+        self.assertEqual(self.spawned[0].transport.written, [])
+        self.assertEqual(self.spawned[1].transport.written, [(CONTROL_READ_FD, line + b'\n')])
+
+    def test_ready(self):
+        notified = []
+        self.patch(workers, 'sd_notify', notified.append)
+        self.supervisor.startService()
+        ready = encode_message('ready') + b'\n'
+        self.spawned[0].childDataReceived(4, ready)
+        self.assertEqual(notified, [])
+        self.spawned[1].childDataReceived(4, ready)
+        self.assertEqual(notified, ['READY=1'])
+        # Restarted workers do not notify systemd again
+        self.end(self.spawned[0])
+        self.clock.advance(3)
+        self.spawned[2].childDataReceived(4, ready)
+        self.assertEqual(notified, ['READY=1'])
+
+    def test_stop_service(self):
+        self.supervisor.startService()
+        self.end(self.spawned[0])
+        d = self.supervisor.stopService()
+        self.assertEqual(self.spawned[1].transport.signals, ['TERM'])
+        # The pending restart is cancelled
+        self.clock.advance(5)
+        self.assertEqual(len(self.spawned), 2)
+        self.assertEqual(self.spawned[1].transport.signals, ['TERM', 'KILL'])
+        self.assertNoResult(d)
+        self.end(self.spawned[1])
+        self.successResultOf(d)
+        self.assertFalse(self.supervisor.port.listening)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_replace_workers(self):
+        self.supervisor.startService()
+        self.supervisor.restart_workers()
+        old_workers, new_workers = self.spawned[:2], self.spawned[2:]
+        self.assertEqual([worker.number for worker in new_workers], [0, 1])
+        self.assertEqual([worker.transport.signals for worker in old_workers], [['TERM'], ['TERM']])
+        self.assertEqual(self.supervisor.retiring, set(old_workers))
+        # Cache entries of old workers are handed over to the new workers
+        line = encode_message('bind-cache', b'uid=hugo,dc=test', None, b'secret', 1.5)
+        old_workers[0].childDataReceived(4, line + b'\n')
+        self.assertEqual(old_workers[1].transport.written, [])
+        self.assertEqual(new_workers[1].transport.written, [(CONTROL_READ_FD, line + b'\n')])
+        # Old workers are not restarted
+        self.end(old_workers[0])
+        self.clock.advance(3)
+        self.assertEqual(len(self.spawned), 4)
+        self.assertEqual(self.supervisor.workers, {0: new_workers[0], 1: new_workers[1]})
+        # ... but they are terminated on shutdown
+        d = self.supervisor.stopService()
+        self.assertEqual(old_workers[1].transport.signals, ['TERM', 'TERM'])
+        for worker in [old_workers[1]] + new_workers:
+            self.end(worker)
+        self.successResultOf(d)
+
+    def test_replace_workers_cancels_restart(self):
+        self.supervisor.startService()
+        self.end(self.spawned[0])
+        self.supervisor.restart_workers()
+        self.clock.advance(3)
+        self.assertEqual([worker.number for worker in self.spawned], [0, 1, 0, 1])
+
+    def test_reload(self):
+        self.supervisor.startService()
+        self.supervisor.config_filename = self.mktemp()
+        with open(self.supervisor.config_filename, 'w') as f:
+            f.write(BASE_CONFIG + '\n[workers]\ncount = 3\nrestart-delay = 5\n')
+        self.assertTrue(self.supervisor.reload())
+        self.assertEqual([worker.transport.signals for worker in self.spawned], [['HUP'], ['HUP'], []])
+        self.assertEqual(self.supervisor.restart_delay, 5)
+        with open(self.supervisor.config_filename, 'w') as f:
+            f.write(BASE_CONFIG + '\n[workers]\ncount = 1\n')
+        self.assertTrue(self.supervisor.reload())
+        self.assertEqual(set(self.supervisor.workers), {0})
+        self.assertEqual(self.supervisor.retiring, set(self.spawned[1:]))
+        self.assertEqual(self.spawned[2].transport.signals, ['HUP', 'TERM'])
+        # Invalid configurations are not forwarded to the workers
+        with open(self.supervisor.config_filename, 'w') as f:
+            f.write(BASE_CONFIG + '\n[workers]\ncount = many\n')
+        self.assertFalse(self.supervisor.reload())
+        self.assertEqual(self.spawned[0].transport.signals, ['HUP', 'HUP'])
+
+    def test_listen(self):
+        supervisor = WorkerSupervisor('proxy.ini', 'tcp:0:interface=127.0.0.1', 1)
+        supervisor.privilegedStartService()
+        self.addCleanup(supervisor.port.stopListening)
+        # The supervisor itself does not accept connections
+        self.assertNotIn(supervisor.port, reactor.getReaders())
+
+    def test_listen_fails(self):
+        supervisor = WorkerSupervisor('proxy.ini', 'tcp:0:interface=192.0.2.1', 1)
+        self.assertRaises(error.CannotListenError, supervisor.privilegedStartService)
+
+
+class AdoptListeningPortTest(unittest.TestCase):
+    def test_adopt(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        address = sock.getsockname()
+        port = adopt_listening_port(reactor, sock.detach(), protocol.Factory(), 'tcp:1389')
+        self.addCleanup(port.stopListening)
+        self.assertEqual(port.getHost().port, address[1])
+
+
+class TestWorkerControl(ProxyTestCase):
+    additional_config = {
+        'bind-cache': {
+            'enabled': True,
+        },
+        'app-cache': {
+            'enabled': True,
+        },
+    }
+
+    def setUp(self):
+        ProxyTestCase.setUp(self)
+        self.factory.bind_cache.callLater = self.clock.callLater
+        self.factory.app_cache.callLater = self.clock.callLater
+        self.control = WorkerControl(self.factory, heartbeat_interval=5)
+        self.control.callLater = self.clock.callLater
+        self.shutdowns = []
+        self.control.shutdown = lambda: self.shutdowns.append(True)
+        self.transport = proto_helpers.StringTransport()
+        self.control.makeConnection(self.transport)
+
+    def messages(self):
+        lines = self.transport.value().splitlines()
+        self.transport.clear()
+        return [decode_message(line) for line in lines]
+
+    def test_heartbeat(self):
+        self.assertEqual(self.messages(), [('heartbeat', [])])
+        self.clock.advance(5)
+        self.assertEqual(self.messages(), [('heartbeat', [])])
+        self.control.connectionLost(error.ConnectionDone())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.shutdowns, [True])
+        self.assertIsNone(self.factory.cache_replicator)
+
+    def test_no_shutdown_when_stopping(self):
+        self.control.stopping = True
+        self.control.connectionLost(error.ConnectionDone())
+        self.assertEqual(self.shutdowns, [])
+
+    def test_share_bind_cache(self):
+        self.messages()
+        self.factory.finalize_authentication(b'uid=hugo,dc=test', 'someApp', b'secret')
+        self.assertEqual(self.messages(), [('bind-cache', [b'uid=hugo,dc=test', 'someApp', b'secret'])])
+        self.control.lineReceived(encode_message('bind-cache', b'uid=other,dc=test', None, b'password'))
+        self.assertTrue(self.factory.is_bind_cached(b'uid=other,dc=test', None, b'password'))
+        # Entries received from the supervisor are not sent back
+        self.assertEqual(self.messages(), [])
+
+    def test_send_snapshot(self):
+        self.factory.finalize_authentication(b'uid=hugo,dc=test', 'someApp', b'secret')
+        self.factory.app_cache.add_to_cache('uid=hugo,dc=test', 'someApp')
+        self.messages()
+        self.control.send_snapshot()
+        [(bind_kind, bind_args), (app_kind, app_args)] = self.messages()
+        self.assertEqual((bind_kind, bind_args[:3]), ('bind-cache', [b'uid=hugo,dc=test', 'someApp', b'secret']))
+        self.assertEqual((app_kind, app_args[:2]), ('app-cache', ['uid=hugo,dc=test', 'someApp']))
+        self.control.lineReceived(encode_message('app-cache', 'uid=other,dc=test', 'otherApp', app_args[2]))
+        self.assertEqual(self.factory.app_cache.get_cached_marker('uid=other,dc=test'), 'otherApp')
+
+    def test_share_app_cache(self):
+        self.control.lineReceived(encode_message('app-cache', 'uid=hugo,dc=test', 'someApp'))
+        self.assertEqual(self.factory.app_cache.get_cached_marker('uid=hugo,dc=test'), 'someApp')
+
+    def test_caches_not_shared(self):
+        self.control.connectionLost(error.ConnectionDone())
+        control = WorkerControl(self.factory, share_caches=False)
+        control.callLater = self.clock.callLater
+        control.makeConnection(self.transport)
+        self.assertIsNone(self.factory.cache_replicator)
+        control.stopping = True
+        control.connectionLost(error.ConnectionDone())
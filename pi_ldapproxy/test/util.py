@@ -24,18 +24,28 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import gc
+import tracemalloc
+
 import configobj
 import twisted
 import validate
 from ldaptor import testutil
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.ldap import ldapserver
 from ldaptor.protocols.ldap.ldapclient import LDAPClient
 from ldaptor.test.util import returnConnected, IOPump
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone
 from twisted.internet.task import LoopingCall
+from twisted.test import proto_helpers
 
 from pi_ldapproxy.config import CONFIG_SPEC
 from pi_ldapproxy.proxy import TwoFactorAuthenticationProxy, ProxyServerFactory
+from pi_ldapproxy.rawforward import RawForwardingLDAPClient
 from pi_ldapproxy.test.mock import MockPrivacyIDEA, MockLDAPClient
 
 BASE_CONFIG = """
@@ -81,6 +91,36 @@ def load_test_config():
     assert result == True, "Invalid test config"
     return config
 
+def measure_idle_connection_memory(factory, count):
+    """
+    Open *count* idle client connections using *factory* and measure the memory allocated for them
+    using ``tracemalloc``. The connections are closed afterwards. In order to measure only the state
+    of the LDAP proxy, the connections use ``StringTransport`` instances, which are allocated before
+    the measurement starts. If ``lazy-connect`` is disabled, connection attempts to the LDAP backend
+    are started (and cancelled once the connections are closed).
+    :return: the number of bytes per connection
+    """
+    addr = IPv4Address('TCP', '192.0.2.1', 12345)
+    transports = [proto_helpers.StringTransport(peerAddress=addr) for _ in range(count)]
+    protocols = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for transport in transports:
+            proto = factory.buildProtocol(addr)
+            proto.makeConnection(transport)
+            protocols.append(proto)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    for proto in protocols:
+        proto.connectionLost(ConnectionDone())
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / count
+
+
 class ProxyTestCase(twisted.trial.unittest.TestCase):
     additional_config = {}
     privacyidea_credentials = {}
@@ -106,6 +146,9 @@ class ProxyTestCase(twisted.trial.unittest.TestCase):
 
     def setUp(self):
         self.factory = ProxyServerFactory(self.get_config())
+        # Deadlines (see ``ProxyServerFactory.with_deadline``) only expire if tests advance the clock
+        self.clock = task.Clock()
+        self.factory.callLater = self.clock.callLater
         self.pump_call = LoopingCall(self.pump_all)
         self.pump_call.start(0.1)
 
@@ -132,13 +175,14 @@ class ProxyTestCase(twisted.trial.unittest.TestCase):
         clientTestDriver = MockLDAPClient(*responses)
 
         def simulateConnectToServer():
-            d = defer.Deferred()
+            # Like a real connection attempt, this can be cancelled
+            d = defer.Deferred(lambda d: connect_call.cancel())
 
             def onConnect():
                 clientTestDriver.connectionMade()
                 d.callback(clientTestDriver)
 
-            reactor.callLater(0, onConnect)
+            connect_call = reactor.callLater(0, onConnect)
             return d
 
         clientConnector = kwds.get('clientConnector', simulateConnectToServer)
@@ -152,4 +196,49 @@ class ProxyTestCase(twisted.trial.unittest.TestCase):
         client = LDAPClient()
         server = self.create_server(*responses, **kwds)
         self.pumps.add(returnConnected(server, client))
-        return server, client
\ No newline at end of file
+        return server, client
+
+
+class BackendTestCase(ProxyTestCase):
+    """
+    Test case which uses a ``RawForwardingLDAPClient`` connected to a ``StringTransport`` as the LDAP backend.
+    """
+    def create_backend_server_and_client(self):
+        self.backend = RawForwardingLDAPClient()
+        self.backend_transport = proto_helpers.StringTransport()
+        self.backend.makeConnection(self.backend_transport)
+        self.backend_buffer = b''
+        return self.create_server_and_client(clientConnector=lambda: defer.succeed(self.backend))
+
+    @defer.inlineCallbacks
+    def receive_request(self):
+        """
+        Wait for the next request to the LDAP backend and return the decoded ``LDAPMessage``.
+        """
+        while True:
+            self.backend_buffer += self.backend_transport.value()
+            self.backend_transport.clear()
+            if self.backend_buffer:
+                break
+            yield task.deferLater(reactor, 0, lambda: None)
+        msg, length = pureber.berDecodeObject(ldapserver.BaseLDAPServer.berdecoder, self.backend_buffer)
+        self.backend_buffer = self.backend_buffer[length:]
+        defer.returnValue(msg)
+
+    def assertNothingReceived(self):
+        self.assertEqual(self.backend_buffer + self.backend_transport.value(), b'')
+
+    def respond(self, message_id, *responses, **kwargs):
+        controls = kwargs.get('controls')
+        self.backend.dataReceived(b''.join(
+            pureldap.LDAPMessage(response, id=message_id,
+                                 controls=controls if isinstance(response, pureldap.LDAPSearchResultDone) else None)
+            .toWire()
+            for response in responses))
+
+    @defer.inlineCallbacks
+    def passthrough_bind(self, client):
+        d = client.bind('uid=passthrough,cn=users,dc=test,dc=local', 'some-secret')
+        msg = yield self.receive_request()
+        self.respond(msg.id, pureldap.LDAPBindResponse(resultCode=0))
+        yield d
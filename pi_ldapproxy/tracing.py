@@ -0,0 +1,339 @@
+"""
+Span-based tracing of LDAP operations, compatible with OpenTelemetry.
+
+Every incoming LDAP operation which expects a response starts a trace (see ``Tracer.start_trace``). Sampling is
+decided once per trace ("head sampling"): Operations which are not sampled get ``NOOP_SPAN``, on which all
+operations do nothing, so tracing costs next to nothing for them. Sampled operations get a ``Span`` with child
+spans for the phases of the operation (e.g. user lookup, realm mapping, the privacyIDEA request and the request
+forwarded to the LDAP backend). The privacyIDEA request carries a W3C ``traceparent`` header, so that traces can
+be correlated with privacyIDEA.
+
+Finished spans are queued and exported in batches every ``export_interval`` seconds (or earlier, once
+``batch_size`` spans are queued) in the OTLP/JSON format, either to a local OpenTelemetry collector via
+HTTP or as JSON lines to a file. Exporting happens asynchronously: HTTP requests are non-blocking, and files
+are written in a thread. At most one batch is exported at a time. If the queue is full (e.g. because the
+collector is slow), new spans are dropped.
+"""
+import json
+import random
+import time
+from collections import deque
+from io import BytesIO
+
+from twisted.internet import defer, reactor, threads
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
+
+#: Span kinds as defined by OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+#: Status codes as defined by OTLP
+STATUS_ERROR = 2
+
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    elif isinstance(value, int):
+        return {'intValue': str(value)}
+    elif isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class _NoopSpan(object):
+    """
+    Span of an operation which is not sampled. All methods do nothing.
+    """
+    __slots__ = ()
+    traceparent = None
+
+    def child(self, name, kind=SPAN_KIND_INTERNAL, attributes=None):
+        return self
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __bool__(self):
+        return False
+
+
+#: The span of all operations which are not traced
+NOOP_SPAN = _NoopSpan()
+
+
+class Span(object):
+    """
+    A sampled span. Once it has ended, it is handed over to the tracer for exporting.
+    Child spans which have not ended yet are ended along with their parent.
+    """
+    __slots__ = ('tracer', 'name', 'kind', 'trace_id', 'span_id', 'parent_id', 'start_time', 'end_time',
+                 'attributes', 'children', 'error')
+
+    def __init__(self, tracer, name, kind, trace_id, parent_id=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = '%016x' % tracer.random.getrandbits(64)
+        self.parent_id = parent_id
+        self.start_time = tracer.seconds()
+        #: Timestamp at which the span has ended, or None
+        self.end_time = None
+        self.attributes = attributes or {}
+        #: List of child spans, or None
+        self.children = None
+        #: Error message if the span has failed, or None
+        self.error = None
+
+    @property
+    def traceparent(self):
+        """ The W3C trace context of this span, e.g. for HTTP requests issued within this span """
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def child(self, name, kind=SPAN_KIND_INTERNAL, attributes=None):
+        """
+        Start a child span.
+        :param name: name of the span
+        :param kind: one of the ``SPAN_KIND_*`` constants
+        :param attributes: dictionary of span attributes, or None
+        :return: a ``Span``
+        """
+        span = Span(self.tracer, name, kind, self.trace_id, self.span_id, attributes)
+        if self.children is None:
+            self.children = []
+        self.children.append(span)
+        return span
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        """
+        Mark the span as failed. Children which have not ended yet are marked as failed once the span ends.
+        :param error: error message
+        """
+        self.error = error
+
+    def end(self, error=None):
+        """
+        End the span (and all of its children which have not ended yet). Spans can only be ended once.
+        :param error: error message if the span has failed, or None
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = self.tracer.seconds()
+        if error is not None:
+            self.error = error
+        for child in self.children or ():
+            if child.end_time is None:
+                child.end(self.error)
+        self.tracer.span_ended(self)
+
+    def to_otlp(self):
+        """
+        :return: the span in the OTLP/JSON format
+        """
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(int(self.start_time * 1e9)),
+            'endTimeUnixNano': str(int(self.end_time * 1e9)),
+            'attributes': [{'key': key, 'value': _attribute_value(value)} for key, value in self.attributes.items()],
+        }
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        if self.error is not None:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+
+class Tracer(object):
+    """
+    Starts traces and exports the finished spans. Tracing is disabled until ``configure`` is called
+    with a positive sample rate.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = time.time
+    random = random.Random()
+
+    def __init__(self):
+        #: Finished spans which have not been exported yet
+        self._queue = deque()
+        #: Number of spans which have been dropped because the queue was full
+        self.dropped = 0
+        #: Deferred of the export in progress, or None
+        self._exporting = None
+        #: DelayedCall of the next export, or None
+        self._export_call = None
+        self.configure()
+
+    def configure(self, sample_rate=0, exporter=None, export_interval=5, max_queue_size=2048, batch_size=512,
+                  service_name='privacyidea-ldap-proxy'):
+        """
+        Change the tracing settings, e.g. after the configuration has been reloaded.
+        :param sample_rate: fraction of operations which are traced (0 disables tracing)
+        :param exporter: A callable which is passed a batch in the OTLP/JSON format (as bytes) and returns
+        a Deferred, or None
+        :param export_interval: maximum number of seconds between exports
+        :param max_queue_size: maximum number of spans waiting to be exported
+        :param batch_size: maximum number of spans per export
+        :param service_name: name of the service in exported spans
+        """
+        self.sample_rate = sample_rate if exporter is not None else 0
+        self.exporter = exporter
+        self.export_interval = export_interval
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.service_name = service_name
+
+    def start_trace(self, name):
+        """
+        Start a new trace, if it is sampled.
+        :param name: name of the root span
+        :return: a ``Span``, or ``NOOP_SPAN`` if the trace is not sampled
+        """
+        if not self.sample_rate or self.random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(self, name, SPAN_KIND_SERVER, '%032x' % self.random.getrandbits(128))
+
+    def span_ended(self, span):
+        """
+        Called once *span* has ended. Queue it for exporting.
+        """
+        if len(self._queue) >= self.max_queue_size:
+            self.dropped += 1
+            return
+        self._queue.append(span)
+        if len(self._queue) == self.batch_size:
+            # Export a full batch right away
+            if self._export_call is not None:
+                self._export_call.cancel()
+                self._export_call = None
+            self._schedule_export(0)
+        else:
+            self._schedule_export(self.export_interval)
+
+    def _schedule_export(self, delay):
+        if self._export_call is None:
+            self._export_call = self.callLater(delay, self.export)
+
+    def encode_batch(self, spans):
+        """
+        :return: an OTLP/JSON ``ExportTraceServiceRequest`` containing *spans*, as bytes
+        """
+        return json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'pi_ldapproxy'}, 'spans': [span.to_otlp() for span in spans]}],
+        }]}).encode('utf-8')
+
+    def export(self):
+        """
+        Export the next batch of queued spans, unless an export is already in progress.
+        :return: a Deferred which fires once the export has completed
+        """
+        self._export_call = None
+        if self._exporting is not None or not self._queue or self.exporter is None:
+            return defer.succeed(None)
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        self._exporting = d = defer.maybeDeferred(self.exporter, self.encode_batch(batch))
+        d.addErrback(self._export_failed, len(batch))
+        d.addBoth(self._export_done)
+        return d
+
+    def _export_failed(self, failure, count):
+        log.warn('Could not export {count!r} spans: {failure!r}', count=count, failure=failure.value)
+
+    def _export_done(self, _):
+        self._exporting = None
+        if self._queue:
+            self._schedule_export(0 if len(self._queue) >= self.batch_size else self.export_interval)
+
+    def close(self):
+        """
+        Export all queued spans, e.g. on shutdown.
+        :return: a Deferred which fires once all spans have been exported (or have failed to be exported)
+        """
+        if self._export_call is not None:
+            self._export_call.cancel()
+            self._export_call = None
+        if self._exporting is not None:
+            return self._exporting.addCallback(lambda _: self.close())
+        if not self._queue or self.exporter is None:
+            self._queue.clear()
+            return defer.succeed(None)
+        return self.export().addCallback(lambda _: self.close())
+
+
+class FileExporter(object):
+    """
+    Appends batches as lines to a file. The file is written in a thread, so that the reactor is not blocked.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _write(self, data):
+        with open(self.filename, 'ab') as f:
+            f.write(data + b'\n')
+
+    def __call__(self, data):
+        return threads.deferToThread(self._write, data)
+
+
+class CollectorExporter(object):
+    """
+    Sends batches to an OpenTelemetry collector using OTLP/HTTP. Requests which take longer than
+    *timeout* seconds are cancelled, so that a hanging collector does not delay the shutdown.
+    """
+    def __init__(self, url, agent=None, timeout=10):
+        """
+        :param url: URL of the traces endpoint of the collector, e.g. ``http://127.0.0.1:4318/v1/traces``
+        """
+        self.url = url.encode('ascii')
+        self.agent = agent if agent is not None else Agent(reactor)
+        self.timeout = timeout
+
+    def __call__(self, data):
+        d = self.agent.request(b'POST', self.url, Headers({'Content-Type': ['application/json']}),
+                               FileBodyProducer(BytesIO(data)))
+        d.addCallback(self._check_response)
+        d.addTimeout(self.timeout, reactor)
+        return d
+
+    def _check_response(self, response):
+        d = readBody(response)
+        if response.code >= 300:
+            d.addCallback(lambda body: defer.fail(RuntimeError('Collector returned HTTP {}: {!r}'.format(
+                response.code, body[:200]))))
+        return d
+
+
+def build_exporter(config):
+    """
+    Build the span exporter configured in ``[tracing]``.
+    :param config: the ``[tracing]`` section
+    :return: an exporter (see ``Tracer.configure``), or None if tracing is disabled
+    """
+    if not config['enabled']:
+        return None
+    if config['exporter'] == 'file':
+        if not config['file']:
+            log.warn('Tracing is disabled, as no file has been configured')
+            return None
+        return FileExporter(config['file'])
+    return CollectorExporter(config['collector'])
@@ -2,11 +2,11 @@ import re
 
 from ldaptor.protocols import pureldap
 from ldaptor.protocols.ldap import ldaperrors
-from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
 from twisted.internet import defer
-from twisted.logger import Logger
 
-log = Logger()
+from pi_ldapproxy.logs import GatedLogger
+
+log = GatedLogger()
 
 class UserMappingError(RuntimeError):
     pass
@@ -73,7 +73,9 @@ class LookupMappingStrategy(UserMappingStrategy):
         :return: Deferred that fires the login name
         """
         # Perform a LDAP bind, search for an object with the distinguished name *dn*
-        client = yield self.factory.connect_service_account()
+        client = yield self.factory.connect_service_account_for(dn)
+        # Imported here because it takes a while, and only this strategy needs it
+        from ldaptor.protocols.ldap.ldapsyntax import LDAPEntry
         entry = LDAPEntry(client, dn)
         try:
             results = yield entry.search('(objectClass=*)', scope=pureldap.LDAP_SCOPE_baseObject)
@@ -90,8 +92,9 @@ class LookupMappingStrategy(UserMappingStrategy):
             # Apparently, the user could not be found. Raise the appropriate exception.
             raise UserMappingError(dn)
         finally:
-            # TODO: Are there cases in which we can't unbind?
-            yield client.unbind()
+            # This also closes the connection if the lookup has been cancelled, e.g. because the client
+            # has disconnected. If the connection has been lost already, there is nothing to unbind.
+            self.factory.unbind(client)
 
 USER_MAPPING_STRATEGIES = {
     'match': MatchMappingStrategy,
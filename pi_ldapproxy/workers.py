@@ -0,0 +1,562 @@
+"""
+Multi-process worker mode.
+
+The supervisor process opens the listening socket of ``[ldap-proxy] endpoint`` once, but never accepts
+connections on it. Instead, it spawns a number of worker processes, each of which inherits the listening
+socket as file descriptor ``LISTEN_FD`` and accepts connections on it, so that the kernel distributes the
+client connections between the workers. Each worker is a separate ``twistd ldap-proxy`` process with its
+own reactor and its own connections to the LDAP backend.
+
+The supervisor and every worker are connected by two pipes ("control pipes"), on which newline-delimited
+JSON messages are exchanged:
+
+ * Every worker periodically sends a ``heartbeat`` message. Workers whose heartbeats stop (e.g. because
+   their reactor is blocked) are killed, and workers which have exited are restarted.
+ * Every worker sends a ``ready`` message once it has warmed up (see ``startup``). Once all workers are
+   ready, the supervisor notifies systemd.
+ * If caches are shared, a worker sends a ``bind-cache`` or ``app-cache`` message whenever it adds an
+   entry to its bind cache or app cache. The supervisor relays the message to all other workers, which
+   add the entry to their caches as well. When a worker shuts down, it sends all entries of its caches.
+
+On ``SIGHUP``, the supervisor validates the configuration file and forwards the signal to the workers, which
+reload the configuration (see ``services.reload_config``). On ``SIGUSR2``, the supervisor replaces all workers by new processes (e.g. after an update) without
+closing the listening socket: The new workers are started first, then the old workers drain their
+sessions and exit. Their cache entries are handed over to the new workers. ``SIGTTIN`` is forwarded to the
+workers, which start a profiling session (see ``profiling``).
+"""
+import base64
+import json
+import os
+import signal
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import defer, error, protocol, reactor, stdio
+from twisted.internet.endpoints import serverFromString
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.protocols.tls import TLSMemoryBIOFactory
+
+from pi_ldapproxy.config import ConfigError, read_config
+from pi_ldapproxy.logs import GatedLogger
+from pi_ldapproxy.services import install_signal_handler, reload_config
+from pi_ldapproxy.startup import report_ready, sd_notify
+
+log = GatedLogger()
+
+#: File descriptor of the inherited listening socket in worker processes
+LISTEN_FD = 3
+#: File descriptor of the control pipe from the worker to the supervisor
+CONTROL_WRITE_FD = 4
+#: File descriptor of the control pipe from the supervisor to the worker
+CONTROL_READ_FD = 5
+
+#: Message types which carry cache entries and are relayed to all other workers
+CACHE_MESSAGES = ('bind-cache', 'app-cache')
+
+
+def _encode_value(value):
+    # Cache entries contain bytes (e.g. DNs and passwords of bind requests), which JSON cannot represent
+    if isinstance(value, bytes):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['bytes'])
+    return value
+
+
+def encode_message(kind, *args):
+    """
+    Encode a control message.
+    :param kind: message type as string
+    :param args: arguments of the message, which may be strings, bytes or None
+    :return: the message as bytes, without the line delimiter
+    """
+    return json.dumps({'type': kind, 'args': [_encode_value(arg) for arg in args]}).encode('utf-8')
+
+
+def decode_message(line):
+    """
+    Decode a control message.
+    :param line: the message as bytes, without the line delimiter
+    :return: a tuple ``(message type, list of arguments)``
+    """
+    message = json.loads(line.decode('utf-8'))
+    return message['type'], [_decode_value(arg) for arg in message['args']]
+
+
+def adopt_listening_port(reactor, fd, factory, endpoint_string):
+    """
+    Accept connections on the inherited listening socket *fd*, which has been opened according to
+    *endpoint_string*. If *endpoint_string* is a ``ssl:`` endpoint, TLS is added on top of the connections.
+    :param reactor: the reactor
+    :param fd: file descriptor of the listening socket
+    :param factory: protocol factory
+    :param endpoint_string: the ``[ldap-proxy] endpoint`` setting
+    :return: an ``IListeningPort``
+    """
+    # Other endpoints must not be parsed again, e.g. ``systemd:`` endpoints are only valid in the supervisor
+    if endpoint_string.startswith('ssl:'):
+        endpoint = serverFromString(reactor, endpoint_string)
+        # ``SSL4ServerEndpoint`` does not expose its context factory, but it is needed to wrap the connections
+        factory = TLSMemoryBIOFactory(endpoint._sslContextFactory, False, factory)
+    # ``socket.socket`` determines the address family of an existing socket
+    sock = socket.socket(fileno=fd)
+    family = sock.family
+    sock.detach()
+    port = reactor.adoptStreamPort(fd, family, factory)
+    # ``adoptStreamPort`` duplicates the file descriptor
+    os.close(fd)
+    return port
+
+
+def stop_timeout(config):
+    """
+    :return: the number of seconds after which workers are killed on shutdown: They are given some time
+    in addition to the ``drain`` deadline.
+    """
+    return config['timeouts']['drain'] + 5
+
+
+def worker_arguments(config_filename, number):
+    """
+    :return: the command line of the worker process with the given number
+    """
+    return [sys.executable, '-c', 'from twisted.scripts.twistd import run; run()',
+            '--nodaemon', '--pidfile=', 'ldap-proxy', '--config', config_filename, '--worker', str(number)]
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    Supervisor side of one worker process.
+    """
+    def __init__(self, supervisor, number):
+        self.supervisor = supervisor
+        self.number = number
+        #: Time of the last heartbeat (or of the start of the process)
+        self.last_heartbeat = supervisor.seconds()
+        #: Specifies whether the worker has warmed up
+        self.ready = False
+        self.ended = False
+        self._buffer = b''
+        self._waiters = []
+
+    def childDataReceived(self, childFD, data):
+        if childFD != CONTROL_WRITE_FD:
+            return
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if line:
+                self.supervisor.message_received(self, line)
+
+    def send_line(self, line):
+        """
+        Send a control message (as bytes, without the line delimiter) to the worker.
+        """
+        if not self.ended:
+            self.transport.writeToChild(CONTROL_READ_FD, line + b'\n')
+
+    def signal(self, signal_name):
+        """
+        Send a signal to the worker. Workers which have exited already are ignored.
+        """
+        try:
+            self.transport.signalProcess(signal_name)
+        except error.ProcessExitedAlready:
+            pass
+
+    def wait(self):
+        """
+        :return: a Deferred which fires once the worker has exited
+        """
+        if self.ended:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def processEnded(self, reason):
+        self.ended = True
+        self.supervisor.worker_ended(self, reason)
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    """
+    Service which runs ``count`` worker processes sharing the listening socket of *endpoint_string*
+    (see the module documentation).
+
+     * Workers which have exited are restarted after ``restart_delay`` seconds.
+     * Workers which have not sent a heartbeat for ``heartbeat_timeout`` seconds are killed (and restarted).
+     * On shutdown, the workers are asked to terminate. Workers which are still running after
+       ``stop_timeout`` seconds are killed.
+     * On ``restart_signal``, all workers are replaced (see ``restart_workers``).
+     * On ``reload_signal``, the workers reload the configuration (see ``reload``).
+     * ``profile_signal`` is forwarded to the workers, which start a profiling session.
+    """
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+    seconds = reactor.seconds
+    spawnProcess = reactor.spawnProcess
+    check_interval = 1
+    restart_signal = signal.SIGUSR2
+    reload_signal = signal.SIGHUP
+    profile_signal = signal.SIGTTIN
+
+    def __init__(self, config_filename, endpoint_string, count, restart_delay=1, heartbeat_timeout=30,
+                 stop_timeout=10):
+        self.config_filename = os.path.abspath(config_filename)
+        self.endpoint_string = endpoint_string
+        self.count = count
+        self.restart_delay = restart_delay
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stop_timeout = stop_timeout
+        #: The listening port, which is inherited by the workers
+        self.port = None
+        #: Map of worker numbers to running ``WorkerProcessProtocol`` instances
+        self.workers = {}
+        #: Set of workers which have been replaced, but have not exited yet
+        self.retiring = set()
+        #: Map of worker numbers to DelayedCalls of pending restarts
+        self._restart_calls = {}
+        self._check_call = None
+        #: Map of signals to the signal handlers which have been replaced
+        self._previous_handlers = {}
+        #: Specifies whether systemd has been notified that the proxy is ready
+        self.notified_ready = False
+
+    def privilegedStartService(self):
+        """
+        Open the listening socket before privileges are dropped, as it might use a privileged port.
+        """
+        service.Service.privilegedStartService(self)
+        failures = []
+        d = serverFromString(reactor, self.endpoint_string).listen(protocol.Factory.forProtocol(protocol.Protocol))
+        d.addCallbacks(self._listening, failures.append)
+        if failures:
+            failures[0].raiseException()
+
+    def _listening(self, port):
+        # Only the workers accept connections
+        port.stopReading()
+        self.port = port
+        log.info('Listening on {address!r} for {count!r} workers', address=port.getHost(), count=self.count)
+
+    def startService(self):
+        service.Service.startService(self)
+        for number in range(self.count):
+            self.spawn_worker(number)
+        self._check_call = self.callLater(self.check_interval, self.check_health)
+        for signum, callback in ((self.restart_signal, self.restart_workers), (self.reload_signal, self.reload),
+                                 (self.profile_signal, self.profile_workers)):
+            if signum is not None:
+                self._previous_handlers[signum] = install_signal_handler(signum, callback)
+
+    def reload(self):
+        """
+        Validate the configuration file and ask all workers to reload it. The settings of the ``[workers]``
+        section are applied by the supervisor, i.e. workers are started or stopped if ``count`` has changed.
+        :return: a boolean specifying whether the configuration is valid
+        """
+        log.info('Reloading configuration from {filename!r} ...', filename=self.config_filename)
+        try:
+            config = read_config(self.config_filename)
+        except ConfigError as e:
+            log.error('Not reloading invalid configuration: {errors}', errors='; '.join(e.errors))
+            return False
+        if config['ldap-proxy']['endpoint'] != self.endpoint_string:
+            log.warn('Changing the endpoint of the LDAP proxy requires a restart')
+        workers = config['workers']
+        self.restart_delay = workers['restart-delay']
+        self.heartbeat_timeout = workers['heartbeat-timeout']
+        self.stop_timeout = stop_timeout(config)
+        for worker in self.workers.values():
+            worker.signal('HUP')
+        self.resize(workers['count'])
+        return True
+
+    def profile_workers(self):
+        """
+        Ask all workers to start a profiling session.
+        """
+        log.info('Asking {count!r} workers to start profiling ...', count=len(self.workers))
+        for worker in self.workers.values():
+            worker.signal(self.profile_signal)
+
+    def resize(self, count):
+        """
+        Start or stop workers, so that *count* workers are running.
+        """
+        if count < 1:
+            log.warn('Disabling the worker processes requires a restart')
+            return
+        for number in range(self.count, count):
+            self.spawn_worker(number)
+        for number in range(count, self.count):
+            restart_call = self._restart_calls.pop(number, None)
+            if restart_call is not None and restart_call.active():
+                restart_call.cancel()
+            worker = self.workers.pop(number, None)
+            if worker is not None:
+                self.retiring.add(worker)
+                worker.signal('TERM')
+        if count != self.count:
+            log.info('Changed the number of workers from {old!r} to {new!r}', old=self.count, new=count)
+        self.count = count
+
+    def restart_workers(self):
+        """
+        Replace all workers by new worker processes. The new workers are started before the old workers are
+        asked to terminate, so that there is always a worker accepting connections while the old workers
+        drain their sessions.
+        """
+        if not self.running:
+            return
+        log.info('Replacing {count!r} workers ...', count=self.count)
+        old_workers = list(self.workers.values())
+        for number in range(self.count):
+            self.spawn_worker(number)
+        for worker in old_workers:
+            self.retiring.add(worker)
+            worker.signal('TERM')
+
+    def spawn_worker(self, number):
+        """
+        Start the worker process with the given number, replacing the current worker with this number.
+        """
+        restart_call = self._restart_calls.pop(number, None)
+        if restart_call is not None and restart_call.active():
+            restart_call.cancel()
+        worker = WorkerProcessProtocol(self, number)
+        self.workers[number] = worker
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        # Only the supervisor notifies systemd
+        env.pop('NOTIFY_SOCKET', None)
+        self.spawnProcess(worker, sys.executable, worker_arguments(self.config_filename, number), env=env,
+                          childFDs={0: 0, 1: 1, 2: 2,
+                                    LISTEN_FD: self.port.fileno(),
+                                    CONTROL_WRITE_FD: 'r',
+                                    CONTROL_READ_FD: 'w'})
+        log.info('Started worker {number!r}', number=number)
+
+    def message_received(self, worker, line):
+        """
+        Called when *worker* has sent a control message.
+        """
+        kind, args = decode_message(line)
+        if kind == 'heartbeat':
+            worker.last_heartbeat = self.seconds()
+        elif kind == 'ready':
+            worker.ready = True
+            if not self.notified_ready and all(other.ready for other in self.workers.values()):
+                log.info('All {count!r} workers are ready', count=len(self.workers))
+                self.notified_ready = True
+                sd_notify('READY=1')
+        elif kind in CACHE_MESSAGES:
+            for other in self.workers.values():
+                if other is not worker:
+                    other.send_line(line)
+        else:
+            log.warn('Unknown message from worker {number!r}: {kind!r}', number=worker.number, kind=kind)
+
+    def check_health(self):
+        """
+        Kill all workers which have not sent a heartbeat within the heartbeat timeout.
+        """
+        self._check_call = None
+        now = self.seconds()
+        for worker in list(self.workers.values()):
+            if now - worker.last_heartbeat >= self.heartbeat_timeout:
+                log.warn('Worker {number!r} has not sent a heartbeat for {seconds!r} seconds, killing ...',
+                         number=worker.number, seconds=now - worker.last_heartbeat)
+                # Do not kill it again on the next check
+                worker.last_heartbeat = now
+                worker.signal('KILL')
+        self._check_call = self.callLater(self.check_interval, self.check_health)
+
+    def worker_ended(self, worker, reason):
+        """
+        Called when *worker* has exited. If the supervisor is running, the worker is restarted.
+        """
+        if self.workers.get(worker.number) is not worker:
+            self.retiring.discard(worker)
+            log.info('Replaced worker {number!r} has exited', number=worker.number)
+            return
+        del self.workers[worker.number]
+        if self.running:
+            log.warn('Worker {number!r} has exited ({reason}), restarting in {delay!r} seconds ...',
+                     number=worker.number, reason=reason.getErrorMessage(), delay=self.restart_delay)
+            self._restart_calls[worker.number] = self.callLater(self.restart_delay, self.spawn_worker,
+                                                                worker.number)
+        else:
+            log.info('Worker {number!r} has exited', number=worker.number)
+
+    def stopService(self):
+        """
+        Terminate all workers and close the listening socket.
+        :return: a Deferred which fires once all workers have exited
+        """
+        service.Service.stopService(self)
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers.clear()
+        sd_notify('STOPPING=1')
+        if self._check_call is not None:
+            self._check_call.cancel()
+            self._check_call = None
+        for delayed_call in self._restart_calls.values():
+            delayed_call.cancel()
+        self._restart_calls.clear()
+        workers = list(self.workers.values()) + list(self.retiring)
+        for worker in workers:
+            worker.signal('TERM')
+        kill_call = self.callLater(self.stop_timeout, self._kill, workers)
+        d = defer.gatherResults([worker.wait() for worker in workers])
+
+        def stopped(_):
+            if kill_call.active():
+                kill_call.cancel()
+            if self.port is not None:
+                return self.port.stopListening()
+        return d.addCallback(stopped)
+
+    def _kill(self, workers):
+        for worker in workers:
+            if not worker.ended:
+                log.warn('Worker {number!r} has not exited, killing ...', number=worker.number)
+                worker.signal('KILL')
+
+
+class WorkerControl(LineOnlyReceiver):
+    """
+    Worker side of the control pipes: Sends heartbeats to the supervisor every ``heartbeat_interval``
+    seconds and, if ``share_caches`` is enabled, exchanges cache entries with the other workers
+    (see ``ProxyServerFactory.cache_replicator``). If the supervisor has exited, the worker shuts down.
+    """
+    delimiter = b'\n'
+    # (see http://twistedmatrix.com/documents/current/core/howto/trial.html)
+    callLater = reactor.callLater
+
+    def __init__(self, factory, heartbeat_interval=5, share_caches=True):
+        self.factory = factory
+        self.heartbeat_interval = heartbeat_interval
+        self.share_caches = share_caches
+        #: Set once the worker is shutting down, so that the pipes are expected to be closed
+        self.stopping = False
+        self._heartbeat_call = None
+
+    def connectionMade(self):
+        if self.share_caches:
+            self.factory.cache_replicator = self
+        self.heartbeat()
+
+    def heartbeat(self):
+        self.sendLine(encode_message('heartbeat'))
+        self._heartbeat_call = self.callLater(self.heartbeat_interval, self.heartbeat)
+
+    def lineReceived(self, line):
+        kind, args = decode_message(line)
+        # Entries are added to the caches directly, so that they are not sent back to the supervisor
+        if kind == 'bind-cache' and self.factory.bind_cache is not None:
+            self.factory.bind_cache.add_to_cache(*args)
+        elif kind == 'app-cache' and self.factory.app_cache is not None:
+            self.factory.app_cache.add_to_cache(*args)
+        else:
+            log.warn('Ignoring message from supervisor: {kind!r}', kind=kind)
+
+    def bind_cache_added(self, dn, app_marker, password):
+        """
+        Called when an entry has been added to the bind cache of this worker.
+        """
+        self.sendLine(encode_message('bind-cache', dn, app_marker, password))
+
+    def app_cache_added(self, dn, marker):
+        """
+        Called when an entry has been added to the app cache of this worker.
+        """
+        self.sendLine(encode_message('app-cache', dn, marker))
+
+    def send_snapshot(self):
+        """
+        Send all entries of the bind cache and app cache to the supervisor, which relays them to all other
+        workers. This is used to hand the caches over to new workers when this worker shuts down.
+        """
+        if self.factory.bind_cache is not None:
+            for dn, app_marker, password, age in self.factory.bind_cache.entries():
+                self.sendLine(encode_message('bind-cache', dn, app_marker, password, age))
+        if self.factory.app_cache is not None:
+            for dn, marker, age in self.factory.app_cache.entries():
+                self.sendLine(encode_message('app-cache', dn, marker, age))
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._heartbeat_call is not None and self._heartbeat_call.active():
+            self._heartbeat_call.cancel()
+        self._heartbeat_call = None
+        if self.factory.cache_replicator is self:
+            self.factory.cache_replicator = None
+        if not self.stopping:
+            log.warn('Lost connection to the supervisor, shutting down ...')
+            self.shutdown()
+
+    def shutdown(self):
+        try:
+            reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+class WorkerService(service.Service):
+    """
+    Service of a worker process: Accepts connections on the listening socket inherited from the supervisor
+    and connects to the control pipes. Once the worker has warmed up its connections (see ``startup``), it sends
+    a ``ready`` message. On shutdown, the caches are handed over (if they are shared) and the client sessions
+    are drained (see ``ProxyServerFactory.stopFactory``). On ``reload_signal``, the configuration is reloaded
+    from *config_filename*. On ``profile_signal``, a profiling session is started.
+    """
+    reload_signal = signal.SIGHUP
+    profile_signal = signal.SIGTTIN
+
+    def __init__(self, factory, endpoint_string, config_filename, heartbeat_interval=5, share_caches=True):
+        self.factory = factory
+        self.config_filename = config_filename
+        self.endpoint_string = endpoint_string
+        self.heartbeat_interval = heartbeat_interval
+        self.share_caches = share_caches
+        self.port = None
+        self.control = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = adopt_listening_port(reactor, LISTEN_FD, self.factory, self.endpoint_string)
+        self.control = WorkerControl(self.factory, self.heartbeat_interval, self.share_caches)
+        stdio.StandardIO(self.control, stdin=CONTROL_READ_FD, stdout=CONTROL_WRITE_FD)
+        if self.reload_signal is not None:
+            install_signal_handler(self.reload_signal, self.reload)
+        if self.profile_signal is not None:
+            install_signal_handler(self.profile_signal, self.factory.profiler.start)
+        d = self.factory.warmup.run(self.factory.config['startup']['timeout'])
+        d.addCallback(self._warmed_up)
+
+    def _warmed_up(self, _):
+        report_ready(notify=False)
+        if self.running:
+            self.control.sendLine(encode_message('ready'))
+
+    def reload(self):
+        return reload_config(self.factory, self.config_filename)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.control is not None:
+            self.control.stopping = True
+            if self.share_caches:
+                self.control.send_snapshot()
+        if self.port is not None:
+            d = defer.maybeDeferred(self.port.stopListening)
+            return d.addCallback(lambda _: self.factory.stopped)
@@ -0,0 +1,39 @@
+#! /usr/bin/env python
+"""
+Measure the memory allocated per idle client connection of the LDAP proxy using tracemalloc.
+
+    PYTHONPATH=. python tools/memory-benchmark.py --connections 100000 --max-bytes 1024
+
+The connections use in-memory transports, so no sockets are opened. Unless --eager is given, the
+proxy is configured with `lazy-connect`, i.e. idle connections do not connect to the LDAP backend.
+If --max-bytes is given, the script exits with status 1 if the budget is exceeded, so it can be
+used as a regression gate.
+"""
+import argparse
+import sys
+
+from pi_ldapproxy.proxy import ProxyServerFactory
+from pi_ldapproxy.test.util import load_test_config, measure_idle_connection_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=10000, help='number of idle connections')
+    parser.add_argument('--eager', action='store_true', help='disable lazy-connect')
+    parser.add_argument('--max-bytes', type=int, help='fail if a connection needs more bytes')
+    args = parser.parse_args()
+
+    config = load_test_config()
+    config['ldap-backend']['lazy-connect'] = not args.eager
+    factory = ProxyServerFactory(config)
+    per_connection = measure_idle_connection_memory(factory, args.connections)
+    print('{:.0f} bytes per idle connection ({} connections, {:.1f} MiB in total)'.format(
+        per_connection, args.connections, per_connection * args.connections / 2 ** 20))
+    if args.max_bytes is not None and per_connection > args.max_bytes:
+        print('Budget of {} bytes exceeded!'.format(args.max_bytes))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,85 @@
+import os
 import sys
+import time
 
-from twisted.internet import reactor
-from twisted.internet.endpoints import serverFromString
 from zope.interface import implementer
 
 from twisted.python import usage, log
 from twisted.plugin import IPlugin
-from twisted.application.service import IServiceMaker
-from twisted.application import internet
+from twisted.application.service import IServiceMaker, MultiService
 
-from pi_ldapproxy.config import load_config
-from pi_ldapproxy.proxy import ProxyServerFactory
+# twistd imports every plugin on every invocation, so the modules of the proxy are only imported
+# once the proxy is actually started (see ``ProxyServiceMaker.makeService``).
+
+
+def build_factory(config, started):
+    """
+    Import the proxy and create its factory, and record the durations of both phases (see ``startup``).
+    :param config: the configuration
+    :param started: timestamp at which the startup has begun
+    :return: a ``ProxyServerFactory``
+    """
+    from pi_ldapproxy.startup import timings
+    from pi_ldapproxy.proxy import ProxyServerFactory
+    started = timings.lap('imports', started)
+    factory = ProxyServerFactory(config)
+    timings.lap('configuration', started)
+    return factory
+
+
+def add_metrics_listener(proxy_service, factory, config, worker=None):
+    """
+    If ``[metrics] endpoint`` is set, serve the metrics of *factory* alongside *proxy_service*.
+    :return: the service which is to be run
+    """
+    if not config['metrics']['endpoint']:
+        return proxy_service
+    from pi_ldapproxy.metrics import metrics_service
+    parent = MultiService()
+    proxy_service.setServiceParent(parent)
+    metrics_service(factory.metrics, config['metrics']['endpoint'], worker).setServiceParent(parent)
+    return parent
+
+
+def add_health_listener(proxy_service, factory, config, worker=None):
+    """
+    If ``[health] endpoint`` is set, serve the health of *factory* alongside *proxy_service*.
+    :return: the service which is to be run
+    """
+    if not config['health']['endpoint']:
+        return proxy_service
+    from pi_ldapproxy.health import health_service
+    parent = MultiService()
+    proxy_service.setServiceParent(parent)
+    health_service(factory.health, config['health']['endpoint'], worker).setServiceParent(parent)
+    return parent
+
+
+def add_listeners(proxy_service, factory, config, worker=None):
+    """
+    Serve the metrics and the health of *factory* alongside *proxy_service*, if their endpoints are set.
+    :return: the service which is to be run
+    """
+    return add_health_listener(add_metrics_listener(proxy_service, factory, config, worker), factory, config, worker)
+
+
+def add_json_log(main_service, config, worker=None):
+    """
+    If ``[logging] file`` is set, write the log events to this file while *main_service* is running.
+    :return: the service which is to be run
+    """
+    from pi_ldapproxy.logs import LoggedService, json_log_service
+    writer = json_log_service(config['logging'], worker)
+    if writer is None:
+        return main_service
+    return LoggedService(main_service, writer)
 
 
 class Options(usage.Options):
     #: The configuration file (which is mandatory) is passed as a parameter.
     #: It might be desirable to use a positional argument instead.
-    optParameters = [["config", "c", None, "Configuration file"]]
+    optParameters = [["config", "c", None, "Configuration file"],
+                     ["worker", None, None, "Run as worker process with the given number (used internally)"]]
 
 
 @implementer(IServiceMaker, IPlugin)
@@ -36,11 +99,36 @@ class ProxyServiceMaker(object):
             print('You need to specify a configuration file via `twistd ldap-proxy -c config.ini`.')
             sys.exit(1)
 
+        started = time.time()
+        from pi_ldapproxy.config import load_config
+        from pi_ldapproxy.logs import configure as configure_logging
+        from pi_ldapproxy.workers import WorkerService, WorkerSupervisor, stop_timeout
         config = load_config(options['config'])
-        factory = ProxyServerFactory(config)
+        configure_logging(config['logging'])
+        # The configuration file is read again on reload, possibly after twistd has changed the working directory
+        config_filename = os.path.abspath(options['config'])
+        workers = config['workers']
+        if options['worker'] is not None:
+            # Worker process started by the supervisor, see ``pi_ldapproxy.workers``
+            factory = build_factory(config, started)
+            proxy_service = WorkerService(factory, config['ldap-proxy']['endpoint'], config_filename,
+                                          workers['heartbeat-interval'], workers['share-caches'])
+            worker = int(options['worker'])
+            return add_json_log(add_listeners(proxy_service, factory, config, worker), config, worker)
+        elif workers['count'] > 0:
+            supervisor = WorkerSupervisor(config_filename, config['ldap-proxy']['endpoint'], workers['count'],
+                                          workers['restart-delay'], workers['heartbeat-timeout'],
+                                          stop_timeout(config))
+            return add_json_log(supervisor, config, 'supervisor')
+
+        from twisted.internet import reactor
+        from twisted.internet.endpoints import serverFromString
+        from pi_ldapproxy.services import ProxyService
+        factory = build_factory(config, started)
 
         endpoint_string = serverFromString(reactor, config['ldap-proxy']['endpoint'])
-        return internet.StreamServerEndpointService(endpoint_string, factory)
+        return add_json_log(add_listeners(ProxyService(endpoint_string, factory, config_filename), factory, config),
+                            config)
 
 
 serviceMaker = ProxyServiceMaker()